@@ -1,13 +1,8 @@
 import math
 
 import pandas as pd
-from tkinter import *
-from tkinter import ttk
-from openpyxl.utils import get_column_letter
-from openpyxl.styles import PatternFill, Font, Alignment
 from math import ceil
 import re
-from PIL import Image, ImageTk
 import traceback
 import os
 import sys
@@ -16,13 +11,22 @@ import numpy as np
 import warnings 
 import contextlib
 import unicodedata
+import json
+import sqlite3
+import hashlib
+import threading
+import tempfile
+import zipfile
+import io
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+
+# Importar este módulo não lê nenhum arquivo nem carrega Tk/PIL/openpyxl: a interface (main.py) desenha
+# nos widgets que recebe e o openpyxl só é importado quando um relatório é gravado.
 
 # Suppress xlrd / Excel warnings
 warnings.simplefilter("ignore")
-
-# Optionally suppress all print output from the engine
-with contextlib.redirect_stdout(None), contextlib.redirect_stderr(None):
-    df = pd.read_excel("Template.xlsx", engine="openpyxl")
 warnings.filterwarnings(
     "ignore",
     category=UserWarning,
@@ -172,241 +176,682 @@ def normalize_sheet_name(desired_name, available_sheets):
             return sheet  # Return the actual sheet name from the file
     
     return None  # No match found
-    
 
-def Processar_Demandas(cod_destino, pasta_demandas="Demandas", sheet_name=None):
-    
-    # Define o caminho completo para a pasta de demandas
-    caminho_pasta = os.path.join(caminho_base, pasta_demandas)
 
-    # Verifica se a pasta de demandas existe
-    if not os.path.isdir(caminho_pasta):
-        adicionar_erro(f"Pasta de demandas não encontrada: '{caminho_pasta}'", "ERRO")
-        return pd.DataFrame()
+# Bytes do caminho vetorizado do parser GMDNVA8: ASCII imprimível + tab/CR/LF, exceto '_'
+# (int() aceita '1_000', então linhas com '_' seguem pela regra original em texto)
+_BYTES_REGULARES_TXT = bytes(b for b in [9, 10, 13] + list(range(0x20, 0x7F)) if b != ord('_'))
 
-    # Lista para armazenar os DataFrames de cada arquivo processado
-    lista_dfs = []
+# Abaixo disso o custo fixo das operações NumPy (~1,5 ms) supera o laço em texto: arquivos pequenos seguem
+# linha a linha (benchmarks.py txt: empate perto de 400 linhas, 2,5x a favor do colunar com 100 mil)
+_LINHAS_MINIMAS_TXT_COLUNAR = 500
+_TABELA_BRANCO_TXT = np.zeros(256, dtype=bool)
+_TABELA_BRANCO_TXT[[9, 13, 32]] = True
+
+
+def _inteiros_largura_fixa(campos, ignorar_mais=False):
+    """Equivalente vetorizado de int(campo.strip()) para uma matriz de bytes ASCII (linhas x largura).
+
+    Percorre as colunas (no máximo 11) aplicando a mesma gramática de int() a todas as linhas de uma
+    vez: brancos à esquerda, sinal opcional, dígitos e brancos à direita.
+
+    Args:
+        campos: array uint8 (n, largura) com os caracteres de cada campo
+        ignorar_mais: se True, remove o sinal '+' antes do strip (regra da QTDE)
+
+    Returns:
+        tuple: (array int64 com os valores, array bool indicando quais campos são inteiros válidos)
+    """
+    n = campos.shape[0]
+    valores = np.zeros(n, dtype=np.int64)
+    digitos = np.zeros(n, dtype=np.int64)
+    negativo = np.zeros(n, dtype=bool)
+    invalido = np.zeros(n, dtype=bool)
+    iniciado = np.zeros(n, dtype=bool)   # já leu sinal ou dígito
+    encerrado = np.zeros(n, dtype=bool)  # já leu branco depois do número
+
+    for caractere in np.ascontiguousarray(campos.T):
+        removido = (caractere == ord('+')) if ignorar_mais else np.zeros(n, dtype=bool)
+        branco = _TABELA_BRANCO_TXT[caractere] & ~removido
+        digito = (caractere >= ord('0')) & (caractere <= ord('9'))
+        sinal = ((caractere == ord('+')) | (caractere == ord('-'))) & ~removido
+
+        invalido |= (digito & encerrado) | (sinal & iniciado) | ~(branco | digito | sinal | removido)
+        encerrado |= branco & iniciado
+        negativo |= sinal & (caractere == ord('-'))
+        iniciado |= digito | sinal
+        valores = np.where(digito, valores * 10 + (caractere.astype(np.int64) - ord('0')), valores)
+        digitos += digito
+
+    return np.where(negativo, -valores, valores), ~invalido & (digitos > 0)
+
+
+def _ler_linhas_txt_demanda(linhas):
+    """Regra original linha a linha, usada pelo parser colunar para linhas fora do ASCII simples."""
+    dados = []
+    for linha in linhas:
+        if "AUTOMATIC" in linha:
+            continue
+
+        linha = linha.strip()
+
+        # A lógica de fatiamento requer um comprimento mínimo
+        if len(linha) >= 20:
+            try:
+                dados.append((
+                    int(linha[3:14].strip()),
+                    int(linha[-20:-11].strip()),
+                    int(linha[-11:].replace("+", "").strip()),
+                ))
+            except (ValueError, IndexError):
+                # Ignora linhas que não seguem o formato esperado
+                continue
+    return dados
+
+
+def _ler_txt_demanda(caminho_arquivo):
+    """Lê um arquivo GMDNVA8 (.txt/.csv) inteiro de uma vez, fatiando os bytes com NumPy.
+
+    Mantém as regras do layout de largura fixa: ignora linhas com 'AUTOMATIC', exige ao menos
+    20 caracteres após o strip, DESENHO = [3:14], COD FORNECEDOR = [-20:-11] e QTDE = [-11:]
+    sem o sinal '+'. Linhas cujos campos não são inteiros são descartadas. Linhas com bytes
+    fora do ASCII imprimível (acentos, BOM, CR isolado, '_') seguem pela regra original em texto,
+    assim como arquivos inteiros com menos de _LINHAS_MINIMAS_TXT_COLUNAR linhas.
+
+    Returns:
+        DataFrame com DESENHO, COD FORNECEDOR e QTDE (int64); vazio se nenhuma linha for válida
+    """
+    with open(caminho_arquivo, "rb") as arquivo:
+        conteudo = arquivo.read()
+
+    buf = np.frombuffer(conteudo, dtype=np.uint8)
+    quebras = np.flatnonzero(buf == 10)
+
+    if len(quebras) < _LINHAS_MINIMAS_TXT_COLUNAR:
+        # Mesma decodificação do open(..., "r", errors="ignore") original, com as quebras universais
+        linhas = io.TextIOWrapper(io.BytesIO(conteudo), encoding="utf-8", errors="ignore").readlines()
+        dados = _ler_linhas_txt_demanda(linhas)
+        return pd.DataFrame({
+            nome: np.array([valores[pos] for valores in dados], dtype=np.int64)
+            for pos, nome in enumerate(["DESENHO", "COD FORNECEDOR", "QTDE"])
+        })
+
+    inicios = np.concatenate(([0], quebras + 1))
+    fins = np.concatenate((quebras, [len(buf)]))  # exclusivo, sem o '\n'
+
+    # Linhas irregulares: bytes não ASCII, controles que str.strip() também removeria
+    # ou CR isolado (que o modo texto trataria como quebra de linha)
+    linha_irregular = np.zeros(len(inicios), dtype=bool)
+    retornos = np.flatnonzero(buf == 13)
+    tem_cr_isolado = bool(len(retornos)) and (
+        retornos[-1] == len(buf) - 1 or bool((buf[retornos[retornos < len(buf) - 1] + 1] != 10).any()))
+    if conteudo.translate(None, _BYTES_REGULARES_TXT) or tem_cr_isolado:
+        proximo = np.concatenate((buf[1:], [0])).astype(np.uint8)
+        irregular = ~np.isin(buf, np.frombuffer(_BYTES_REGULARES_TXT, dtype=np.uint8)) | ((buf == 13) & (proximo != 10))
+        irregulares_acumulados = np.concatenate(([0], np.cumsum(irregular)))
+        linha_irregular = irregulares_acumulados[fins] > irregulares_acumulados[inicios]
+
+    # Cabeçalhos AUTOMATIC
+    linha_automatic = np.zeros(len(inicios), dtype=bool)
+    pos = conteudo.find(b"AUTOMATIC")
+    while pos != -1:
+        linha_automatic[np.searchsorted(inicios, pos, side="right") - 1] = True
+        pos = conteudo.find(b"AUTOMATIC", pos + 1)
+
+    # strip(): nas linhas regulares, brancos (espaço, tab, CR) são exatamente os bytes <= 32
+    nao_branco = np.flatnonzero(buf > 32)
+    if len(nao_branco):
+        primeiro = nao_branco[np.minimum(np.searchsorted(nao_branco, inicios), len(nao_branco) - 1)]
+        ultimo = nao_branco[np.maximum(np.searchsorted(nao_branco, fins) - 1, 0)]
+        comprimento = np.where((primeiro < fins) & (ultimo >= inicios), ultimo - primeiro + 1, 0)
+    else:
+        primeiro = ultimo = comprimento = np.zeros(len(inicios), dtype=np.int64)
+
+    regulares = np.flatnonzero(~linha_irregular & ~linha_automatic & (comprimento >= 20))
+    primeiro = primeiro[regulares]
+    ultimo = ultimo[regulares]
+
+    desenho, ok_desenho = _inteiros_largura_fixa(buf[primeiro[:, None] + np.arange(3, 14)])
+    fornecedor, ok_fornecedor = _inteiros_largura_fixa(buf[ultimo[:, None] + np.arange(-19, -10)])
+    qtde, ok_qtde = _inteiros_largura_fixa(buf[ultimo[:, None] + np.arange(-10, 1)], ignorar_mais=True)
+
+    validos = ok_desenho & ok_fornecedor & ok_qtde
+    ordem = [regulares[validos]]
+    colunas = [desenho[validos], fornecedor[validos], qtde[validos]]
+
+    # Linhas irregulares (raras): decodifica e aplica a regra original em texto
+    extras = []
+    for i in np.flatnonzero(linha_irregular):
+        texto = conteudo[inicios[i]:fins[i]].decode("utf-8", errors="ignore")
+        for valores in _ler_linhas_txt_demanda(texto.split("\r")):
+            extras.append((i, valores))
+
+    if extras:
+        ordem.append(np.array([i for i, _ in extras], dtype=np.int64))
+        for pos, coluna in enumerate(colunas):
+            colunas[pos] = np.concatenate((coluna, np.array([v[pos] for _, v in extras], dtype=np.int64)))
+
+    sequencia = np.argsort(np.concatenate(ordem), kind="stable")
+    return pd.DataFrame({
+        "DESENHO": colunas[0][sequencia],
+        "COD FORNECEDOR": colunas[1][sequencia],
+        "QTDE": colunas[2][sequencia],
+    })
+
+
+def _ler_cabecalho_excel(caminho_arquivo, sheet_name=0, header=0):
+    """Lê só a linha de cabeçalho de uma planilha (openpyxl em modo somente leitura para .xlsx).
+
+    Serve para classificar o arquivo antes da leitura completa: arquivos com layout errado
+    são descartados sem ler os dados.
+    """
+    return list(pd.read_excel(caminho_arquivo, sheet_name=sheet_name, header=header, nrows=0).columns)
 
-    # Percorre todos os arquivos na pasta de demandas
-    for nome_arquivo in os.listdir(caminho_pasta):
-        caminho_completo_arquivo = os.path.join(caminho_pasta, nome_arquivo)
-        nome_arquivo_lower = nome_arquivo.lower()
+
+def _posicoes_colunas(colunas_cabecalho, colunas_necessarias):
+    """Posições (para usecols) das colunas necessárias, na ordem em que aparecem no arquivo"""
+    return sorted({colunas_cabecalho.index(coluna) for coluna in colunas_necessarias})
+
+
+def _coluna_saturacao(coluna):
+    """Nome padrão de uma coluna do cabeçalho da planilha de saturação, ou None se não for usada"""
+    col_upper = str(coluna).upper().strip()
+    if 'DESENHO' in col_upper and 'FIAT' in col_upper:
+        return 'DESENHO'
+    elif 'CÓDIGO' in col_upper and 'IMS' in col_upper:
+        # IMS será mantido como COD IMS
+        return 'COD IMS'
+    elif 'QUANTIDADE' in col_upper and 'SOLICITADA' in col_upper:
+        return 'QTDE'
+    return None
+
+
+# Planilhas de saturação já lidas: caminho -> ((tamanho, mtime_ns), {aba: DataFrame ou exceção da leitura})
+# Trocar a opção de Flechinha entre execuções reaproveita a leitura em vez de abrir o arquivo de novo.
+# Processar_Demandas descarta os arquivos que saíram da pasta de demandas.
+_cache_planilhas_saturacao = {}
+
+
+def _abas_planilha_saturacao(caminho_arquivo):
+    """Lê todas as abas de um arquivo de saturação (cabeçalho na linha 3, só as colunas usadas).
+
+    O workbook é aberto uma única vez por versão do arquivo; se tamanho ou data de modificação
+    mudarem, a entrada é descartada e o arquivo é lido de novo. Abas que não podem ser lidas
+    guardam a exceção, que só é lançada se aquela aba for pedida.
+    """
+    stat = os.stat(caminho_arquivo)
+    impressao = (stat.st_size, stat.st_mtime_ns)
+    chave = os.path.normcase(os.path.abspath(caminho_arquivo))
+
+    entrada = _cache_planilhas_saturacao.get(chave)
+    if entrada is not None and entrada[0] == impressao:
+        return entrada[1]
+
+    abas = {}
+    with pd.ExcelFile(caminho_arquivo) as xl_file:
+        for aba in xl_file.sheet_names:
+            try:
+                abas[aba] = xl_file.parse(aba, header=2, usecols=lambda c: _coluna_saturacao(c) is not None)
+            except Exception as e:
+                abas[aba] = e
+
+    _cache_planilhas_saturacao[chave] = (impressao, abas)
+    return abas
+
+
+def _remover_planilhas_saturacao_orfas(caminho_pasta, nomes_arquivos):
+    """Descarta da memória as planilhas de saturação desta pasta que não estão mais em `nomes_arquivos`"""
+    prefixo = os.path.normcase(os.path.abspath(caminho_pasta)) + os.sep
+    presentes = {os.path.normcase(os.path.abspath(os.path.join(caminho_pasta, nome))) for nome in nomes_arquivos}
+    for chave in list(_cache_planilhas_saturacao):
+        if chave.startswith(prefixo) and chave not in presentes:
+            del _cache_planilhas_saturacao[chave]
+
+
+def _ler_arquivo_demanda(caminho_pasta, nome_arquivo, sheet_name):
+    """Lê um único arquivo da pasta de demandas e o converte para o layout padrão.
+
+    Não depende do destino (ver _aplicar_destino_demanda), o que permite guardar o resultado no
+    cache de demandas. Função de nível de módulo para poder ser enviada ao pool de processos de
+    Processar_Demandas; como o processo filho não enxerga a lista global de erros, os avisos são
+    devolvidos ao chamador.
+
+    Returns:
+        tuple: (DataFrame do arquivo ou None se ignorado, lista de (mensagem, tipo) para adicionar_erro,
+                False se a leitura falhou por exceção e o resultado não deve ir para o cache)
+    """
+    caminho_completo_arquivo = os.path.join(caminho_pasta, nome_arquivo)
+    nome_arquivo_lower = nome_arquivo.lower()
+    mensagens = []
+
+    try:
+        # --- ARQUIVOS .TXT E .CSV (layout GMDNVA8 de largura fixa) ---
+        if nome_arquivo_lower.endswith((".txt", ".csv")):
+            # Fatiamento de largura fixa feito de forma colunar (ver _ler_txt_demanda)
+            df_temp = _ler_txt_demanda(caminho_completo_arquivo)
+
+            # Se dados foram extraídos do arquivo, cria um DataFrame
+            if not df_temp.empty:
+                df_temp['IS_FLECHINHA'] = 0  # .txt files are NOT flechinha
+                return df_temp, mensagens, True
+
+        # --- NOVA LÓGICA PARA PROCESSAR ARQUIVOS EXCEL (.XLS, .XLSX) ---
+        elif nome_arquivo_lower.endswith((".xls", ".xlsx")) and ("saturação" not in nome_arquivo_lower and "saturacao" not in nome_arquivo_lower) and not nome_arquivo_lower.startswith("~$") and 'Coletas' not in nome_arquivo and 'DHL' not in nome_arquivo:
+                       
+            # Mapeamento dos nomes de coluna do arquivo Excel para os nomes desejados
+            colunas_mapeamento = {
+                'DESENHO': 'DESENHO',
+                'COD ORIGEM': 'COD FORNECEDOR',
+                'ENTREGA SOLICITADA': 'QTDE',
+                'COD DESTINO': 'COD DESTINO'
+            }
+        
+            # Lê só o cabeçalho do arquivo Excel
+            colunas_cabecalho = _ler_cabecalho_excel(caminho_completo_arquivo)
+
+            # Pega a lista de colunas que precisamos do arquivo original
+            colunas_originais_necessarias = list(colunas_mapeamento.keys())
+
+            # Verifica se todas as colunas necessárias existem no arquivo
+            if not all(coluna in colunas_cabecalho for coluna in colunas_originais_necessarias):
+                faltando = [c for c in colunas_originais_necessarias if c not in colunas_cabecalho]
+                mensagens.append((f"Arquivo '{nome_arquivo}': Colunas faltando: {', '.join(faltando)}", "AVISO"))
+                return None, mensagens, True
+
+            # Lê os dados apenas das colunas mapeadas
+            df_excel = pd.read_excel(caminho_completo_arquivo,
+                                     usecols=_posicoes_colunas(colunas_cabecalho, colunas_originais_necessarias))
+
+            # 1. Seleciona apenas as colunas que nos interessam
+            df_temp = df_excel[colunas_originais_necessarias].copy()
+        
+            # 2. Renomeia as colunas para o padrão final
+            df_temp.rename(columns=colunas_mapeamento, inplace=True)
+       
+            # 3. Marca como NÃO FLECHINHA (Excel normal, não saturação)
+            #    O filtro por COD DESTINO é feito em _aplicar_destino_demanda
+            df_temp['IS_FLECHINHA'] = 0
         
-        try:
-            # --- MANTÉM A LÓGICA ORIGINAL PARA ARQUIVOS .TXT E .CSV ---
-            if nome_arquivo_lower.endswith((".txt", ".csv")):
-                dados_arquivo_atual = []
-                with open(caminho_completo_arquivo, "r", encoding="utf-8", errors="ignore") as arquivo:
-                    linhas_a_processar = arquivo.readlines()
+            # 4. Adiciona o DataFrame processado à lista para concatenação posterior
+            return df_temp, mensagens, True
+        
+        elif nome_arquivo_lower.endswith((".xls", ".xlsx")) and ("saturação" in nome_arquivo_lower or "saturacao" in nome_arquivo_lower)  and not nome_arquivo_lower.startswith("~$") and 'Coletas' not in nome_arquivo and 'DHL' not in nome_arquivo:
+                        
+            # Só processa arquivos de saturação se sheet_name foi fornecido
+            if sheet_name is None:
+                return None, mensagens, True
+        
+            try:
+                # Todas as abas do arquivo, lidas uma única vez e mantidas em memória
+                abas = _abas_planilha_saturacao(caminho_completo_arquivo)
+                nomes_abas = list(abas.keys())
+            
+                # Normaliza o nome da sheet para encontrar correspondência
+                actual_sheet_name = normalize_sheet_name(sheet_name, nomes_abas)
+            
+                # Verifica se a sheet existe
+                if actual_sheet_name is None:
+                    mensagens.append((f"Arquivo '{nome_arquivo}': Sheet '{sheet_name}' não encontrada. Disponíveis: {', '.join(nomes_abas)}", "ERRO"))
+                    return None, mensagens, True
+            
+            except Exception as e:
+                # Arquivo aberto/bloqueado no Excel: não guarda no cache para tentar de novo
+                return None, mensagens, False
+        
+            # Sheet específica com header na linha 3 (índice 2); aba ilegível propaga o erro da leitura
+            df_excel = abas[actual_sheet_name]
+            if isinstance(df_excel, Exception):
+                raise df_excel
+        
+            colunas_saturacao_mapeamento = {}
+        
+            # Procura pelas colunas necessárias
+            for col in df_excel.columns:
+                coluna_padrao = _coluna_saturacao(col)
+                if coluna_padrao is not None:
+                    colunas_saturacao_mapeamento[col] = coluna_padrao
+        
+            # Verifica se encontrou as colunas OBRIGATÓRIAS (DESENHO e QTDE)
+            tem_desenho = 'DESENHO' in colunas_saturacao_mapeamento.values()
+            tem_qtde = 'QTDE' in colunas_saturacao_mapeamento.values()
+        
+            if not (tem_desenho and tem_qtde):
+                faltando = []
+                if not tem_desenho: faltando.append('DESENHO FIAT')
+                if not tem_qtde: faltando.append('QUANTIDADE SOLICITADA')
+                mensagens.append((f"Arquivo saturação '{nome_arquivo}': Colunas obrigatórias faltando: {', '.join(faltando)}", "ERRO"))
+                return None, mensagens, True
 
-                # Processa cada linha extraída do arquivo de texto
-                for linha in linhas_a_processar:
-                    if "AUTOMATIC" in linha:
-                        continue
+            # 1. Seleciona apenas as colunas que nos interessam
+            colunas_originais_necessarias = list(colunas_saturacao_mapeamento.keys())
+            df_temp = df_excel[colunas_originais_necessarias].copy()
+        
+            # 2. Renomeia as colunas para o padrão final
+            df_temp.rename(columns=colunas_saturacao_mapeamento, inplace=True)
+        
+        
+        
+            # 3. Remove .0 do final dos valores de COD IMS (converte para int, depois para string)
+            if 'COD IMS' in df_temp.columns:
+                df_temp['COD IMS'] = pd.to_numeric(df_temp['COD IMS'], errors='coerce')
+                df_temp['COD IMS'] = df_temp['COD IMS'].fillna(0).astype(int).astype(str)
+                # df_temp['COD IMS'] = df_temp['COD IMS'].replace('0', pd.NA)  # Restaura NaN onde era 0
+            
+        
+            # 4. COD FORNECEDOR sempre nulo para arquivos de saturação (será preenchido depois via COD IMS)
+            df_temp['COD FORNECEDOR'] = ""
+            # print(f"INFO: Coluna 'COD FORNECEDOR' definida como nula (será derivada de COD IMS).")
 
-                    linha = linha.strip()
+            # 5. Marca como FLECHINHA (saturação file)
+            #    COD DESTINO é adicionado em _aplicar_destino_demanda
+            df_temp['IS_FLECHINHA'] = 1
 
-                    # A lógica de fatiamento requer um comprimento mínimo
-                    if len(linha) >= 20:
-                        try:
-                            # Extrai os dados com base na posição dos caracteres
-                            desenho = linha[3:14]
-                            cod_fornecedor = linha[-20:-11]
-                            quantidade = linha[-11:].replace("+", "")
-
-                            # Adiciona os dados extraídos à lista deste arquivo
-                            dados_arquivo_atual.append({
-                                "DESENHO": int(desenho.strip()),
-                                "COD FORNECEDOR": int(cod_fornecedor.strip()),
-                                "QTDE": int(quantidade.strip()),
-                            })
-                        except (ValueError, IndexError):
-                            # Ignora linhas que não seguem o formato esperado
-                            continue
-                
-                # Se dados foram extraídos do arquivo, cria um DataFrame
-                if dados_arquivo_atual:
-                    df_temp = pd.DataFrame(dados_arquivo_atual)
-                    if cod_destino is not None:
-                        df_temp["COD DESTINO"] = cod_destino
-                    df_temp['IS_FLECHINHA'] = 0  # .txt files are NOT flechinha
-                    lista_dfs.append(df_temp)
-
-            # --- NOVA LÓGICA PARA PROCESSAR ARQUIVOS EXCEL (.XLS, .XLSX) ---
-            elif nome_arquivo_lower.endswith((".xls", ".xlsx")) and ("saturação" not in nome_arquivo_lower and "saturacao" not in nome_arquivo_lower) and not nome_arquivo_lower.startswith("~$") and 'Coletas' not in nome_arquivo and 'DHL' not in nome_arquivo:
-                               
-                # Mapeamento dos nomes de coluna do arquivo Excel para os nomes desejados
-                colunas_mapeamento = {
-                    'DESENHO': 'DESENHO',
-                    'COD ORIGEM': 'COD FORNECEDOR',
-                    'ENTREGA SOLICITADA': 'QTDE',
-                    'COD DESTINO': 'COD DESTINO'
-                }
-                
-                # Lê o arquivo Excel
-                df_excel = pd.read_excel(caminho_completo_arquivo)
+            # 6. Adiciona o DataFrame processado à lista para concatenação posterior
+            return df_temp, mensagens, True
+        
+        elif nome_arquivo_lower.endswith((".xls", ".xlsx")) and not nome_arquivo_lower.startswith("~$") and "Coletas DHL" in nome_arquivo and "DHL" in nome_arquivo:
+            print(f"Processando arquivo de coletas DHL: '{nome_arquivo}'")
+        
+            # Mapeamento dos nomes de coluna do arquivo Excel para os nomes desejados
+            colunas_mapeamento = {
+                'Desenho': 'DESENHO',
+                'Codigo': 'COD FORNECEDOR',
+                'Quantidade': 'QTDE',
+                'Data da coleta': 'FDS'  # Usamos a data da coleta como COD DESTINO para filtrar depois, se necessário
+            }
+        
+            # Lê só o cabeçalho do arquivo Excel
+            colunas_cabecalho = _ler_cabecalho_excel(caminho_completo_arquivo)
 
-                # Pega a lista de colunas que precisamos do arquivo original
-                colunas_originais_necessarias = list(colunas_mapeamento.keys())
+            # Pega a lista de colunas que precisamos do arquivo original
+            colunas_originais_necessarias = list(colunas_mapeamento.keys())
 
-                # Verifica se todas as colunas necessárias existem no arquivo
-                if not all(coluna in df_excel.columns for coluna in colunas_originais_necessarias):
-                    faltando = [c for c in colunas_originais_necessarias if c not in df_excel.columns]
-                    adicionar_erro(f"Arquivo '{nome_arquivo}': Colunas faltando: {', '.join(faltando)}", "AVISO")
-                    continue
+            # Verifica se todas as colunas necessárias existem no arquivo
+            if not all(coluna in colunas_cabecalho for coluna in colunas_originais_necessarias):
+                faltando = [c for c in colunas_originais_necessarias if c not in colunas_cabecalho]
+                mensagens.append((f"Arquivo '{nome_arquivo}': Colunas faltando: {', '.join(faltando)}", "AVISO"))
+                return None, mensagens, True
 
-                # 1. Seleciona apenas as colunas que nos interessam
-                df_temp = df_excel[colunas_originais_necessarias].copy()
-                
-                # 2. Renomeia as colunas para o padrão final
-                df_temp.rename(columns=colunas_mapeamento, inplace=True)
-               
-                # 3. Filtra por COD DESTINO se fornecido
-                if cod_destino is not None:
-                    df_temp = df_temp[df_temp['COD DESTINO'].astype(str) == str(cod_destino)]
-
-                # 4. Marca como NÃO FLECHINHA (Excel normal, não saturação)
-                df_temp['IS_FLECHINHA'] = 0
-                
-                # 5. Adiciona o DataFrame processado à lista para concatenação posterior
-                lista_dfs.append(df_temp)
-                
-            elif nome_arquivo_lower.endswith((".xls", ".xlsx")) and ("saturação" in nome_arquivo_lower or "saturacao" in nome_arquivo_lower)  and not nome_arquivo_lower.startswith("~$") and 'Coletas' not in nome_arquivo and 'DHL' not in nome_arquivo:
-                                
-                # Só processa arquivos de saturação se sheet_name foi fornecido
-                if sheet_name is None:
-                    continue
-                
-                try:
-                    xl_file = pd.ExcelFile(caminho_completo_arquivo)
-                    
-                    # Normaliza o nome da sheet para encontrar correspondência
-                    actual_sheet_name = normalize_sheet_name(sheet_name, xl_file.sheet_names)
-                    
-                    # Verifica se a sheet existe
-                    if actual_sheet_name is None:
-                        adicionar_erro(f"Arquivo '{nome_arquivo}': Sheet '{sheet_name}' não encontrada. Disponíveis: {', '.join(xl_file.sheet_names)}", "ERRO")
-                        continue
-                    
-                except Exception as e:
-                    continue
-                
-                # Lê o arquivo Excel de saturação da sheet específica com header na linha 3 (índice 2)
-                df_excel = pd.read_excel(caminho_completo_arquivo, sheet_name=actual_sheet_name, header=2)
-                
-                colunas_saturacao_mapeamento = {}
-                
-                # Procura pelas colunas necessárias
-                for col in df_excel.columns:
-                    col_upper = str(col).upper().strip()
-                    if 'DESENHO' in col_upper and 'FIAT' in col_upper:
-                        colunas_saturacao_mapeamento[col] = 'DESENHO'
-                    elif 'CÓDIGO' in col_upper and 'IMS' in col_upper:
-                        # IMS será mantido como COD IMS
-                        colunas_saturacao_mapeamento[col] = 'COD IMS'
-                    elif 'QUANTIDADE' in col_upper and 'SOLICITADA' in col_upper:
-                        colunas_saturacao_mapeamento[col] = 'QTDE'
-                
-                # Verifica se encontrou as colunas OBRIGATÓRIAS (DESENHO e QTDE)
-                tem_desenho = 'DESENHO' in colunas_saturacao_mapeamento.values()
-                tem_qtde = 'QTDE' in colunas_saturacao_mapeamento.values()
-                
-                if not (tem_desenho and tem_qtde):
-                    faltando = []
-                    if not tem_desenho: faltando.append('DESENHO FIAT')
-                    if not tem_qtde: faltando.append('QUANTIDADE SOLICITADA')
-                    adicionar_erro(f"Arquivo saturação '{nome_arquivo}': Colunas obrigatórias faltando: {', '.join(faltando)}", "ERRO")
-                    continue
+            # Lê os dados apenas das colunas mapeadas
+            df_excel = pd.read_excel(caminho_completo_arquivo,
+                                     usecols=_posicoes_colunas(colunas_cabecalho, colunas_originais_necessarias))
 
-                # 1. Seleciona apenas as colunas que nos interessam
-                colunas_originais_necessarias = list(colunas_saturacao_mapeamento.keys())
-                df_temp = df_excel[colunas_originais_necessarias].copy()
-                
-                # 2. Renomeia as colunas para o padrão final
-                df_temp.rename(columns=colunas_saturacao_mapeamento, inplace=True)
-                
-                
-                
-                # 3. Remove .0 do final dos valores de COD IMS (converte para int, depois para string)
-                if 'COD IMS' in df_temp.columns:
-                    df_temp['COD IMS'] = pd.to_numeric(df_temp['COD IMS'], errors='coerce')
-                    df_temp['COD IMS'] = df_temp['COD IMS'].fillna(0).astype(int).astype(str)
-                    # df_temp['COD IMS'] = df_temp['COD IMS'].replace('0', pd.NA)  # Restaura NaN onde era 0
-                    
-                
-                # 4. COD FORNECEDOR sempre nulo para arquivos de saturação (será preenchido depois via COD IMS)
-                df_temp['COD FORNECEDOR'] = ""
-                # print(f"INFO: Coluna 'COD FORNECEDOR' definida como nula (será derivada de COD IMS).")
+            # 1. Seleciona apenas as colunas que nos interessam
+            df_temp = df_excel[colunas_originais_necessarias].copy()
+        
+            # print(df_temp.head())
+        
+            # 2. Renomeia as colunas para o padrão final
+            df_temp.rename(columns=colunas_mapeamento, inplace=True)
+        
+       
+            df_temp = df_temp[df_temp['FDS'] == sheet_name]
+            df_temp = df_temp.groupby(['DESENHO', 'COD FORNECEDOR'], as_index=False).agg({
+                    'QTDE': 'sum',
+                    'FDS': 'first'  # Keep the first FDS value (should be same after filter)
+                })
+        
+            # Validation: Check if any rows remain after filtering
+            if df_temp.empty:
+                mensagens.append((f"Arquivo '{nome_arquivo}': Nenhum dado encontrado para data '{sheet_name}'", "AVISO"))
+                return None, mensagens, True
 
-                # 5. Adiciona a coluna COD DESTINO
-                if cod_destino is not None:
-                    df_temp["COD DESTINO"] = cod_destino
-                
-                # 6. Marca como FLECHINHA (saturação file)
-                df_temp['IS_FLECHINHA'] = 1
-                
-                # 7. Adiciona o DataFrame processado à lista para concatenação posterior
-                lista_dfs.append(df_temp)
-                
-            elif nome_arquivo_lower.endswith((".xls", ".xlsx")) and not nome_arquivo_lower.startswith("~$") and "Coletas DHL" in nome_arquivo and "DHL" in nome_arquivo:
-                print(f"Processando arquivo de coletas DHL: '{nome_arquivo}'")
-                
-                # Mapeamento dos nomes de coluna do arquivo Excel para os nomes desejados
-                colunas_mapeamento = {
-                    'Desenho': 'DESENHO',
-                    'Codigo': 'COD FORNECEDOR',
-                    'Quantidade': 'QTDE',
-                    'Data da coleta': 'FDS'  # Usamos a data da coleta como COD DESTINO para filtrar depois, se necessário
-                }
-                
-                # Lê o arquivo Excel
-                df_excel = pd.read_excel(caminho_completo_arquivo)
-                
-                
+            # 3. Marca como NÃO FLECHINHA (Excel normal, não saturação)
+            #    O filtro por COD DESTINO é feito em _aplicar_destino_demanda
+            df_temp['IS_FLECHINHA'] = 0
 
-                # Pega a lista de colunas que precisamos do arquivo original
-                colunas_originais_necessarias = list(colunas_mapeamento.keys())
+            # 4. Adiciona o DataFrame processado à lista para concatenação posterior
+            return df_temp, mensagens, True
 
-                # Verifica se todas as colunas necessárias existem no arquivo
-                if not all(coluna in df_excel.columns for coluna in colunas_originais_necessarias):
-                    faltando = [c for c in colunas_originais_necessarias if c not in df_excel.columns]
-                    adicionar_erro(f"Arquivo '{nome_arquivo}': Colunas faltando: {', '.join(faltando)}", "AVISO")
-                    continue
+    except Exception as e:
+        mensagens.append((f"Erro ao processar arquivo '{nome_arquivo}': {str(e)}", "ERRO"))
+        return None, mensagens, False
 
-                # 1. Seleciona apenas as colunas que nos interessam
-                df_temp = df_excel[colunas_originais_necessarias].copy()
-                
-                # print(df_temp.head())
-                
-                # 2. Renomeia as colunas para o padrão final
-                df_temp.rename(columns=colunas_mapeamento, inplace=True)
-                
-               
-                df_temp = df_temp[df_temp['FDS'] == sheet_name]
-                df_temp = df_temp.groupby(['DESENHO', 'COD FORNECEDOR'], as_index=False).agg({
-                        'QTDE': 'sum',
-                        'FDS': 'first'  # Keep the first FDS value (should be same after filter)
-                    })
-                
-                # Validation: Check if any rows remain after filtering
-                if df_temp.empty:
-                    adicionar_erro(f"Arquivo '{nome_arquivo}': Nenhum dado encontrado para data '{sheet_name}'", "AVISO")
-                    continue
+    return None, mensagens, True
 
-                # 3. Filtra por COD DESTINO se fornecido
-                if cod_destino is not None:
-                    df_temp = df_temp[df_temp['COD DESTINO'].astype(str) == str(cod_destino)]
 
-                # 4. Marca como NÃO FLECHINHA (Excel normal, não saturação)
-                df_temp['IS_FLECHINHA'] = 0
-                
-                # 5. Adiciona o DataFrame processado à lista para concatenação posterior
-                lista_dfs.append(df_temp)
-                
-                
+def _tipo_arquivo_demanda(nome_arquivo):
+    """Classifica um arquivo da pasta de demandas com as mesmas regras de _ler_arquivo_demanda.
+
+    Returns:
+        str: "txt", "excel", "saturacao", "dhl" ou None para arquivos ignorados
+    """
+    nome_arquivo_lower = nome_arquivo.lower()
+    if nome_arquivo_lower.endswith((".txt", ".csv")):
+        return "txt"
+    if not nome_arquivo_lower.endswith((".xls", ".xlsx")) or nome_arquivo_lower.startswith("~$"):
+        return None
+    if 'Coletas' not in nome_arquivo and 'DHL' not in nome_arquivo:
+        if "saturação" in nome_arquivo_lower or "saturacao" in nome_arquivo_lower:
+            return "saturacao"
+        return "excel"
+    if "Coletas DHL" in nome_arquivo:
+        return "dhl"
+    return None
+
+
+def _aplicar_destino_demanda(df_temp, tipo_arquivo, cod_destino):
+    """Marca (TXT/saturação) ou filtra (Excel/Coletas DHL) as linhas de um arquivo pelo destino.
+
+    Com uma lista de destinos, as linhas de Excel/Coletas DHL de qualquer um deles são mantidas com o
+    próprio COD DESTINO e as de TXT/saturação ficam sem destino (valem para todos).
+    Não altera o DataFrame recebido, que pode ter vindo do cache de demandas.
+    """
+    if cod_destino is None:
+        return df_temp
+
+    if isinstance(cod_destino, (list, tuple, set)):
+        if tipo_arquivo in ("txt", "saturacao"):
+            return df_temp
+        return df_temp[df_temp['COD DESTINO'].astype(str).isin([str(c) for c in cod_destino])]
+
+    if tipo_arquivo in ("txt", "saturacao"):
+        df_temp = df_temp.copy()
+        # Mantém a ordem de colunas original (COD DESTINO antes de IS_FLECHINHA)
+        df_temp.insert(df_temp.columns.get_loc('IS_FLECHINHA'), "COD DESTINO", cod_destino)
+        return df_temp
+
+    # Excel e Coletas DHL: mantém só as linhas do destino (Coletas DHL não tem a coluna -> KeyError)
+    return df_temp[df_temp['COD DESTINO'].astype(str) == str(cod_destino)]
+
+
+# ------------------- CACHE DE DEMANDAS -------------------
+# Cada arquivo lido por _ler_arquivo_demanda é guardado em .viajante_cache/demandas/ (um pickle por
+# arquivo) com um índice JSON que guarda a "impressão digital" do arquivo de origem. Na próxima
+# execução só os arquivos novos ou alterados são lidos de novo.
+
+_VERSAO_CACHE_DEMANDAS = 1  # incrementar quando o layout devolvido por _ler_arquivo_demanda mudar
+_NOME_INDICE_CACHE = "indice.json"
+
+
+def _pasta_cache(subpasta):
+    return os.path.join(caminho_base, ".viajante_cache", subpasta)
+
+
+def _hash_arquivo(caminho_arquivo):
+    h = hashlib.blake2b(digest_size=16)
+    with open(caminho_arquivo, "rb") as arquivo:
+        for bloco in iter(lambda: arquivo.read(1 << 20), b""):
+            h.update(bloco)
+    return h.hexdigest()
+
+
+def _chave_cache_demanda(caminho_arquivo, tipo_arquivo, sheet_name):
+    # sheet_name só influencia a leitura de saturação e Coletas DHL
+    sheet = repr(sheet_name) if tipo_arquivo in ("saturacao", "dhl") else ""
+    return f"{os.path.normcase(os.path.abspath(caminho_arquivo))}|{sheet}"
+
+
+def _carregar_indice_cache(pasta_cache):
+    try:
+        with open(os.path.join(pasta_cache, _NOME_INDICE_CACHE), "r", encoding="utf-8") as f:
+            indice = json.load(f)
+        if indice.get("versao") == _VERSAO_CACHE_DEMANDAS:
+            return indice["entradas"]
+    except (OSError, ValueError, KeyError, AttributeError):
+        pass
+    return {}
+
+
+def _salvar_indice_cache(pasta_cache, entradas):
+    caminho_indice = os.path.join(pasta_cache, _NOME_INDICE_CACHE)
+    temporario = caminho_indice + ".tmp"
+    with open(temporario, "w", encoding="utf-8") as f:
+        json.dump({"versao": _VERSAO_CACHE_DEMANDAS, "entradas": entradas}, f, ensure_ascii=False)
+    os.replace(temporario, caminho_indice)
+
+
+def _ler_cache_demanda(pasta_cache, entradas, chave, impressao, hash_conteudo, caminho_arquivo):
+    """Devolve (df, mensagens) do cache se o arquivo não mudou, ou None se precisa ser lido de novo"""
+    entrada = entradas.get(chave)
+    if entrada is None or entrada["tamanho"] != impressao["tamanho"]:
+        return None
+
+    if hash_conteudo:
+        impressao["hash"] = _hash_arquivo(caminho_arquivo)
+        if entrada.get("hash") != impressao["hash"]:
+            return None
+        # Mesmo conteúdo com outra data (cópia/touch): só atualiza a impressão
+        entrada["mtime_ns"] = impressao["mtime_ns"]
+    elif entrada["mtime_ns"] != impressao["mtime_ns"]:
+        return None
+
+    df_temp = None
+    if entrada["arquivo"] is not None:
+        try:
+            df_temp = pd.read_pickle(os.path.join(pasta_cache, entrada["arquivo"]))
+        except Exception:
+            return None
+    return df_temp, [tuple(m) for m in entrada["mensagens"]]
+
+
+def _gravar_cache_demanda(pasta_cache, entradas, chave, impressao, df_temp, mensagens):
+    nome_pickle = None
+    if df_temp is not None:
+        nome_pickle = hashlib.sha1(chave.encode("utf-8")).hexdigest() + ".pkl"
+        temporario = os.path.join(pasta_cache, nome_pickle + ".tmp")
+        df_temp.to_pickle(temporario)
+        os.replace(temporario, os.path.join(pasta_cache, nome_pickle))
+    entradas[chave] = {
+        "tamanho": impressao["tamanho"],
+        "mtime_ns": impressao["mtime_ns"],
+        "hash": impressao.get("hash"),
+        "arquivo": nome_pickle,
+        "mensagens": [list(m) for m in mensagens],
+    }
+
+
+def _remover_entradas_orfas(pasta_cache, entradas, caminho_pasta, arquivos_presentes):
+    """Remove do cache os arquivos desta pasta que não existem mais"""
+    prefixo = os.path.normcase(os.path.abspath(caminho_pasta)) + os.sep
+    for chave in list(entradas):
+        caminho = chave.rsplit("|", 1)[0]
+        if caminho.startswith(prefixo) and caminho not in arquivos_presentes:
+            entrada = entradas.pop(chave)
+            if entrada["arquivo"] is not None and not any(
+                    e["arquivo"] == entrada["arquivo"] for e in entradas.values()):
+                with contextlib.suppress(OSError):
+                    os.remove(os.path.join(pasta_cache, entrada["arquivo"]))
+
+
+def limpar_cache_demandas():
+    """Apaga o cache de demandas (força a releitura de todos os arquivos na próxima execução)"""
+    import shutil
+    shutil.rmtree(_pasta_cache("demandas"), ignore_errors=True)
+
+
+def Processar_Demandas(cod_destino, pasta_demandas="Demandas", sheet_name=None, paralelo=False, max_processos=None,
+                       usar_cache=True, hash_conteudo=False):
+    """Lê todos os arquivos da pasta de demandas (.txt/.csv GMDNVA8, Excel, saturação e Coletas DHL).
+
+    Args:
+        cod_destino: código de destino para marcar/filtrar as linhas, lista de códigos (uma leitura para
+            vários destinos, ver _aplicar_destino_demanda) ou None para manter todos
+        pasta_demandas: pasta relativa a caminho_base com os arquivos
+        sheet_name: aba dos arquivos de saturação (Flechinha) ou data das Coletas DHL
+        paralelo: se True, lê os arquivos em um pool de processos (um arquivo por tarefa)
+        max_processos: limite de processos do pool (padrão: número de núcleos)
+        usar_cache: reaproveita a leitura de arquivos que não mudaram desde a última execução
+        hash_conteudo: além de tamanho e data, confere o conteúdo do arquivo (mais lento)
+
+    Returns:
+        DataFrame consolidado, ou DataFrame vazio se nada pôde ser lido
+    """
+    
+    
+    # Define o caminho completo para a pasta de demandas
+    caminho_pasta = os.path.join(caminho_base, pasta_demandas)
+
+    # Verifica se a pasta de demandas existe
+    if not os.path.isdir(caminho_pasta):
+        adicionar_erro(f"Pasta de demandas não encontrada: '{caminho_pasta}'", "ERRO")
+        return pd.DataFrame()
+
+    # Lista para armazenar os DataFrames de cada arquivo processado
+    lista_dfs = []
+
+    # Só os arquivos que _ler_arquivo_demanda sabe ler; os demais são ignorados
+    nomes_arquivos = [n for n in os.listdir(caminho_pasta) if _tipo_arquivo_demanda(n) is not None]
+    _remover_planilhas_saturacao_orfas(caminho_pasta, nomes_arquivos)
+    tipos_arquivos = [_tipo_arquivo_demanda(n) for n in nomes_arquivos]
+    resultados = [None] * len(nomes_arquivos)
+
+    # Consulta o cache: arquivos sem alteração não são lidos de novo
+    pasta_cache = _pasta_cache("demandas")
+    entradas_cache = _carregar_indice_cache(pasta_cache) if usar_cache else {}
+    chaves, impressoes = {}, {}
+    for i, (nome_arquivo, tipo_arquivo) in enumerate(zip(nomes_arquivos, tipos_arquivos)):
+        caminho_arquivo = os.path.join(caminho_pasta, nome_arquivo)
+        if not usar_cache or not os.path.isfile(caminho_arquivo):
+            continue
+        stat = os.stat(caminho_arquivo)
+        chaves[i] = _chave_cache_demanda(caminho_arquivo, tipo_arquivo, sheet_name)
+        impressoes[i] = {"tamanho": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+        resultado = _ler_cache_demanda(pasta_cache, entradas_cache, chaves[i], impressoes[i],
+                                       hash_conteudo, caminho_arquivo)
+        if resultado is not None:
+            resultados[i] = resultado + (True,)
+
+    # Lê os arquivos restantes. No modo paralelo cada arquivo vai para um processo do pool;
+    # map() devolve os resultados na mesma ordem da lista de entrada.
+    pendentes = [i for i, r in enumerate(resultados) if r is None]
+    argumentos = ([caminho_pasta] * len(pendentes), [nomes_arquivos[i] for i in pendentes],
+                  [sheet_name] * len(pendentes))
+
+    if paralelo and len(pendentes) > 1:
+        with ProcessPoolExecutor(max_workers=max_processos) as executor:
+            lidos = list(executor.map(_ler_arquivo_demanda, *argumentos))
+    else:
+        lidos = list(map(_ler_arquivo_demanda, *argumentos))
+
+    for i, resultado in zip(pendentes, lidos):
+        resultados[i] = resultado
+
+    # Atualiza o cache (falhas de gravação apenas desativam o cache nesta execução)
+    if usar_cache:
+        try:
+            os.makedirs(pasta_cache, exist_ok=True)
+            for i in pendentes:
+                df_temp, mensagens, cacheavel = resultados[i]
+                if cacheavel and i in chaves:
+                    if hash_conteudo and "hash" not in impressoes[i]:
+                        impressoes[i]["hash"] = _hash_arquivo(os.path.join(caminho_pasta, nomes_arquivos[i]))
+                    _gravar_cache_demanda(pasta_cache, entradas_cache, chaves[i], impressoes[i], df_temp, mensagens)
+            presentes = {c.rsplit("|", 1)[0] for c in chaves.values()}
+            _remover_entradas_orfas(pasta_cache, entradas_cache, caminho_pasta, presentes)
+            _salvar_indice_cache(pasta_cache, entradas_cache)
         except Exception as e:
-            adicionar_erro(f"Erro ao processar arquivo '{nome_arquivo}': {str(e)}", "ERRO")
+            print(f"[WARN] Não foi possível atualizar o cache de demandas: {e}")
+
+    for nome_arquivo, tipo_arquivo, (df_temp, mensagens, _) in zip(nomes_arquivos, tipos_arquivos, resultados):
+        for mensagem, tipo in mensagens:
+            adicionar_erro(mensagem, tipo)
+        if df_temp is None:
             continue
+        try:
+            lista_dfs.append(_aplicar_destino_demanda(df_temp, tipo_arquivo, cod_destino))
+        except Exception as e:
+            adicionar_erro(f"Erro ao processar arquivo '{nome_arquivo}': {str(e)}", "ERRO")
 
     # --- LÓGICA FINAL PARA CONSOLIDAR OS DADOS ---
     # Se a lista de DataFrames estiver vazia, retorna um DataFrame vazio
@@ -436,53 +881,1111 @@ def Processar_Demandas(cod_destino, pasta_demandas="Demandas", sheet_name=None):
         if col in df_final.columns:
             df_final[col] = pd.to_numeric(df_final[col], errors='coerce')
 
-    # Remove linhas onde a conversão numérica falhou (resultando em NaT/NaN)
-    # Mas mantém se apenas COD FORNECEDOR estiver nulo (pode vir de COD IMS depois)
-    df_final.dropna(subset=["DESENHO", "QTDE"], inplace=True)
+    # Remove linhas onde a conversão numérica falhou (resultando em NaT/NaN)
+    # Mas mantém se apenas COD FORNECEDOR estiver nulo (pode vir de COD IMS depois)
+    df_final.dropna(subset=["DESENHO", "QTDE"], inplace=True)
+
+    # Remove linhas onde QTDE é zero ou negativo
+    df_final = df_final[df_final['QTDE'] > 0]
+
+    # Converte DESENHO e QTDE para inteiro após remover os nulos
+    for col in colunas_numericas:
+        if col in df_final.columns:
+            df_final[col] = pd.to_numeric(df_final[col], errors='coerce')
+            # Só converte para int se não tiver NaN
+            if df_final[col].notna().all():
+                df_final[col] = df_final[col].astype(int)
+
+    # Clean up COD FORNECEDOR: always store as string to prevent float upcast.
+    # Numeric values drop the .0 suffix; compound codes kept; empty -> None (not '0',
+    # because '0' would cause false substring matches in main.py matching logic).
+    if 'COD FORNECEDOR' in df_final.columns:
+        def _clean_forn(val):
+            s = str(val).strip()
+            if s in ('nan', '', 'None'):
+                return None
+            if '/' in s:
+                return s
+            try:
+                return str(int(float(s)))
+            except (ValueError, TypeError):
+                return s
+        df_final['COD FORNECEDOR'] = df_final['COD FORNECEDOR'].apply(_clean_forn)
+    
+    # Clean up COD DESTINO to remove .0 suffix if it exists
+    if 'COD DESTINO' in df_final.columns:
+        df_final['COD DESTINO'] = df_final['COD DESTINO'].astype(str).str.replace(r'\.0$', '', regex=True)
+    
+    # Clean up COD IMS to remove .0 suffix if it exists  
+    if 'COD IMS' in df_final.columns:
+        df_final['COD IMS'] = df_final['COD IMS'].astype(str).str.replace(r'\.0$', '', regex=True)
+    
+    
+    return df_final
+
+# Exemplo de como chamar a função
+# df_processado = Processar_Demandas(cod_destino="BR01")
+# print(df_processado)
+
+
+# ------------------- REFERÊNCIAS EM MEMÓRIA -------------------
+# A GUI fica aberta o dia todo e cada "Atualizar Dados" lia de novo todos os registros do BD e remontava
+# os mesmos mapas. _referencia_em_cache guarda em memória (por processo) qualquer valor derivado de
+# arquivos, validado por tamanho/mtime: o primeiro clique paga a leitura, os seguintes reaproveitam até
+# um arquivo mudar (ex.: check_and_update_files baixou um registro novo).
+
+_cache_referencias = {}
+# Uma trava por chave: o pré-carregamento e as etapas do cálculo rodam em threads e, se pedirem a
+# mesma referência ao mesmo tempo, a segunda espera a primeira em vez de ler tudo de novo
+_travas_referencias = {}
+_trava_travas = threading.Lock()
+
+
+def _impressao_registro(caminho):
+    try:
+        stat = os.stat(caminho)
+    except (OSError, TypeError):
+        return (caminho, None, None)
+    return (caminho, stat.st_size, stat.st_mtime_ns)
+
+
+def _referencia_em_cache(chave, arquivos, construtor):
+    """Devolve construtor(), guardado em memória enquanto os `arquivos` não mudarem"""
+    with _trava_travas:
+        trava = _travas_referencias.setdefault(chave, threading.Lock())
+    with trava:
+        impressao = tuple(_impressao_registro(arquivo) for arquivo in arquivos)
+        entrada = _cache_referencias.get(chave)
+        if entrada is not None and entrada[0] == impressao:
+            return entrada[1]
+        valor = construtor()
+        _cache_referencias[chave] = (impressao, valor)
+        return valor
+
+
+def limpar_cache_referencias():
+    """Descarta as referências em memória (a próxima leitura volta aos arquivos)"""
+    _cache_referencias.clear()
+
+
+# ------------------- REGISTROS DO BD EM FORMATO COLUNAR -------------------
+# Os registros do BD (BD_CADASTRO_PN, BD_CADASTRO_MDR, VEÍCULOS, FLUXO...) eram lidos com pd.read_excel
+# a cada cálculo. ler_registro converte cada aba lida para um pickle do DataFrame já tipado, gravado ao
+# lado do .xlsx ("BD_CADASTRO_PN_2025-01-10.BD.pkl"), e só volta ao Excel quando ele muda. Ao gravar um
+# .pkl, apaga os das outras versões do mesmo registro que não são mais a escolhida por get_latest_file.
+
+_VERSAO_REGISTRO_COLUNAR = 1  # incrementar quando o conteúdo gravado por ler_registro mudar
+
+_VERSAO_DATADA = re.compile(r"^(?P<registro>.+)_\d{4}-\d{2}-\d{2}$")  # BD_CADASTRO_PN_2025-01-10
+
+
+def _caminho_registro_colunar(caminho_xlsx, sheet_name):
+    return f"{os.path.splitext(caminho_xlsx)[0]}.{sheet_name}.pkl"
+
+
+def _limpar_registros_colunares(caminho_xlsx):
+    """Apaga os .pkl de outras versões do registro de `caminho_xlsx` (datadas ou o nome sem data) cujo
+    Excel não existe mais ou não é o atual: a versão datada mais recente, ou o nome sem data se não houver."""
+    pasta, nome = os.path.split(os.path.abspath(caminho_xlsx))
+    raiz = os.path.splitext(nome)[0]
+    versao = _VERSAO_DATADA.match(raiz)
+    registro = versao.group("registro") if versao else raiz
+    padrao_xlsx = re.compile(rf"^{re.escape(registro)}(_\d{{4}}-\d{{2}}-\d{{2}})?\.xlsx$", re.IGNORECASE)
+    padrao_pkl = re.compile(rf"^(?P<raiz>{re.escape(registro)}(_\d{{4}}-\d{{2}}-\d{{2}})?)\..+\.pkl$")
+
+    nomes = os.listdir(pasta)
+    versoes = [n for n in nomes if padrao_xlsx.match(n)]
+    datadas = [n for n in versoes if _VERSAO_DATADA.match(os.path.splitext(n)[0])]
+    if datadas:
+        atual = max(datadas, key=lambda n: os.path.getmtime(os.path.join(pasta, n)))
+    else:
+        atual = versoes[0] if versoes else nome
+    manter = {raiz, os.path.splitext(atual)[0]}
+
+    for nome_pkl in nomes:
+        encontrado = padrao_pkl.match(nome_pkl)
+        if encontrado and encontrado.group("raiz") not in manter:
+            with contextlib.suppress(OSError):
+                os.remove(os.path.join(pasta, nome_pkl))
+
+
+def ler_registro(caminho_xlsx, sheet_name=0, dtype=None, usar_colunar=True, em_memoria=True):
+    """Lê uma aba de um registro do BD pelo arquivo colunar gravado ao lado do Excel.
+
+    O .pkl guarda tamanho/mtime do Excel de origem e o `dtype` pedido; se não bater (Excel novo ou
+    alterado), lê o Excel e regrava o .pkl. Falha ao gravar (pasta somente leitura) não impede a leitura.
+
+    Args:
+        caminho_xlsx: caminho do registro (ex.: o retornado por get_latest_file)
+        sheet_name, dtype: repassados ao pd.read_excel
+        usar_colunar: False lê sempre o Excel (sem ler nem gravar o .pkl)
+        em_memoria: guarda a tabela lida em memória e devolve cópias enquanto o Excel não mudar
+    """
+    if em_memoria:
+        chave = ("registro", os.path.abspath(caminho_xlsx), sheet_name, repr(dtype), usar_colunar)
+        return _referencia_em_cache(chave, [caminho_xlsx], lambda: ler_registro(
+            caminho_xlsx, sheet_name=sheet_name, dtype=dtype, usar_colunar=usar_colunar, em_memoria=False)).copy()
+
+    if not usar_colunar:
+        return pd.read_excel(caminho_xlsx, sheet_name=sheet_name, dtype=dtype)
+
+    stat = os.stat(caminho_xlsx)
+    origem = {"tamanho": stat.st_size, "mtime_ns": stat.st_mtime_ns, "dtype": repr(dtype)}
+    caminho_colunar = _caminho_registro_colunar(caminho_xlsx, sheet_name)
+
+    try:
+        registro = pd.read_pickle(caminho_colunar)
+        if registro.get("versao") == _VERSAO_REGISTRO_COLUNAR and registro.get("origem") == origem:
+            return registro["df"]
+    except Exception:
+        pass  # .pkl ausente, corrompido ou de outra versão do pandas: reconverte
+
+    df = pd.read_excel(caminho_xlsx, sheet_name=sheet_name, dtype=dtype)
+    temporario = caminho_colunar + ".tmp"
+    try:
+        pd.to_pickle({"versao": _VERSAO_REGISTRO_COLUNAR, "origem": origem, "df": df}, temporario)
+        os.replace(temporario, caminho_colunar)
+        _limpar_registros_colunares(caminho_xlsx)
+    except OSError:
+        with contextlib.suppress(OSError):
+            os.remove(temporario)
+    return df
+
+
+def arquivos_registros(caminho_BD="BD"):
+    """Registros atuais do BD: nome -> caminho do .xlsx.
+
+    BD_CADASTRO_PN e BD_CADASTRO_MDR são escolhidos por get_latest_file (versão datada mais recente,
+    None se não houver nenhuma); os demais têm nome fixo e podem não existir.
+    """
+    pasta = os.path.join(caminho_base, caminho_BD)
+    arquivos = {
+        "PN": get_latest_file(os.path.join(pasta, "BD_CADASTRO_PN_*.xlsx"),
+                              fallback=os.path.join(pasta, "BD_CADASTRO_PN.xlsx")),
+        "MDR": get_latest_file(os.path.join(pasta, "BD_CADASTRO_MDR_*.xlsx"),
+                               fallback=os.path.join(pasta, "BD_CADASTRO_MDR.xlsx")),
+    }
+    for nome, arquivo in (("VEICULOS", "VEÍCULOS.xlsx"), ("EMPILHAMENTO", "BD_EMPILHAMENTO_EMBALAGENS.xlsx"),
+                          ("PERDA_COMPRIMENTO", "BD_CADASTRO_MDR_PERDA_COMPRIMENTO.xlsx"),
+                          ("PN_CT", "PN_Conta_trabalho.xlsx"), ("FLUXO", "FLUXO.xlsx")):
+        arquivos[nome] = os.path.join(pasta, arquivo)
+    return arquivos
+
+
+# Abas lidas de cada registro (e dtype), exatamente como completar_informacoes/consolidar_dados leem
+_ABAS_REGISTROS = {
+    "PN": [("BD", {'DESENHO': str})],
+    "MDR": [("BD", None)],
+    "VEICULOS": [("VEÍCULOS", None), (0, None)],
+    "EMPILHAMENTO": [("BD", None)],
+    "PERDA_COMPRIMENTO": [("BD", None)],
+    "PN_CT": [(0, None)],
+    "FLUXO": [("FLUXOS", None)],
+}
+
+
+def converter_registros(caminho_BD="BD"):
+    """Gera/atualiza os arquivos colunares de todos os registros do BD (ex.: logo após um download).
+
+    Returns:
+        lista de (nome, aba, erro ou None)
+    """
+    resultado = []
+    for nome, caminho in arquivos_registros(caminho_BD).items():
+        if caminho is None or not os.path.exists(caminho):
+            continue
+        for sheet_name, dtype in _ABAS_REGISTROS[nome]:
+            try:
+                ler_registro(caminho, sheet_name=sheet_name, dtype=dtype, em_memoria=False)
+                resultado.append((nome, sheet_name, None))
+            except Exception as e:
+                resultado.append((nome, sheet_name, str(e)))
+    return resultado
+
+
+# ------------------- ÍNDICE DE FLUXOS (casamento demanda x FLUXO) -------------------
+# input_demanda comparava cada linha de demanda com cada linha de FLUXO. O índice abaixo pré-processa
+# a tabela FLUXOS uma vez (textos já normalizados e dicionários por código) e guarda o resultado de
+# cada combinação (fornecedor, IMS, tipo de demanda), que se repete muito entre as linhas de demanda.
+
+def _coluna_fluxo(db_fluxos, coluna, padrao=None):
+    """Valores de uma coluna de FLUXOS como lista (padrao para todas as linhas se a coluna não existir)"""
+    if coluna in db_fluxos.columns:
+        return db_fluxos[coluna].tolist()
+    return [padrao] * len(db_fluxos)
+
+
+def _agrupar_posicoes(textos):
+    """{texto: [posições em ordem]} para os textos não vazios"""
+    posicoes = {}
+    for posicao, texto in enumerate(textos):
+        if texto:
+            posicoes.setdefault(texto, []).append(posicao)
+    return posicoes
+
+
+def _indice_fluxos(db_fluxos):
+    """Pré-processa a tabela FLUXOS para o casamento feito em input_demanda.
+
+    Os textos seguem exatamente a comparação linha a linha original: str(...).strip() de COD FORNECEDOR
+    e COD DESTINO, e COD IMS como texto (None se nulo ou se a coluna não existir).
+    """
+    fornecedores = [str(v).strip() for v in _coluna_fluxo(db_fluxos, "COD FORNECEDOR")]
+    destinos = [str(v).strip() for v in _coluna_fluxo(db_fluxos, "COD DESTINO")]
+    ims = [str(v).strip() if pd.notna(v) else None for v in _coluna_fluxo(db_fluxos, "COD IMS")]
+    por_fornecedor = _agrupar_posicoes(fornecedores)
+    por_ims = _agrupar_posicoes(ims)
+
+    return {
+        "fornecedor": fornecedores,
+        "destino": destinos,
+        "ims": ims,
+        "por_fornecedor": por_fornecedor,
+        "por_ims": por_ims,
+        "contem_fornecedor": _indice_substrings(por_fornecedor),
+        "contem_ims": _indice_substrings(por_ims),
+        # Fluxos com COD IMS para o destino 1046 são reservados às demandas de Flechinha
+        "reservados_1046": {
+            posicao for posicao, (texto_ims, destino) in enumerate(zip(ims, destinos))
+            if texto_ims and texto_ims != '0' and destino == '1046'
+        },
+        "casamentos": {},
+    }
+
+
+# Textos maiores que isso ficam fora do índice de trechos (seriam O(n²) trechos) e são varridos
+_TAMANHO_MAXIMO_TRECHOS = 64
+
+
+def _indice_substrings(posicoes_por_texto):
+    """Índice de trechos para a comparação "contém" (`trecho in texto`).
+
+    Cada texto (código de fornecedor ou IMS, normalmente curto, ex. "24149/36190") é registrado sob
+    todos os seus trechos, então a consulta é uma busca em dicionário em vez de percorrer os fluxos.
+
+    Returns:
+        tuple: ({trecho: [posições em ordem]}, {texto longo: posições} para varredura)
+    """
+    por_trecho = {}
+    longos = {}
+    for texto, posicoes in posicoes_por_texto.items():
+        if len(texto) > _TAMANHO_MAXIMO_TRECHOS:
+            longos[texto] = posicoes
+            continue
+        trechos = {texto[i:j] for i in range(len(texto)) for j in range(i + 1, len(texto) + 1)}
+        for trecho in trechos:
+            por_trecho.setdefault(trecho, []).extend(posicoes)
+    for posicoes in por_trecho.values():
+        posicoes.sort()
+    return por_trecho, longos
+
+
+def _posicoes_contendo(indice_substrings, trecho):
+    """Posições de todos os textos que contêm `trecho` (comparação `trecho in texto`)"""
+    por_trecho, longos = indice_substrings
+    posicoes = por_trecho.get(trecho, [])
+    if longos:
+        posicoes = posicoes + [p for texto, ps in longos.items() if trecho in texto for p in ps]
+    return posicoes
+
+
+def _fluxos_casados(indice, cod_forn, cod_ims, regular, fornecedor_exato=False, ims_contem=False):
+    """Posições (na ordem de FLUXOS) das linhas que casam com uma linha de demanda.
+
+    Args:
+        cod_forn: COD FORNECEDOR da demanda (texto) ou None
+        cod_ims: COD IMS da demanda (texto) ou None
+        regular: True para demanda não Flechinha (ignora os fluxos reservados ao 1046)
+        fornecedor_exato: compara COD FORNECEDOR por igualdade em vez de "contém"
+        ims_contem: compara COD IMS por "contém" em vez de igualdade
+    """
+    chave = (cod_forn, cod_ims, regular, fornecedor_exato, ims_contem)
+    casamentos = indice["casamentos"]
+    if chave in casamentos:
+        return casamentos[chave]
+
+    posicoes = set()
+    if cod_forn:
+        if fornecedor_exato:
+            posicoes.update(indice["por_fornecedor"].get(cod_forn, ()))
+        else:
+            posicoes.update(_posicoes_contendo(indice["contem_fornecedor"], cod_forn))
+    if cod_ims:
+        if ims_contem:
+            posicoes.update(_posicoes_contendo(indice["contem_ims"], cod_ims))
+        else:
+            posicoes.update(indice["por_ims"].get(cod_ims, ()))
+    if regular:
+        posicoes -= indice["reservados_1046"]
+
+    casamentos[chave] = sorted(posicoes)
+    return casamentos[chave]
+
+
+def _campos_demanda(df):
+    """Colunas de demanda usadas no casamento, normalizadas como no laço original de input_demanda.
+
+    Returns:
+        tuple de listas: (COD FORNECEDOR, COD IMS, IS_FLECHINHA, DESENHO, QTDE)
+    """
+    def texto_ou_none(valores):
+        return [str(v).strip() if pd.notna(v) else None for v in valores]
+
+    n = len(df)
+    cods_forn = texto_ou_none(df["COD FORNECEDOR"]) if "COD FORNECEDOR" in df.columns else [None] * n
+    cods_ims = texto_ou_none(df["COD IMS"]) if "COD IMS" in df.columns else [None] * n
+    flechinhas = [int(v) for v in df["IS_FLECHINHA"]] if "IS_FLECHINHA" in df.columns else [0] * n
+    return cods_forn, cods_ims, flechinhas, df["DESENHO"].tolist(), df["QTDE"].tolist()
+
+
+def particionar_por_destino(df, cod_destinos, compartilhar_sem_destino=True):
+    """
+    Splits df by COD DESTINO in a single grouped pass: returns {cod_destino: rows of that destination}.
+    Keys are compared as str(value).strip(), the same way the FLUXO matching does.
+    compartilhar_sem_destino: rows without a destination (TXT/saturação demand) go to every destination.
+    Row order inside each partition follows df.
+    """
+    if df.empty or "COD DESTINO" not in df.columns:
+        base = df if compartilhar_sem_destino else df.iloc[0:0]
+        return {cod: base for cod in cod_destinos}
+
+    chave = df["COD DESTINO"].map(lambda v: str(v).strip())
+    posicoes = chave.groupby(chave, sort=False).indices
+    vazio = np.array([], dtype=np.intp)
+    if compartilhar_sem_destino:
+        sem_destino = np.flatnonzero(chave.isin(['', 'nan', 'None', '<NA>']).to_numpy())
+    else:
+        sem_destino = vazio
+
+    return {
+        cod: df.iloc[np.union1d(posicoes.get(cod, vazio), sem_destino)]
+        for cod in cod_destinos
+    }
+
+
+def carregar_fluxos(caminho_BD="BD"):
+    """FLUXO.xlsx (aba FLUXOS) e o índice de casamento demanda x FLUXO.
+
+    O índice é montado uma vez por versão do arquivo e fica em memória entre os cálculos.
+
+    Returns:
+        dict com a tabela FLUXOS em "tabela" e o índice de _indice_fluxos em "indice"
+    """
+    caminho = os.path.join(caminho_base, caminho_BD, "FLUXO.xlsx")
+    db_fluxos = ler_registro(caminho, sheet_name='FLUXOS')
+    indice = _referencia_em_cache(("indice_fluxos", caminho), [caminho], lambda: _indice_fluxos(db_fluxos))
+    return {"tabela": db_fluxos, "indice": indice}
+
+
+def casar_demanda_fluxos(df, fluxos, use_all_codes, cod_destinos, codigo_veiculo=None, pn_ct_lookup=None):
+    """Casa as linhas de demanda com os fluxos de FLUXO.xlsx: uma linha de saída por (demanda, fluxo).
+
+    Args:
+        df: demanda de Processar_Demandas
+        fluxos: resultado de carregar_fluxos
+        use_all_codes: True gera uma linha para cada fluxo casado (e uma sem fluxo quando nenhum casa);
+            False usa só o primeiro fluxo casado de cada destino de cod_destinos
+        cod_destinos: destinos (texto) pedidos quando use_all_codes é False
+        codigo_veiculo: converte o VEICULO PRINCIPAL do fluxo no código do veículo (None mantém o texto)
+        pn_ct_lookup: pares (COD IMS, DESENHO) de PN_Conta_trabalho; com pares, só ficam os PNs do seu MOT
+
+    Returns:
+        DataFrame com COD FORNECEDOR, COD IMS, COD FLUXO, COD DESTINO, DESENHO, QTDE, VEICULO,
+        TIPO SATURACAO, MOT e FLECHINHA, na ordem da demanda
+    """
+    db_fluxos, indice_fluxos = fluxos["tabela"], fluxos["indice"]
+    fluxo_fornecedores = indice_fluxos["fornecedor"]
+    fluxo_destinos = indice_fluxos["destino"]
+    fluxo_veiculos = [codigo_veiculo(v) if codigo_veiculo else v for v in db_fluxos["VEICULO PRINCIPAL"]]
+    fluxo_tipos = _coluna_fluxo(db_fluxos, "TIPO SATURACAO")
+    fluxo_mots = _coluna_fluxo(db_fluxos, "MOT")
+    fluxo_cods_ims = _coluna_fluxo(db_fluxos, "COD IMS")
+    fluxo_ids = _coluna_fluxo(db_fluxos, "COD FLUXO")
+
+    def linha(cod_forn, cod_ims, desenho, qtde, is_flechinha, j=None):
+        return {
+            "COD FORNECEDOR": cod_forn,
+            "COD IMS": cod_ims,
+            "COD FLUXO": fluxo_ids[j] if j is not None else None,
+            "COD DESTINO": fluxo_destinos[j] if j is not None else None,
+            "DESENHO": desenho,
+            "QTDE": qtde,
+            "VEICULO": fluxo_veiculos[j] if j is not None else None,
+            "TIPO SATURACAO": fluxo_tipos[j] if j is not None else None,
+            "MOT": fluxo_mots[j] if j is not None else None,
+            "FLECHINHA": is_flechinha,
+        }
+
+    all_rows = []
+    if use_all_codes:
+        demanda = zip(*_campos_demanda(df)) if not df.empty else []
+        for cod_forn, cod_ims_from_file, is_flechinha, desenho, qtde in demanda:
+            # Every fluxo whose COD FORNECEDOR contains cod_forn or whose COD IMS contains the file's IMS.
+            # For REGULAR demands (FLECHINHA=0) fluxos with COD IMS and destination 1046 are
+            # left out (reserved for flechinha to 1046).
+            fluxos_casados = _fluxos_casados(indice_fluxos, cod_forn, cod_ims_from_file,
+                                             regular=is_flechinha == 0, ims_contem=True)
+
+            # For each fluxo row that matches, append a separate output row
+            for j in fluxos_casados:
+                # Se foi match por IMS e arquivo não trazia fornecedor, usa o fornecedor do fluxo
+                all_rows.append(linha(fluxo_fornecedores[j] if not cod_forn else cod_forn,
+                                      fluxo_cods_ims[j] or cod_ims_from_file, desenho, qtde, is_flechinha, j))
+
+            # If no fluxo match was found for this demand row, still append a row indicating missing fornecedor
+            if not fluxos_casados:
+                all_rows.append(linha(cod_forn, cod_ims_from_file, desenho, qtde, is_flechinha))
+    else:
+        # Each destination only sees its own demand rows
+        demanda_por_destino = particionar_por_destino(df, cod_destinos)
+
+        for cod_dest in cod_destinos:
+            df_dest = demanda_por_destino[cod_dest]
+            demanda = zip(*_campos_demanda(df_dest)) if not df_dest.empty else []
+
+            for cod_forn, cod_ims_from_file, is_flechinha, desenho, qtde in demanda:
+                # Check if this is Flechinho data (COD FORNECEDOR = COD IMS)
+                is_flechinho = bool(cod_forn and cod_ims_from_file and cod_forn == cod_ims_from_file)
+
+                # Match logic: EXACT for Flechinho (avoids matching "1094/1097" when we want "1097"),
+                # CONTAINS for others; COD IMS is always an exact match.
+                # REGULAR demands (FLECHINHA=0) skip fluxos with COD IMS and destination 1046.
+                fluxos_casados = _fluxos_casados(indice_fluxos, cod_forn, cod_ims_from_file,
+                                                 regular=is_flechinha == 0, fornecedor_exato=is_flechinho)
+
+                # First matching fluxo (FLUXO order) with exactly this COD DESTINO
+                j = next((p for p in fluxos_casados if fluxo_destinos[p] == cod_dest), None)
+                if j is None:
+                    continue
+
+                # Se foi match por IMS, pega o COD FORNECEDOR do fluxo
+                all_rows.append(linha(fluxo_fornecedores[j] if not cod_forn else cod_forn,
+                                      fluxo_cods_ims[j] or cod_ims_from_file, desenho, qtde, is_flechinha, j))
+
+    # Only keep PNs that belong to their MOT: MOT=CT needs (COD IMS, DESENHO) in PN_Conta_trabalho,
+    # MOT=FTL/LTL must not be there; rows without COD IMS or with another MOT are kept.
+    # The COD IMS checked is the one written to the row (fluxo COD IMS, else the file's).
+    if pn_ct_lookup and all_rows:
+        incluir = _avaliar_conta_trabalho([r["COD IMS"] for r in all_rows], [r["DESENHO"] for r in all_rows],
+                                          [r["MOT"] for r in all_rows], pn_ct_lookup)["incluir"]
+        all_rows = [r for r, manter in zip(all_rows, incluir) if manter]
+
+    return pd.DataFrame(all_rows)
+
+
+# ------------------- CONTA TRABALHO (elegibilidade CT/FTL) -------------------
+# Um PN de PN_Conta_trabalho (COD IMS + DESENHO) só entra no cálculo com MOT=CT; com MOT FTL/LTL ele
+# sai. A regra é avaliada para todas as linhas de uma vez: os códigos compostos de IMS ("24149/36190")
+# são separados uma única vez e cruzados com a tabela de pares (código, desenho).
+
+def _codigo_ct(valor):
+    """Código como texto sem o '.0' do Excel (123.0 -> '123'); nulo -> '' e texto não numérico sem espaços"""
+    if not pd.notna(valor):
+        return ''
+    try:
+        return str(int(float(valor)))
+    except (ValueError, TypeError):
+        return str(valor).strip()
+
+
+def _mapear_valores_unicos(valores, funcao, valor_nulo=''):
+    """Aplica `funcao` uma vez por valor distinto (nulos viram `valor_nulo`) e devolve um array"""
+    codigos, unicos = pd.factorize(pd.Series(valores, dtype=object))
+    traduzidos = np.array([funcao(u) for u in unicos] + [valor_nulo], dtype=object)
+    return traduzidos[codigos]  # código -1 (nulo) pega o último elemento
+
+
+def _pares_conta_trabalho(db_pn_ct):
+    """Pares (FORNECEDOR/COD IMS, DESENHO) de PN_Conta_trabalho, ou None se faltarem as colunas"""
+    # Normalize column names to find Fornecedor, Desenho, Destino
+    col_map = {}
+    for col in db_pn_ct.columns:
+        col_upper = str(col).upper().strip()
+        if 'FORNECEDOR' in col_upper:
+            col_map['FORNECEDOR'] = col
+        elif 'DESENHO' in col_upper:
+            col_map['DESENHO'] = col
+        elif 'DESTINO' in col_upper:
+            col_map['DESTINO'] = col
+
+    # Need FORNECEDOR and DESENHO columns for CT matching
+    if not all(k in col_map for k in ['FORNECEDOR', 'DESENHO']):
+        return None
+
+    fornecedores = _mapear_valores_unicos(db_pn_ct[col_map['FORNECEDOR']], _codigo_ct)
+    desenhos = _mapear_valores_unicos(db_pn_ct[col_map['DESENHO']], _codigo_ct)
+    return {(forn, desenho) for forn, desenho in zip(fornecedores, desenhos) if forn and desenho}
+
+
+def _avaliar_conta_trabalho(cod_ims, desenhos, mots, pn_ct_lookup):
+    """Aplica a regra de PN_Conta_trabalho a todas as linhas.
+
+    - MOT=CT: inclui só se (COD IMS, DESENHO) estiver em pn_ct_lookup
+    - MOT=FTL/LTL: exclui se (COD IMS, DESENHO) estiver em pn_ct_lookup
+    - sem COD IMS ou outro MOT: inclui (sem filtro)
+    COD IMS composto ("24149/36190") conta como encontrado se qualquer parte estiver na tabela.
+
+    Returns:
+        dict de arrays booleanos: 'incluir', 'ct' e 'ftl' (MOT da linha), 'sem_ims' e 'no_ct'
+    """
+    mot = _mapear_valores_unicos(mots, lambda m: str(m).strip().upper())
+    ct = mot == 'CT'
+    ftl = (mot == 'FTL') | (mot == 'LTL')
+
+    ims_txt = _mapear_valores_unicos(cod_ims, _codigo_ct)
+    sem_ims = ims_txt == ''
+
+    no_ct = np.zeros(len(mot), dtype=bool)
+    linhas = np.flatnonzero((ct | ftl) & ~sem_ims)
+    if pn_ct_lookup and len(linhas):
+        desenho_txt = _mapear_valores_unicos(pd.Series(desenhos, dtype=object).iloc[linhas], _codigo_ct)
+        partes = (pd.Series(ims_txt[linhas], index=np.arange(len(linhas)))
+                  .str.split('/').explode().str.strip())
+        chaves = pd.MultiIndex.from_arrays([partes.to_numpy(dtype=object),
+                                            desenho_txt[partes.index.to_numpy()]])
+        encontrados = chaves.isin(pd.MultiIndex.from_tuples(list(pn_ct_lookup)))
+        no_ct[linhas[partes.index.to_numpy()[encontrados]]] = True
+
+    excluir = ~sem_ims & ((ct & ~no_ct) | (ftl & no_ct))
+    return {"incluir": ~excluir, "ct": ct, "ftl": ftl, "sem_ims": sem_ims, "no_ct": no_ct}
+
+
+def pares_conta_trabalho_arquivo(caminho_pn_ct):
+    """_pares_conta_trabalho de PN_Conta_trabalho.xlsx, guardado em memória enquanto o arquivo não mudar"""
+    return _referencia_em_cache(("pn_ct", caminho_pn_ct), [caminho_pn_ct], lambda: _pares_conta_trabalho(
+        ler_registro(caminho_pn_ct, em_memoria=False)))
+
+
+# ------------------- RESOLVERS DO TEMPLATE (QME, VOLUME, PESO, DESCRIÇÕES) -------------------
+
+def _explodir_codigos(valores):
+    """Quebra cada valor em códigos ("24149/36190" -> 24149, 36190), uma vez por valor distinto.
+
+    Returns:
+        (tem_codigos, longa): array booleano por linha e DataFrame (linha, ordem, codigo) com o
+        _codigo_principal de cada código, na ordem em que aparece no campo
+    """
+    ids, unicos = pd.factorize(pd.Series(valores, dtype=object))
+    listas = [_normalizar_codigos_campo(valor) for valor in unicos]
+    tem_codigos = np.array([bool(lista) for lista in listas] + [False])[ids]  # id -1 (nulo) pega o último
+
+    id_valor, ordem, codigo = [], [], []
+    for i, lista in enumerate(listas):
+        for posicao, texto in enumerate(lista):
+            id_valor.append(i)
+            ordem.append(posicao)
+            codigo.append(_codigo_principal(texto))
+    por_valor = pd.DataFrame({
+        'id': np.array(id_valor, dtype=np.int64),
+        'ordem': np.array(ordem, dtype=np.int64),
+        'codigo': pd.Series(codigo, dtype=object),
+    })
+
+    linhas = pd.DataFrame({'linha': np.arange(len(ids), dtype=np.int64), 'id': ids.astype(np.int64)})
+    return tem_codigos, linhas.merge(por_valor, on='id')[['linha', 'ordem', 'codigo']]
+
+
+def _candidatos_resolucao(cod_ims, cod_fornecedor):
+    """Tabela longa (linha, codigo) com os candidatos de cada linha, na ordem em que são tentados:
+    todos os códigos de COD IMS ou, se o campo estiver vazio, os de COD FORNECEDOR.
+    Códigos que _codigo_principal reduz a '' (ex.: "0") não geram chave e ficam de fora."""
+    tem_ims, longa_ims = _explodir_codigos(cod_ims)
+    _, longa_fornecedor = _explodir_codigos(cod_fornecedor)
+
+    longa = pd.concat([
+        longa_ims[tem_ims[longa_ims['linha'].to_numpy()]],
+        longa_fornecedor[~tem_ims[longa_fornecedor['linha'].to_numpy()]],
+    ], ignore_index=True)
+    longa = longa[longa['codigo'] != ''].sort_values(['linha', 'ordem'], kind='stable')
+    return longa[['linha', 'codigo']].reset_index(drop=True)
+
+
+def _resolver_por_candidatos(indice, candidatos, sufixos, mapa, mapa_fallback, exige_sufixo=False):
+    """Resolve um valor por linha do template com joins, sem laço por linha.
+
+    Procura "codigo|sufixo" em `mapa` para os candidatos de cada linha (ver _candidatos_resolucao)
+    e fica com o primeiro acerto não nulo na ordem dos candidatos; sem acerto, usa
+    `mapa_fallback[sufixo]`. Linhas com sufixo '' não montam chave composta e, se `exige_sufixo`,
+    ficam NaN (sem fallback).
+
+    Returns:
+        (valores, chaves): Series alinhadas a `indice` com o valor e a chave composta usada
+        ('' quando o valor veio do fallback)
+    """
+    sufixos = np.asarray(sufixos, dtype=object)
+    sufixo_valido = sufixos != ''
+
+    resultado = np.full(len(sufixos), np.nan, dtype=object)
+    chaves_usadas = np.full(len(sufixos), '', dtype=object)
+    resolvidas = np.zeros(len(sufixos), dtype=bool)
+
+    linhas = candidatos['linha'].to_numpy()
+    manter = sufixo_valido[linhas]
+    linhas = linhas[manter]
+    if len(linhas) and len(mapa):
+        chaves = candidatos['codigo'].to_numpy(dtype=object)[manter] + '|' + sufixos[linhas]
+        posicoes = mapa.index.get_indexer(chaves)
+        valores = mapa.to_numpy(dtype=object)[posicoes]
+        acerto = (posicoes >= 0) & pd.notna(valores)
+
+        # candidatos já estão ordenados por (linha, ordem): o primeiro acerto de cada linha vence
+        linhas_acerto = linhas[acerto]
+        primeiro = ~pd.Series(linhas_acerto).duplicated().to_numpy()
+        linhas_acerto = linhas_acerto[primeiro]
+        resultado[linhas_acerto] = valores[acerto][primeiro]
+        chaves_usadas[linhas_acerto] = chaves[acerto][primeiro]
+        resolvidas[linhas_acerto] = True
+
+    pendentes = ~resolvidas
+    if exige_sufixo:
+        pendentes &= sufixo_valido
+    if pendentes.any() and len(mapa_fallback):
+        posicoes = mapa_fallback.index.get_indexer(sufixos[pendentes])
+        valores = mapa_fallback.to_numpy(dtype=object)[posicoes]
+        resultado[pendentes] = np.where(posicoes >= 0, valores, np.nan)
+
+    # lista -> Series para o pandas inferir o dtype como o apply(axis=1) fazia
+    return (pd.Series(resultado.tolist(), index=indice),
+            pd.Series(chaves_usadas.tolist(), index=indice))
+
+
+# ------------------- REFERÊNCIAS DO CÁLCULO (registros normalizados + mapas) -------------------
+
+def _tabelas_referencia(registros):
+    """Lê e normaliza os registros do BD usados por completar_informacoes.
+
+    Returns:
+        dict com db_PN, db_MDR, db_veiculos, db_empilhamento, db_efi, pn_ct_lookup e
+        avisos (lista de (mensagem, tipo) para adicionar_erro)
+    """
+    avisos = []
+
+    # ------------------Working in the DB structrue------------------
+    # Registros lidos pelo arquivo colunar ao lado de cada .xlsx (reconvertido quando o Excel muda);
+    # em_memoria=False porque carregar_referencias já guarda o resultado normalizado
+    # Use 'Int64' (nullable integer) instead of 'int' to handle NaN values in the Excel file
+    db_PN = ler_registro(registros["PN"], sheet_name='BD', dtype={'DESENHO': str}, em_memoria=False)
+    db_PN = db_PN.rename(columns={'CÓD. FORNECEDOR': 'COD FORNECEDOR'})
+
+    # Filter for EMPRESA = 1, 10.12 (not separate 10 and 12!)
+    # Note: EMPRESA 10.12 is a single float value in the database
+    if 'EMPRESA' in db_PN.columns:
+        db_PN = db_PN[db_PN['EMPRESA'].isin([1, 1.0, 10.12])]
+    else:
+        print("[WARNING] Column 'EMPRESA' not found in BD_CADASTRO_PN")
+
+    db_MDR = ler_registro(registros["MDR"], sheet_name='BD', em_memoria=False)
+    db_MDR = db_MDR.rename(columns={'DESCRIÇÃO2': 'DESCRIÇÃO'})
+
+    # Filter for EMPRESA = 1, 10.12 (not separate 10 and 12!)
+    if 'EMPRESA' in db_MDR.columns:
+        db_MDR = db_MDR[db_MDR['EMPRESA'].isin([1, 1.0, 10.12])]
+    else:
+        print("[WARNING] Column 'EMPRESA' not found in BD_CADASTRO_MDR")
+
+    db_veiculos = ler_registro(registros["VEICULOS"], sheet_name='VEÍCULOS', em_memoria=False)
+
+    db_empilhamento = ler_registro(registros["EMPILHAMENTO"], sheet_name='BD', em_memoria=False)
+    db_empilhamento = db_empilhamento.rename(columns={'CÓD. FORNECEDOR': 'COD FORNECEDOR'})
+
+    db_efi = ler_registro(registros["PERDA_COMPRIMENTO"], sheet_name='BD', em_memoria=False)
+
+    # --- Load PN_Conta_trabalho for CT validation ---
+    pn_ct_lookup = set()  # Will store (FORNECEDOR, DESENHO) pairs
+    try:
+        if os.path.exists(registros["PN_CT"]):
+            # CT matching uses FORNECEDOR (COD IMS) + DESENHO
+            pares_ct = pares_conta_trabalho_arquivo(registros["PN_CT"])
+            if pares_ct is not None:
+                pn_ct_lookup = pares_ct
+            else:
+                avisos.append(("PN_Conta_trabalho.xlsx: Colunas esperadas não encontradas", "AVISO"))
+    except Exception as e:
+        avisos.append((f"Erro ao carregar PN_Conta_trabalho.xlsx: {str(e)}", "AVISO"))
+
+    # --- Normalização de tipos ---
+    db_PN['DESENHO ATUALIZAÇÃO'] = pd.to_datetime(db_PN['DESENHO ATUALIZAÇÃO'], errors='coerce')
+    db_MDR['VOLUME'] = pd.to_numeric(db_MDR['VOLUME'], errors='coerce')
+    db_MDR['MDR PESO'] = pd.to_numeric(db_MDR['MDR PESO'], errors='coerce')
+    db_PN['PESO (Kg) MATERIAL'] = pd.to_numeric(db_PN['PESO (Kg) MATERIAL'], errors='coerce')
+
+    db_PN = db_PN.sort_values('DESENHO ATUALIZAÇÃO', ascending=False)
+
+    # Criar chave composta DESENHO+MDR em db_PN
+    db_PN['KEY'] = db_PN['DESENHO'].astype(str) + '_' + db_PN['MDR'].astype(str)
+
+    return {
+        "db_PN": db_PN,
+        "db_MDR": db_MDR,
+        "db_veiculos": db_veiculos,
+        "db_empilhamento": db_empilhamento,
+        "db_efi": db_efi,
+        "pn_ct_lookup": pn_ct_lookup,
+        "avisos": avisos,
+    }
+
+
+def _primeiro_por_chave(df, chave, coluna):
+    """Series chave -> coluna com a primeira linha de cada chave (df já vem na ordem de prioridade)"""
+    return df.drop_duplicates(chave, keep='first').set_index(chave)[coluna]
+
+
+def _tabela_por_chave(atributos):
+    """Junta Series chave -> valor numa tabela com uma linha por chave e uma coluna por atributo"""
+    atributos = {nome: serie for nome, serie in atributos.items() if serie is not None}
+    return pd.concat(atributos, axis=1) if atributos else pd.DataFrame()
+
+
+def _indice_referencia(db_PN, db_MDR):
+    """Índice de lookup dos cadastros PN/MDR: uma tabela por tipo de chave, com todos os atributos.
+
+    db_PN já vem ordenado do cadastro mais recente ao mais antigo, então cada atributo fica com o valor
+    válido mais recente da chave (a mesma resolução que os drop_duplicates(keep='first') faziam por mapa).
+
+    Returns:
+        dict tipo de chave -> DataFrame indexado pela chave:
+        - CHAVE_PN ("fornecedor|DESENHO_MDR") e KEY ("DESENHO_MDR"): DESCRIÇÃO MATERIAL, QME, PESO MAT (KEY também MDR)
+        - CHAVE_MDR ("fornecedor|MDR") e MDR_CHAVE ("MDR"): DESCRIÇÃO DA EMBALAGEM, VOLUME, PESO MDR
+        - EMBALAGEM (MDR como está no cadastro): CAIXA PLÁSTICA, CAIXAS POR PALLET
+        - FORNECEDOR (COD FORNECEDOR): FORNECEDOR
+        - DESENHO: MDR
+    """
+    # Mapas baseados na chave composta - already sorted by DESENHO ATUALIZAÇÃO descending
+    # This ensures we always get the most recent non-null values
+    fornecedor_pn = pd.Series(_mapear_valores_unicos(db_PN['COD FORNECEDOR'], _codigo_principal),
+                              index=db_PN.index).astype(str)
+    chave_pn = (fornecedor_pn + '|' + db_PN['KEY'].astype(str)).where(
+        fornecedor_pn.ne('') & db_PN['KEY'].notna(), '')
+
+    # For QME and PESO, filter out invalid values before mapping
+    validos_pn = {
+        'DESCRIÇÃO MATERIAL': ('DESCRIÇÃO', db_PN['DESCRIÇÃO'].notna()),
+        'QME': ('QME', db_PN['QME'].notna() & (db_PN['QME'] > 0)),
+        'PESO MAT': ('PESO (Kg) MATERIAL', db_PN['PESO (Kg) MATERIAL'].notna()),
+    }
+    por_chave_pn, por_key = {}, {}
+    for atributo, (coluna, valido) in validos_pn.items():
+        linhas = pd.DataFrame({'CHAVE': chave_pn[valido], 'KEY': db_PN.loc[valido, 'KEY'],
+                               atributo: db_PN.loc[valido, coluna]})
+        por_chave_pn[atributo] = _primeiro_por_chave(linhas[linhas['CHAVE'] != ''], 'CHAVE', atributo)
+        por_key[atributo] = _primeiro_por_chave(linhas, 'KEY', atributo)
+    por_key['MDR'] = _primeiro_por_chave(db_PN, 'KEY', 'MDR')
+
+    # Mapas vindos do db_MDR - filter out nan values BEFORE creating mappings
+    # Get the correct column name for FORNECEDOR
+    coluna_fornecedor_mdr = 'CÓD. FORNECEDOR' if 'CÓD. FORNECEDOR' in db_MDR.columns else ('COD FORNECEDOR' if 'COD FORNECEDOR' in db_MDR.columns else None)
+    mdr_chave = pd.Series(_mapear_valores_unicos(db_MDR['MDR'], _mdr_chave), index=db_MDR.index).astype(str)
+    chave_mdr = None
+    if coluna_fornecedor_mdr is not None:
+        fornecedor_mdr = pd.Series(_mapear_valores_unicos(db_MDR[coluna_fornecedor_mdr], _codigo_principal),
+                                   index=db_MDR.index).astype(str)
+        chave_mdr = (fornecedor_mdr + '|' + mdr_chave).where(fornecedor_mdr.ne('') & mdr_chave.ne(''), '')
+
+    por_chave_mdr, por_mdr = {}, {}
+    for atributo, coluna in (('DESCRIÇÃO DA EMBALAGEM', 'DESCRIÇÃO'), ('VOLUME', 'VOLUME'), ('PESO MDR', 'MDR PESO')):
+        valido = db_MDR[coluna].notna()
+        linhas = pd.DataFrame({'MDR_CHAVE': mdr_chave[valido], atributo: db_MDR.loc[valido, coluna]})
+        if chave_mdr is not None:
+            linhas['CHAVE'] = chave_mdr[valido]
+            por_chave_mdr[atributo] = _primeiro_por_chave(linhas[linhas['CHAVE'] != ''], 'CHAVE', atributo)
+        por_mdr[atributo] = _primeiro_por_chave(linhas, 'MDR_CHAVE', atributo)
+
+    # Mapas da saturação: caixa plástica e caixas por pallet (moda por MDR)
+    # Create mappings from db_MDR - filter out NaN values before deduplication
+    # to ensure we don't get empty/null values when valid values exist
+    db_MDR_valid_paletizavel = db_MDR[db_MDR['CAIXA PLÁSTICA'].notna()]
+
+    # For CAIXAS POR PALLET, filter out NaN and use the most common value (mode)
+    # This prevents picking the first row if it has NaN when other rows have valid values
+    db_MDR_valid_cxs = db_MDR[db_MDR['CAIXAS POR PALLET'].notna()]
+
+    # Group by MDR and take the mode (most common value) for CAIXAS POR PALLET
+    # If multiple modes exist, take the first one
+    por_embalagem = {
+        'CAIXA PLÁSTICA': _primeiro_por_chave(db_MDR_valid_paletizavel, 'MDR', 'CAIXA PLÁSTICA'),
+        'CAIXAS POR PALLET': db_MDR_valid_cxs.groupby('MDR')['CAIXAS POR PALLET'].agg(
+            lambda x: x.mode()[0] if not x.mode().empty else x.iloc[0]
+        ),
+    }
+
+    # Filter out nan MDR values and use most recent (already sorted by DESENHO ATUALIZAÇÃO)
+    db_PN_valid_mdr = db_PN[db_PN['MDR'].notna()]
+
+    return {
+        'CHAVE_PN': _tabela_por_chave(por_chave_pn),
+        'KEY': _tabela_por_chave(por_key),
+        'CHAVE_MDR': _tabela_por_chave(por_chave_mdr),
+        'MDR_CHAVE': _tabela_por_chave(por_mdr),
+        'EMBALAGEM': _tabela_por_chave(por_embalagem),
+        'FORNECEDOR': _tabela_por_chave({'FORNECEDOR': _primeiro_por_chave(db_PN, 'COD FORNECEDOR', 'FORNECEDOR')}),
+        'DESENHO': _tabela_por_chave({'MDR': _primeiro_por_chave(db_PN_valid_mdr, 'DESENHO', 'MDR')}),
+    }
+
+
+# Índice gravado em .viajante_cache/referencias/: só é remontado quando BD_CADASTRO_PN/MDR mudam
+_VERSAO_INDICE_REFERENCIA = 1  # incrementar quando _indice_referencia ou a normalização dos cadastros mudar
+
+
+def _indice_referencia_persistido(registros, tabelas):
+    """_indice_referencia da versão atual dos cadastros, lido do disco ou montado e gravado"""
+    origem = [_impressao_registro(registros["PN"]), _impressao_registro(registros["MDR"])]
+    caminho_indice = os.path.join(_pasta_cache("referencias"), "indice.pkl")
+
+    try:
+        gravado = pd.read_pickle(caminho_indice)
+        if gravado.get("versao") == _VERSAO_INDICE_REFERENCIA and gravado.get("origem") == origem:
+            return gravado["indice"]
+    except Exception:
+        pass  # índice ausente, corrompido ou de outra versão do pandas: remonta
+
+    indice = _indice_referencia(tabelas["db_PN"], tabelas["db_MDR"])
+    temporario = caminho_indice + ".tmp"
+    try:
+        os.makedirs(os.path.dirname(caminho_indice), exist_ok=True)
+        pd.to_pickle({"versao": _VERSAO_INDICE_REFERENCIA, "origem": origem, "indice": indice}, temporario)
+        os.replace(temporario, caminho_indice)
+    except OSError:
+        with contextlib.suppress(OSError):
+            os.remove(temporario)
+    return indice
+
+
+def _mapas_referencia(indice, db_veiculos):
+    """Mapas de lookup de completar_informacoes, extraídos do índice de _indice_referencia.
+
+    Chaves sem valor para um atributo saem do mapa (o lookup devolve o padrão, como antes).
+
+    Returns:
+        dict nome do mapa -> Series/dict
+    """
+    def mapa(tipo_chave, atributo):
+        tabela = indice[tipo_chave]
+        if atributo not in tabela.columns:
+            return pd.Series(dtype=object)
+        return tabela[atributo].dropna()
+
+    return {
+        "mapa_fornecedores": mapa('FORNECEDOR', 'FORNECEDOR'),
+        "mapa_mdr_desenho": mapa('DESENHO', 'MDR'),
+        "mapa_pn": mapa('CHAVE_PN', 'DESCRIÇÃO MATERIAL'),
+        "mapa_pn_fallback": mapa('KEY', 'DESCRIÇÃO MATERIAL'),
+        "mapa_mdr": mapa('KEY', 'MDR'),
+        "mapa_qme": mapa('CHAVE_PN', 'QME'),
+        "mapa_qme_fallback": mapa('KEY', 'QME'),
+        "mapa_peso_pn": mapa('CHAVE_PN', 'PESO MAT'),
+        "mapa_peso_pn_fallback": mapa('KEY', 'PESO MAT'),
+        "mapa_descricao_mdr": mapa('CHAVE_MDR', 'DESCRIÇÃO DA EMBALAGEM'),
+        "mapa_descricao_mdr_fallback": mapa('MDR_CHAVE', 'DESCRIÇÃO DA EMBALAGEM'),
+        "mapa_volume": mapa('CHAVE_MDR', 'VOLUME'),
+        "mapa_volume_mdr": mapa('MDR_CHAVE', 'VOLUME'),
+        "mapa_peso_mdr": mapa('CHAVE_MDR', 'PESO MDR'),
+        "mapa_peso_mdr_fallback": mapa('MDR_CHAVE', 'PESO MDR'),
+        "mapa_paletizavel": mapa('EMBALAGEM', 'CAIXA PLÁSTICA'),
+        "mapa_cxs_por_pallet": mapa('EMBALAGEM', 'CAIXAS POR PALLET'),
+        "mapa_peso_max": db_veiculos.set_index('COD VEICULO')['PESO MAXIMO'],
+        # Mapeia de código do veículo (ex: 4) -> coluna de capacidade no db_MDR (ex: "14 x 2,4 x 2,78")
+        "mapa_coluna_capacidade": db_veiculos.set_index('COD VEICULO')['VEICULOS'].to_dict(),
+    }
+
+
+def _chave_fornecedor_capacidade(codigo):
+    """Código (COD FORNECEDOR, MDR...) como chave de junção com a mesma igualdade do isin e do ==: texto só
+    casa com texto e número com número (12 == 12.0); nulos não casam"""
+    if isinstance(codigo, str):
+        return 't' + codigo
+    if isinstance(codigo, (int, float, np.integer, np.floating)) and not isinstance(codigo, (bool, np.bool_)):
+        return None if pd.isna(codigo) else 'n' + repr(float(codigo))
+    return None
+
+
+def _tabela_capacidades(db_MDR, mapa_coluna_capacidade):
+    """Capacidade de cada MDR em cada coluna de veículo do db_MDR, calculada uma vez por versão do registro.
+
+    Returns:
+        dict com
+        "fornecedor": MDR, CHAVE FORNECEDOR, COLUNA -> CAPACIDADE pela regra híbrida (MODA se a amplitude
+            máx - mín passar de metade da moda, senão MÁX) sobre as capacidades do fornecedor
+        "mdr": MDR, COLUNA -> CAPACIDADE máxima entre todos os fornecedores
+        Grupos com texto no lugar de número ficam com CAPACIDADE nula (o cálculo linha a linha falhava).
+    """
+    duplicadas = set(db_MDR.columns[db_MDR.columns.duplicated()])
+    colunas = sorted({coluna for coluna in mapa_coluna_capacidade.values()
+                      if isinstance(coluna, str) and coluna and coluna in db_MDR.columns and coluna not in duplicadas})
+    base = pd.DataFrame({
+        'MDR': db_MDR['MDR'].astype(str).str.upper(),
+        'CHAVE FORNECEDOR': db_MDR['CÓD. FORNECEDOR'].map(_chave_fornecedor_capacidade),
+    })
+
+    partes = []
+    for coluna in colunas:
+        valores = db_MDR[coluna]
+        if pd.api.types.is_numeric_dtype(valores):
+            invalido = pd.Series(False, index=valores.index)
+        else:
+            invalido = valores.map(lambda valor: isinstance(valor, str)).astype(bool)
+        parte = base.assign(COLUNA=coluna, VALOR=pd.to_numeric(valores.where(~invalido), errors='coerce'),
+                            INVALIDO=invalido)
+        partes.append(parte[valores.notna()])
+    longa = (pd.concat(partes, ignore_index=True) if partes else
+             pd.DataFrame(columns=['MDR', 'CHAVE FORNECEDOR', 'COLUNA', 'VALOR', 'INVALIDO']))
+    longa['VALOR'] = longa['VALOR'].astype(float)
+    longa['INVALIDO'] = longa['INVALIDO'].astype(bool)
+
+    # Por fornecedor: moda (mais frequente; no empate, a menor), mínimo e máximo
+    chave = ['MDR', 'CHAVE FORNECEDOR', 'COLUNA']
+    do_fornecedor = longa[longa['CHAVE FORNECEDOR'].notna()]
+    fornecedor = do_fornecedor.groupby(chave, as_index=False).agg(
+        MINIMO=('VALOR', 'min'), MAXIMO=('VALOR', 'max'), INVALIDO=('INVALIDO', 'any'))
+    moda = (
+        do_fornecedor.groupby(chave + ['VALOR']).size().rename('CONTAGEM').reset_index()
+        .sort_values(['CONTAGEM', 'VALOR'], ascending=[False, True], kind='mergesort')
+        .drop_duplicates(chave)
+        .rename(columns={'VALOR': 'MODA'})[chave + ['MODA']]
+    )
+    fornecedor = fornecedor.merge(moda, on=chave, how='left')
+    amplitude = fornecedor['MAXIMO'] - fornecedor['MINIMO']
+    fornecedor['CAPACIDADE'] = fornecedor['MAXIMO'].where(~(amplitude > fornecedor['MODA'] * 0.5), fornecedor['MODA'])
+    fornecedor.loc[fornecedor['INVALIDO'], 'CAPACIDADE'] = np.nan
+
+    # Por MDR (todos os fornecedores): máximo
+    mdr = longa.groupby(['MDR', 'COLUNA'], as_index=False).agg(CAPACIDADE=('VALOR', 'max'), INVALIDO=('INVALIDO', 'any'))
+    mdr.loc[mdr['INVALIDO'], 'CAPACIDADE'] = np.nan
+
+    return {
+        "fornecedor": fornecedor[chave + ['CAPACIDADE']],
+        "mdr": mdr[['MDR', 'COLUNA', 'CAPACIDADE']],
+    }
+
 
-    # Remove linhas onde QTDE é zero ou negativo
-    df_final = df_final[df_final['QTDE'] > 0]
+def _capacidade_por_linha(df_saturacao, capacidades, mapa_coluna_capacidade):
+    """CAPACIDADE de cada linha da saturação (EMBALAGEM, COD FORNECEDOR, VEICULO) pela tabela de capacidades:
+    a do fornecedor quando ele tem capacidade cadastrada para o MDR, senão a máxima do MDR"""
+    chaves = pd.DataFrame({
+        'MDR': df_saturacao['EMBALAGEM'].astype(str).str.upper().to_numpy(),
+        'CHAVE FORNECEDOR': df_saturacao['COD FORNECEDOR'].map(_chave_fornecedor_capacidade).to_numpy(),
+        'COLUNA': [mapa_coluna_capacidade.get(cod_veic) for cod_veic in df_saturacao['VEICULO']],
+    })
+    do_fornecedor = chaves.merge(capacidades['fornecedor'].assign(CADASTRADA=True),
+                                 on=['MDR', 'CHAVE FORNECEDOR', 'COLUNA'], how='left')
+    do_mdr = chaves.merge(capacidades['mdr'], on=['MDR', 'COLUNA'], how='left')
+    capacidade = do_fornecedor['CAPACIDADE'].where(do_fornecedor['CADASTRADA'].notna(), do_mdr['CAPACIDADE'])
+    return pd.Series(capacidade.to_numpy(dtype=float), index=df_saturacao.index)
 
-    # Converte DESENHO e QTDE para inteiro após remover os nulos
-    for col in colunas_numericas:
-        if col in df_final.columns:
-            df_final[col] = pd.to_numeric(df_final[col], errors='coerce')
-            # Só converte para int se não tiver NaN
-            if df_final[col].notna().all():
-                df_final[col] = df_final[col].astype(int)
 
-    # Clean up COD FORNECEDOR: always store as string to prevent float upcast.
-    # Numeric values drop the .0 suffix; compound codes kept; empty -> None (not '0',
-    # because '0' would cause false substring matches in main.py matching logic).
-    if 'COD FORNECEDOR' in df_final.columns:
-        def _clean_forn(val):
-            s = str(val).strip()
-            if s in ('nan', '', 'None'):
-                return None
-            if '/' in s:
-                return s
-            try:
-                return str(int(float(s)))
-            except (ValueError, TypeError):
-                return s
-        df_final['COD FORNECEDOR'] = df_final['COD FORNECEDOR'].apply(_clean_forn)
-    
-    # Clean up COD DESTINO to remove .0 suffix if it exists
-    if 'COD DESTINO' in df_final.columns:
-        df_final['COD DESTINO'] = df_final['COD DESTINO'].astype(str).str.replace(r'\.0$', '', regex=True)
-    
-    # Clean up COD IMS to remove .0 suffix if it exists  
-    if 'COD IMS' in df_final.columns:
-        df_final['COD IMS'] = df_final['COD IMS'].astype(str).str.replace(r'\.0$', '', regex=True)
-    
-    
-    return df_final
+def _tabela_eficiencias(db_efi):
+    """BD_CADASTRO_MDR_PERDA_COMPRIMENTO em formato longo: primeira eficiência não nula de cada
+    (CHAVE FORNE + MDR, coluna de veículo), na ordem do registro.
 
-# Exemplo de como chamar a função
-# df_processado = Processar_Demandas(cod_destino="BR01")
-# print(df_processado)
+    Returns:
+        Series EFICIÊNCIA indexada por (CHAVE, COLUNA); chaves que não são texto e colunas duplicadas ficam de fora
+    """
+    duplicadas = set(db_efi.columns[db_efi.columns.duplicated()])
+    colunas = [coluna for coluna in db_efi.columns if coluna != 'CHAVE FORNE + MDR' and coluna not in duplicadas]
+    chaves = db_efi['CHAVE FORNE + MDR'].map(lambda chave: chave if isinstance(chave, str) else None)
+    longa = (
+        pd.concat([chaves.rename('CHAVE'), db_efi[colunas]], axis=1)
+        .melt(id_vars='CHAVE', var_name='COLUNA', value_name='EFICIÊNCIA')
+        .dropna(subset=['CHAVE', 'EFICIÊNCIA'])
+        .drop_duplicates(['CHAVE', 'COLUNA'])
+    )
+    return longa.set_index(['CHAVE', 'COLUNA'])['EFICIÊNCIA']
+
+
+def _eficiencia_por_linha(chaves, colunas, eficiencias):
+    """EFICIÊNCIA_COMPRIMENTO de cada par (CHAVE, coluna de veículo); 1 quando não há cadastro"""
+    indice = pd.MultiIndex.from_arrays([pd.Index(chaves, dtype=object), pd.Index(colunas, dtype=object)])
+    eficiencia = eficiencias.reindex(indice).infer_objects().fillna(1)
+    return pd.Series(eficiencia.to_numpy(), index=chaves.index)
+
+
+# Veículo imediatamente menor de cada código (o 11 é o menor de todos)
+VEICULO_MENOR = {
+    **dict.fromkeys([4, 5, 6, 7, 8, 9, 14], 3),
+    **dict.fromkeys([2, 3, 12, 13, 15, 16, 17, 18], 1),
+    1: 10,
+    10: 11,
+    11: 11,
+}
+
+
+def escada_veiculos(cod_veic):
+    """Cadeia de veículos menores a partir de cod_veic, sem ele (ex: 4 -> [3, 1, 10, 11])"""
+    escada = []
+    atual = VEICULO_MENOR.get(cod_veic)
+    while atual is not None and atual != cod_veic and atual not in escada:
+        escada.append(atual)
+        cod_veic, atual = atual, VEICULO_MENOR.get(atual)
+    return escada
+
+
+def _float_ou_nan(valor):
+    try:
+        return float(valor)
+    except (TypeError, ValueError):
+        return np.nan
 
 
+def _matriz_capacidades(db_MDR, mapa_coluna_capacidade):
+    """Matriz MDR x código de veículo com a capacidade do primeiro cadastro não nulo do MDR na coluna do
+    veículo (ordem do db_MDR). Veículo sem coluna no db_MDR, ou com a coluna duplicada, fica nulo.
+
+    Returns:
+        DataFrame float indexado pelo MDR em caixa alta, uma coluna por COD VEICULO
+    """
+    mdr = db_MDR['MDR'].astype(str).str.upper()
+    duplicadas = set(db_MDR.columns[db_MDR.columns.duplicated()])
+    primeiros = {}
+    for coluna in set(mapa_coluna_capacidade.values()):
+        if isinstance(coluna, str) and coluna and coluna in db_MDR.columns and coluna not in duplicadas:
+            primeiros[coluna] = db_MDR[coluna].groupby(mdr, sort=False).first().map(_float_ou_nan)
+    indice = pd.Index(mdr.unique())
+    return pd.DataFrame(
+        {cod_veic: (primeiros[coluna].reindex(indice) if coluna in primeiros else np.nan)
+         for cod_veic, coluna in mapa_coluna_capacidade.items()},
+        index=indice, dtype=float,
+    )
+
+
+def _capacidades_da_matriz(matriz, mdrs, veiculos=None):
+    """Capacidade de cada par (MDR, veículo) na matriz, ou de cada MDR em todos os veículos (linhas x colunas
+    da matriz) quando veiculos é None; pares fora da matriz ficam nulos"""
+    valores = np.pad(matriz.to_numpy(dtype=float), ((0, 1), (0, 1)), constant_values=np.nan)
+    linhas = matriz.index.get_indexer(mdrs)
+    if veiculos is None:
+        return valores[linhas, :-1]
+    return valores[linhas, matriz.columns.get_indexer(veiculos)]
+
+
+def carregar_referencias(caminho_BD="BD"):
+    """Registros do BD já normalizados e mapas de lookup do cálculo, reaproveitados em memória.
+
+    A primeira chamada lê os registros (ler_registro) e monta os mapas; as seguintes devolvem o mesmo
+    resultado enquanto tamanho/mtime dos arquivos não mudarem. Quem for alterar uma tabela deve
+    trabalhar numa cópia.
+
+    Returns:
+        dict de _tabelas_referencia com os mapas de _mapas_referencia em "mapas", a tabela de
+        _tabela_capacidades em "capacidades", a matriz de _matriz_capacidades em "matriz_capacidades" e
+        a tabela longa de _tabela_eficiencias em "eficiencias"
+    """
+    registros = arquivos_registros(caminho_BD)
+    if registros["PN"] is None:
+        raise FileNotFoundError("BD_CADASTRO_PN file not found. Please ensure database files are available.")
+    if registros["MDR"] is None:
+        raise FileNotFoundError("BD_CADASTRO_MDR file not found. Please ensure database files are available.")
+
+    def montar():
+        referencias = _tabelas_referencia(registros)
+        indice = _indice_referencia_persistido(registros, referencias)
+        referencias["mapas"] = _mapas_referencia(indice, referencias["db_veiculos"])
+        referencias["capacidades"] = _tabela_capacidades(referencias["db_MDR"],
+                                                         referencias["mapas"]["mapa_coluna_capacidade"])
+        referencias["matriz_capacidades"] = _matriz_capacidades(referencias["db_MDR"],
+                                                                referencias["mapas"]["mapa_coluna_capacidade"])
+        referencias["eficiencias"] = _tabela_eficiencias(referencias["db_efi"])
+        return referencias
+
+    return _referencia_em_cache(("referencias", caminho_BD), list(registros.values()), montar)
 
 
 def desenhar_caminhoes(canvas, ocupacao, caminhao_img):
@@ -511,7 +2014,7 @@ def desenhar_caminhoes(canvas, ocupacao, caminhao_img):
             x_offset = margem + 90  # centraliza abaixo dos dois
             y_offset = margem + 130
 
-        canvas.create_image(x_offset + 12, y_offset + 17, image=caminhao_img, anchor=NW)
+        canvas.create_image(x_offset + 12, y_offset + 17, image=caminhao_img, anchor="nw")
 
         x_inicial_grade = x_offset + 50
         y_inicial_grade = y_offset + 10
@@ -528,155 +2031,689 @@ def desenhar_caminhoes(canvas, ocupacao, caminhao_img):
 
 
 
-def calcular_empilhamento_line_haul(df_saturacao, db_empilhamento):
-    empilhamento_rows = []
-
-    base_df = df_saturacao[df_saturacao['EMBALAGEM_BASE'] == 1]
-    sobre_df = df_saturacao[df_saturacao['EMBALAGEM_SOBREPOSTA'] == 1]
-
-    for _, base_row in base_df.iterrows():
-        for _, sobre_row in sobre_df.iterrows():
-            if base_row['COD FORNECEDOR'] == sobre_row['COD FORNECEDOR'] and base_row['COD FLUXO'] == sobre_row['COD FLUXO']:
-                fornecedor = base_row['COD FORNECEDOR']
-                cod_fluxo = base_row['COD FLUXO']
-                embal_base = base_row['EMBALAGEM']
-                embal_sobre = sobre_row['EMBALAGEM']
-
-                empilhamento_match = db_empilhamento[
-                    (db_empilhamento['COD FORNECEDOR'] == fornecedor) &
-                    (db_empilhamento['MDR BASE'] == embal_base) &
-                    (db_empilhamento['MDR SOBREPOSTA'] == embal_sobre)
-                ]
-
-                if empilhamento_match.empty:
-                    continue
+def _empilhamento_por_par(df_saturacao, db_empilhamento, empilhamento_base=None):
+    """Combinações base x sobreposta de cada fornecedor e fluxo com cadastro no db_empilhamento.
+
+    Cada linha base (EMBALAGEM_BASE == 1) é juntada às sobrepostas (EMBALAGEM_SOBREPOSTA == 1) do mesmo
+    COD FORNECEDOR e COD FLUXO, e o par ao primeiro cadastro (COD FORNECEDOR, MDR BASE, MDR SOBREPOSTA).
+    Cada pilha usa EMPILHAMENTO BASE caixas base e 1 sobreposta, então o número de pilhas é
+    min(total_base // emp_base, total_sobre) e não precisa ser contado caixa a caixa.
+
+    Args:
+        empilhamento_base: caixas base por sobreposta fixas para todos os pares (ex: 1 no line haul);
+            None usa o EMPILHAMENTO BASE do cadastro
+
+    Returns:
+        DataFrame na ordem base x sobreposta da aba Saturação (vazio, sem colunas, quando não há pares)
+    """
+    def chave(serie):
+        return serie.map(_chave_fornecedor_capacidade).astype(object)
+
+    def chaves(df, colunas):
+        return {f'_{coluna}': chave(df[coluna]) for coluna in colunas}
+
+    base = df_saturacao[df_saturacao['EMBALAGEM_BASE'] == 1]
+    sobre = df_saturacao[df_saturacao['EMBALAGEM_SOBREPOSTA'] == 1]
+    base = pd.DataFrame({
+        '_POSICAO_BASE': np.arange(len(base)),
+        **chaves(base, ['COD FORNECEDOR', 'COD FLUXO', 'EMBALAGEM']),
+        'FORNECEDOR': base['COD FORNECEDOR'],
+        'COD FLUXO': base['COD FLUXO'],
+        'EMBALAGEM_BASE': base['EMBALAGEM'],
+        'CAPACIDADE_VEÍCULO': base['CAPACIDADE'],
+        'TOTAL_DE_EMBALAGENS_BASE': base['TOTAL DE CXS'],
+    })
+    sobre = pd.DataFrame({
+        '_POSICAO_SOBRE': np.arange(len(sobre)),
+        **chaves(sobre, ['COD FORNECEDOR', 'COD FLUXO']),
+        '_MDR SOBREPOSTA': chave(sobre['EMBALAGEM']),
+        'EMBALAGEM_SOBREPOSTA': sobre['EMBALAGEM'],
+        'TOTAL_DE_EMBALAGENS_SOBREPOSTA': sobre['TOTAL DE CXS'],
+    })
+    cadastro = pd.DataFrame({
+        '_COD FORNECEDOR': chave(db_empilhamento['COD FORNECEDOR']),
+        '_EMBALAGEM': chave(db_empilhamento['MDR BASE']),
+        '_MDR SOBREPOSTA': chave(db_empilhamento['MDR SOBREPOSTA']),
+        'EMPILHAMENTO BASE': db_empilhamento['EMPILHAMENTO BASE'],
+    })
+    juncao = ['_COD FORNECEDOR', '_EMBALAGEM', '_MDR SOBREPOSTA']
+    cadastro = cadastro.dropna(subset=juncao).drop_duplicates(juncao)
+
+    pares = (
+        base.dropna(subset=['_COD FORNECEDOR', '_COD FLUXO'])
+        .merge(sobre.dropna(subset=['_COD FORNECEDOR', '_COD FLUXO']), on=['_COD FORNECEDOR', '_COD FLUXO'])
+        .merge(cadastro, on=juncao)
+        .sort_values(['_POSICAO_BASE', '_POSICAO_SOBRE'], kind='mergesort')
+        .reset_index(drop=True)
+    )
+    if pares.empty:
+        return pd.DataFrame()
+    if empilhamento_base is not None:
+        pares['EMPILHAMENTO BASE'] = empilhamento_base
+
+    total_base = pares['TOTAL_DE_EMBALAGENS_BASE']
+    total_sobre = pares['TOTAL_DE_EMBALAGENS_SOBREPOSTA']
+    emp_base = pares['EMPILHAMENTO BASE']
+    # Sem caixas base por pilha (<= 0) só a quantidade de sobrepostas limita as pilhas
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pilhas_base = np.where(emp_base > 0, total_base // emp_base.where(emp_base > 0, 1),
+                               np.where(total_base >= emp_base, np.inf, 0))
+    pilhas = np.minimum(pilhas_base, total_sobre // 1)
+    pilhas = pd.Series(np.where(pilhas > 0, pilhas, 0).astype(np.int64), index=pares.index)
+
+    usadas_base = (pilhas * emp_base).where(pilhas > 0, 0)
+    pares['TOTAL_DE_EMBALAGENS_BASE_PARA_COMBINAR'] = usadas_base
+    pares['TOTAL_DE_EMBALAGENS_SOBREPOSTA_PARA_COMBINAR'] = pilhas
+    pares['EMBALAGENS_BASE_RESTANTE'] = total_base - usadas_base
+    pares['EMBALAGENS_SOBREPOSTA_RESTANTE'] = total_sobre - pilhas
+    pares['CHAVE'] = (pares['FORNECEDOR'].map(str) + '-' + pares['EMBALAGEM_BASE'].map(str) + '-'
+                      + pares['EMBALAGEM_SOBREPOSTA'].map(str))
+    pares['TOTAL_EMBALAGENS_EMPILHADAS'] = usadas_base + pilhas
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pares['SATURAÇÃO'] = pares['TOTAL_EMBALAGENS_EMPILHADAS'] / pares['CAPACIDADE_VEÍCULO']
+
+    return pares[['FORNECEDOR', 'COD FLUXO', 'EMBALAGEM_BASE', 'EMBALAGEM_SOBREPOSTA', 'CAPACIDADE_VEÍCULO',
+                  'TOTAL_DE_EMBALAGENS_BASE', 'TOTAL_DE_EMBALAGENS_SOBREPOSTA',
+                  'TOTAL_DE_EMBALAGENS_BASE_PARA_COMBINAR', 'TOTAL_DE_EMBALAGENS_SOBREPOSTA_PARA_COMBINAR',
+                  'EMBALAGENS_BASE_RESTANTE', 'EMBALAGENS_SOBREPOSTA_RESTANTE', 'CHAVE',
+                  'TOTAL_EMBALAGENS_EMPILHADAS', 'SATURAÇÃO', 'EMPILHAMENTO BASE']]
 
-                capacidade_veiculo = base_row['CAPACIDADE']
-
-                total_base = base_row['TOTAL DE CXS']
-                total_sobre = sobre_row['TOTAL DE CXS']
-
-                usadas_base = 0
-                usadas_sobre = 0
-
-                # Empilha 1 base com 1 sobreposta (não considera EMPILHAMENTO BASE)
-                while total_base >= 1 and total_sobre >= 1:
-                    total_base -= 1
-                    total_sobre -= 1
-                    usadas_base += 1
-                    usadas_sobre += 1
-
-                total_empilhado = usadas_base + usadas_sobre
-                chave = f"{fornecedor}-{embal_base}-{embal_sobre}"
-               
-                saturacao = total_empilhado / capacidade_veiculo
-
-                empilhamento_rows.append({
-                    'FORNECEDOR': fornecedor,
-                    'COD FLUXO': cod_fluxo,
-                    'EMBALAGEM_BASE': embal_base,
-                    'EMBALAGEM_SOBREPOSTA': embal_sobre,
-                    'CAPACIDADE_VEÍCULO': capacidade_veiculo,
-                    'TOTAL_DE_EMBALAGENS_BASE': base_row['TOTAL DE CXS'],
-                    'TOTAL_DE_EMBALAGENS_SOBREPOSTA': sobre_row['TOTAL DE CXS'],
-                    'TOTAL_DE_EMBALAGENS_BASE_PARA_COMBINAR': usadas_base,
-                    'TOTAL_DE_EMBALAGENS_SOBREPOSTA_PARA_COMBINAR': usadas_sobre,
-                    'EMBALAGENS_BASE_RESTANTE': total_base,
-                    'EMBALAGENS_SOBREPOSTA_RESTANTE': total_sobre,
-                    'CHAVE': chave,
-                    'TOTAL_EMBALAGENS_EMPILHADAS': total_empilhado,
-                    'SATURAÇÃO': saturacao,
-                    'EMPILHAMENTO BASE': 1  # fixo, pois é 1:1
-                })
 
-    return pd.DataFrame(empilhamento_rows)
+def calcular_empilhamento_line_haul(df_saturacao, db_empilhamento):
+    # Empilha 1 base com 1 sobreposta (não considera EMPILHAMENTO BASE)
+    return _empilhamento_por_par(df_saturacao, db_empilhamento, empilhamento_base=1)
 
 
 def calcular_empilhamento(df_saturacao, db_empilhamento):
-    empilhamento_rows = []
-
-    base_df = df_saturacao[df_saturacao['EMBALAGEM_BASE'] == 1]
-    sobre_df = df_saturacao[df_saturacao['EMBALAGEM_SOBREPOSTA'] == 1]
-
-    for _, base_row in base_df.iterrows():
-        for _, sobre_row in sobre_df.iterrows():
-            # Must match on COD FLUXO too — stacking only within the same fluxo
-            if base_row['COD FORNECEDOR'] == sobre_row['COD FORNECEDOR'] and base_row['COD FLUXO'] == sobre_row['COD FLUXO']:
-                fornecedor = base_row['COD FORNECEDOR']
-                cod_fluxo = base_row['COD FLUXO']
-                embal_base = base_row['EMBALAGEM']
-                embal_sobre = sobre_row['EMBALAGEM']
-
-                empilhamento_match = db_empilhamento[
-                    (db_empilhamento['COD FORNECEDOR'] == fornecedor) &
-                    (db_empilhamento['MDR BASE'] == embal_base) &
-                    (db_empilhamento['MDR SOBREPOSTA'] == embal_sobre)
-                ]
-
-                if empilhamento_match.empty:
-                    continue
+    # Empilhamento só dentro do mesmo fluxo, com EMPILHAMENTO BASE caixas base por sobreposta
+    return _empilhamento_por_par(df_saturacao, db_empilhamento)
+
+
+def integrar_saturacao_total(df_sat, df_emp):
+    """SATURAÇÃO_TOTAL e SATURAÇÃO_POR_MDR da aba Saturação com as saturações do cálculo de empilhamento.
 
-                emp_base = empilhamento_match.iloc[0]['EMPILHAMENTO BASE']
-                capacidade_veiculo = base_row['CAPACIDADE']
+    As saturações de empilhamento são somadas uma vez por (fornecedor, embalagem base, fluxo) e juntadas
+    às linhas; o resto é aritmética de colunas.
+    """
+    def chaves(df, fornecedor, embalagem):
+        return pd.DataFrame({
+            nome: df[coluna].map(_chave_fornecedor_capacidade).astype(object).to_numpy()
+            for nome, coluna in [('_FORNECEDOR', fornecedor), ('_EMBALAGEM', embalagem), ('_COD FLUXO', 'COD FLUXO')]
+        })
+
+    chave = ['_FORNECEDOR', '_EMBALAGEM', '_COD FLUXO']
+    somas = (
+        chaves(df_emp, 'FORNECEDOR', 'EMBALAGEM_BASE')
+        .assign(SOMA_SATURACOES=df_emp['SATURAÇÃO'].to_numpy())
+        .groupby(chave, as_index=False)['SOMA_SATURACOES'].sum()
+    )
+    soma_saturacoes = (
+        chaves(df_sat, 'COD FORNECEDOR', 'EMBALAGEM')
+        .merge(somas, on=chave, how='left')['SOMA_SATURACOES'].fillna(0).to_numpy()
+    )
+
+    # Prevent division by zero
+    capacidade = df_sat['CAPACIDADE'].to_numpy(dtype=float)
+    sem_capacidade = np.isnan(capacidade) | (capacidade == 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        proporcao = df_sat['CXS/PALLETS_TOTAL'].to_numpy(dtype=float) / capacidade
+        total = (proporcao + soma_saturacoes) * df_sat['EFICIÊNCIA_COMPRIMENTO'].to_numpy(dtype=float)
+    df_sat['SATURAÇÃO_TOTAL'] = np.where(sem_capacidade, 0.0, total)
+    # Clean up infinity values
+    df_sat['SATURAÇÃO_TOTAL'] = df_sat['SATURAÇÃO_TOTAL'].replace([np.inf, -np.inf], np.nan).fillna(0)
+
+    # Prevent division by zero for SATURAÇÃO_POR_MDR
+    df_sat['SATURAÇÃO_POR_MDR'] = 0.0
+    mask = (df_sat['TOTAL DE CXS'].notna()) & (df_sat['TOTAL DE CXS'] > 0)
+    df_sat.loc[mask, 'SATURAÇÃO_POR_MDR'] = df_sat.loc[mask, 'SATURAÇÃO_TOTAL'] / df_sat.loc[mask, 'TOTAL DE CXS']
+    df_sat['SATURAÇÃO_POR_MDR'] = df_sat['SATURAÇÃO_POR_MDR'].replace([np.inf, -np.inf], np.nan).fillna(0)
+
+    return df_sat
+
+
+# ------------------- TEMPLATE EM MEMÓRIA E EXPORTAÇÃO DOS RELATÓRIOS -------------------
+# input_demanda -> completar_informacoes -> consolidar_dados passam DataFrames direto de uma etapa para
+# a outra; Template.xlsx, VIAJANTE.xlsx e Volume_por_rota.xlsx são só a saída final (exportar_relatorios),
+# que pode rodar em segundo plano depois que os números estão prontos.
+
+ABAS_FORMATADAS_VIAJANTE = ['Template Completo', 'Saturação', 'Calculo Empilhamento']
+
+
+# Textos que o read_excel lê como célula vazia (os que input_demanda pode gerar com str() de um nulo)
+_TEXTOS_NULOS_PLANILHA = ['', 'nan', 'NaN', 'None', 'NULL', 'null', 'NA', 'N/A', 'n/a', '<NA>', '#N/A']
+
+
+def _texto_planilha(valor):
+    """Valor como o Excel devolve numa coluna lida como texto: 12.0 -> '12'; nulo ou vazio -> NaN"""
+    if not pd.notna(valor) or valor in _TEXTOS_NULOS_PLANILHA:
+        return np.nan
+    if isinstance(valor, float) and valor.is_integer():
+        return str(int(valor))
+    return str(valor)
+
+
+def _preparar_template_demanda(template):
+    """Template vindo de input_demanda com os mesmos valores que a leitura de Template.xlsx traria.
+
+    Textos vazios ou de nulo ('nan', 'None') viram nulos, como uma célula vazia, e DESENHO vira texto,
+    como no read_excel(dtype={'DESENHO': str}).
+    """
+    template = template.copy()
+    for coluna in template.columns:
+        if not pd.api.types.is_numeric_dtype(template[coluna]):
+            template[coluna] = template[coluna].replace(_TEXTOS_NULOS_PLANILHA, np.nan)
+    if 'DESENHO' in template.columns:
+        template['DESENHO'] = template['DESENHO'].map(_texto_planilha).astype(object)
+    return template
+
+
+def _pns_nao_cadastrados(template):
+    """Linhas do template com problema de cadastro (sem MDR, sem QME ou sem descrição), ou None"""
+    # Identify PNs with issues
+    pn_nao_cadastrados_list = []
+
+    # 1. PNs not in BD_CADASTRO_PN (no MDR)
+    pn_sem_mdr = template[
+        template['MDR'].isna() | (template['MDR'].astype(str).str.strip() == '')
+    ].copy()
+    if not pn_sem_mdr.empty:
+        pn_sem_mdr['MOTIVO'] = 'PN não encontrado no BD_CADASTRO_PN (sem MDR)'
+        pn_nao_cadastrados_list.append(pn_sem_mdr)
+
+    # 2. PNs without QME (critical for calculations)
+    pn_sem_qme = template[
+        template['MDR'].notna() &
+        (template['QME'].isna() | (template['QME'] == 0))
+    ].copy()
+    if not pn_sem_qme.empty:
+        pn_sem_qme['MOTIVO'] = 'PN sem QME cadastrado'
+        pn_nao_cadastrados_list.append(pn_sem_qme)
+
+    # 3. PNs without DESCRIÇÃO MATERIAL
+    pn_sem_desc = template[
+        template['MDR'].notna() &
+        (template['DESCRIÇÃO MATERIAL'].isna() | (template['DESCRIÇÃO MATERIAL'].astype(str).str.strip() == ''))
+    ].copy()
+    if not pn_sem_desc.empty:
+        pn_sem_desc['MOTIVO'] = 'PN sem DESCRIÇÃO MATERIAL cadastrada'
+        pn_nao_cadastrados_list.append(pn_sem_desc)
+
+    if not pn_nao_cadastrados_list:
+        return None
 
-                total_base = base_row['TOTAL DE CXS']
-                total_sobre = sobre_row['TOTAL DE CXS']
+    # Combine all issues
+    pn_nao_cadastrados = pd.concat(pn_nao_cadastrados_list, ignore_index=True)
 
-                usadas_base = 0
-                usadas_sobre = 0
+    # Select columns to keep
+    cols_to_keep = ['COD FORNECEDOR', 'FORNECEDOR', 'COD IMS', 'COD DESTINO', 'DESENHO', 'QTDE', 'MDR', 'QME', 'MOTIVO']
+    existing_cols = [c for c in cols_to_keep if c in pn_nao_cadastrados.columns]
+    if not existing_cols:
+        return None
 
-                while total_base >= emp_base and total_sobre >= 1:
-                    total_base -= emp_base
-                    total_sobre -= 1
-                    usadas_base += emp_base
-                    usadas_sobre += 1
+    pn_nao_cadastrados = pn_nao_cadastrados[existing_cols]
+    return pn_nao_cadastrados.drop_duplicates(subset=["DESENHO", "MOTIVO"])
+
+
+# Os relatórios são gravados direto em XML (xlsx é um zip de XMLs), coluna a coluna e em blocos de linhas,
+# sem criar uma célula do openpyxl por valor: sem lxml, o openpyxl leva ~20 µs por célula, mesmo em write_only.
+# Valores, tipos, formatos de data, estilo do cabeçalho e larguras saem iguais aos do DataFrame.to_excel
+# com a formatação feita depois no openpyxl, que era como os relatórios eram gravados.
+
+ESTILO_CABECALHO_VIAJANTE = {'fundo': 'FFC000', 'fonte': '000000'}
+ESTILO_CABECALHO_VOLUME = {'fundo': '00246C', 'fonte': 'FFFFFF'}
+
+_LINHAS_POR_BLOCO = 20000
+_FORMATO_DATA_HORA_PLANILHA = 'YYYY-MM-DD HH:MM:SS'
+_FORMATO_DATA_PLANILHA = 'YYYY-MM-DD'
+# Posição em cellXfs (styles.xml) de cada estilo de célula
+_ESTILOS_CELULA = {'cabecalho': 1, _FORMATO_DATA_HORA_PLANILHA: 2, _FORMATO_DATA_PLANILHA: 3, '0': 4}
+_CARACTERES_ILEGAIS_XML = re.compile(r'[\000-\010]|[\013-\014]|[\016-\037]')
+_CODIGOS_ERRO_PLANILHA = ('#NULL!', '#DIV/0!', '#VALUE!', '#REF!', '#NAME?', '#NUM!', '#N/A')
+_INICIO_DATAS_EXCEL = datetime(1899, 12, 30)
+
+
+def _valor_planilha(valor):
+    """(valor, formato) de uma célula como o DataFrame.to_excel gravaria"""
+    if pd.api.types.is_scalar(valor) and pd.isna(valor):
+        return None, None
+    if getattr(valor, 'tzinfo', None) is not None:
+        raise ValueError("O Excel não aceita datas com fuso horário")
+    if pd.api.types.is_bool(valor):
+        return bool(valor), None
+    if pd.api.types.is_integer(valor):
+        return int(valor), None
+    if pd.api.types.is_float(valor):
+        if np.isinf(valor):
+            return ('inf' if valor > 0 else '-inf'), None
+        return float(valor), None
+    if isinstance(valor, Decimal):
+        return valor, None
+    if isinstance(valor, datetime):
+        return valor, _FORMATO_DATA_HORA_PLANILHA
+    if isinstance(valor, date):
+        return valor, _FORMATO_DATA_PLANILHA
+    if isinstance(valor, timedelta):
+        return valor.total_seconds() / 86400, '0'
+    return str(valor), None
+
+
+def _serial_excel(valor):
+    """Data/hora no número de série do Excel (dias desde 30/12/1899, com o ajuste de 1900 do openpyxl)"""
+    if not isinstance(valor, datetime):
+        valor = datetime.combine(valor, datetime.min.time())
+    dias = (valor - _INICIO_DATAS_EXCEL).days
+    if 0 < dias <= 60:
+        dias -= 1
+    return dias + (valor.hour * 3600 + valor.minute * 60 + valor.second + valor.microsecond / 10**6) / 86400
+
+
+def _escapar_xml(texto):
+    return texto.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+def _xml_texto(ref, texto, atributos=''):
+    """Célula de texto; como no openpyxl, '=...' vira fórmula e '#N/A' etc. viram erro"""
+    texto = _CARACTERES_ILEGAIS_XML.sub('', texto[:32767])
+    if not texto:
+        return ''
+    if len(texto) > 1 and texto.startswith('='):
+        return f'<c r="{ref}"{atributos}><f>{_escapar_xml(texto[1:])}</f></c>'
+    if texto in _CODIGOS_ERRO_PLANILHA:
+        return f'<c r="{ref}"{atributos} t="e"><v>{texto}</v></c>'
+    espaco = ' xml:space="preserve"' if texto.strip() and texto != texto.strip() else ''
+    return f'<c r="{ref}"{atributos} t="inlineStr"><is><t{espaco}>{_escapar_xml(texto)}</t></is></c>'
+
+
+def _numero_xml(valor):
+    """Texto exato de um número na célula: inteiros e Decimal por extenso, floats pelo repr (o menor texto
+    que volta ao mesmo float; '%.16g' arredondava 0.1 + 0.2 e inteiros a partir de 1e16)"""
+    if isinstance(valor, (int, np.integer)):
+        return str(int(valor))
+    if isinstance(valor, Decimal):
+        return str(valor)
+    return repr(float(valor))
+
+
+def _xml_celula(ref, valor, formato=None, estilo=None):
+    """XML de uma célula a partir do (valor, formato) de _valor_planilha; '' para célula vazia"""
+    if valor is None:
+        return ''
+    if formato is not None:
+        estilo = _ESTILOS_CELULA[formato]
+    atributos = f' s="{estilo}"' if estilo else ''
+    if isinstance(valor, str):
+        return _xml_texto(ref, valor, atributos)
+    if isinstance(valor, bool):
+        return f'<c r="{ref}"{atributos} t="b"><v>{int(valor)}</v></c>'
+    if isinstance(valor, (datetime, date)):
+        valor = _serial_excel(valor)
+    return f'<c r="{ref}"{atributos} t="n"><v>{_numero_xml(valor)}</v></c>'
+
+
+def _celulas_xml(serie, letra, primeira_linha):
+    """XML das células de uma coluna, uma string por linha ('' para célula vazia)"""
+    linhas = range(primeira_linha, primeira_linha + len(serie))
+    tipo = serie.dtype.kind if isinstance(serie.dtype, np.dtype) else 'O'
+
+    if tipo == 'b':
+        return [f'<c r="{letra}{n}" t="b"><v>{int(v)}</v></c>' for n, v in zip(linhas, serie.tolist())]
+    if tipo in 'iu':
+        return [f'<c r="{letra}{n}" t="n"><v>{v}</v></c>' for n, v in zip(linhas, serie.tolist())]
+    if tipo == 'f':
+        return [
+            '' if v != v
+            else f'<c r="{letra}{n}" t="n"><v>{v!r}</v></c>' if abs(v) != np.inf
+            else _xml_texto(f'{letra}{n}', 'inf' if v > 0 else '-inf')
+            for n, v in zip(linhas, serie.tolist())
+        ]
+    if tipo == 'M':
+        # Mesma conta de _serial_excel, vetorizada
+        dias = (serie - pd.Timestamp(_INICIO_DATAS_EXCEL)).dt.days
+        dias = dias.where(~((dias > 0) & (dias <= 60)), dias - 1)
+        segundos = serie.dt.hour * 3600 + serie.dt.minute * 60 + serie.dt.second + serie.dt.microsecond / 10**6
+        seriais = (dias + segundos / 86400).tolist()
+        estilo = _ESTILOS_CELULA[_FORMATO_DATA_HORA_PLANILHA]
+        return [
+            '' if v != v else f'<c r="{letra}{n}" s="{estilo}" t="n"><v>{v!r}</v></c>'
+            for n, v in zip(linhas, seriais)
+        ]
+    if pd.api.types.infer_dtype(serie, skipna=True) == 'string':
+        return ['' if v is None or v != v else _xml_texto(f'{letra}{n}', v)
+                for n, v in zip(linhas, serie.astype(object).tolist())]
+    return [_xml_celula(f'{letra}{n}', *_valor_planilha(v)) for n, v in zip(linhas, serie.astype(object).tolist())]
+
+
+def _xml_estilos(estilo_cabecalho):
+    """styles.xml: fonte padrão, cabeçalho (negrito, cor da fonte e fundo, centralizado) e formatos de data"""
+    fundo, fonte = estilo_cabecalho['fundo'], estilo_cabecalho['fonte']
+    return (
+        '<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+        f'<numFmts count="2"><numFmt numFmtId="164" formatCode="{_FORMATO_DATA_HORA_PLANILHA}"/>'
+        f'<numFmt numFmtId="165" formatCode="{_FORMATO_DATA_PLANILHA}"/></numFmts>'
+        '<fonts count="2"><font><name val="Calibri"/><family val="2"/><color rgb="FF000000"/><sz val="11"/>'
+        f'</font><font><b val="1"/><color rgb="00{fonte}"/></font></fonts>'
+        '<fills count="3"><fill><patternFill/></fill><fill><patternFill patternType="gray125"/></fill>'
+        f'<fill><patternFill patternType="solid"><fgColor rgb="00{fundo}"/><bgColor rgb="00{fundo}"/>'
+        '</patternFill></fill></fills>'
+        '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+        '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+        '<cellXfs count="5"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>'
+        '<xf numFmtId="0" fontId="1" fillId="2" borderId="0" applyAlignment="1" xfId="0">'
+        '<alignment horizontal="center" vertical="center"/></xf>'
+        '<xf numFmtId="164" fontId="0" fillId="0" borderId="0" applyNumberFormat="1" xfId="0"/>'
+        '<xf numFmtId="165" fontId="0" fillId="0" borderId="0" applyNumberFormat="1" xfId="0"/>'
+        '<xf numFmtId="1" fontId="0" fillId="0" borderId="0" applyNumberFormat="1" xfId="0"/></cellXfs>'
+        '<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>'
+        '</styleSheet>'
+    )
+
+
+def _gravar_aba_xml(arquivo, df, larguras=None, formatar_cabecalho=False):
+    """Escreve o XML de uma aba (cabeçalho + linhas, sem índice) em `arquivo`, um bloco de linhas por vez"""
+    from openpyxl.utils import get_column_letter
+
+    letras = [get_column_letter(posicao) for posicao in range(1, df.shape[1] + 1)]
+    ultima = f'{letras[-1]}{len(df) + 1}' if letras else 'A1'
+    partes = [
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+        f'<dimension ref="A1:{ultima}"/><sheetViews><sheetView workbookViewId="0">'
+        '<selection activeCell="A1" sqref="A1"/></sheetView></sheetViews>'
+        '<sheetFormatPr baseColWidth="8" defaultRowHeight="15"/>'
+    ]
+    if larguras:
+        partes.append('<cols>' + ''.join(
+            f'<col min="{posicao}" max="{posicao}" width="{largura}" customWidth="1"/>'
+            for posicao, largura in enumerate(larguras, 1)
+        ) + '</cols>')
+    estilo = _ESTILOS_CELULA['cabecalho'] if formatar_cabecalho else None
+    cabecalho = ''.join(_xml_celula(f'{letra}1', *_valor_planilha(coluna), estilo=estilo)
+                        for letra, coluna in zip(letras, df.columns))
+    partes.append(f'<sheetData><row r="1">{cabecalho}</row>')
+    arquivo.write(''.join(partes).encode('utf-8'))
+
+    for inicio in range(0, len(df), _LINHAS_POR_BLOCO):
+        bloco = df.iloc[inicio:inicio + _LINHAS_POR_BLOCO]
+        colunas = [_celulas_xml(bloco.iloc[:, posicao], letra, inicio + 2) for posicao, letra in enumerate(letras)]
+        linhas = ''.join(f'<row r="{n}">{"".join(celulas)}</row>'
+                         for n, celulas in enumerate(zip(*colunas), inicio + 2))
+        arquivo.write(linhas.encode('utf-8'))
+
+    arquivo.write(b'</sheetData><pageMargins left="0.75" right="0.75" top="1" bottom="1" header="0.5" '
+                  b'footer="0.5"/></worksheet>')
+
+
+def _gravar_atomico(caminho, gravar):
+    """Chama gravar(temporario) com um arquivo na mesma pasta do destino e só então troca um pelo outro.
+
+    Quem estiver com o relatório aberto (ex.: Excel) nunca vê um arquivo pela metade. Se o destino
+    estiver bloqueado, o arquivo anterior fica como estava e o erro sobe com o nome do arquivo.
+    """
+    pasta = os.path.dirname(os.path.abspath(caminho))
+    nome, extensao = os.path.splitext(os.path.basename(caminho))
+    descritor, temporario = tempfile.mkstemp(prefix=f'~{nome}.', suffix=extensao, dir=pasta)
+    os.close(descritor)
+    try:
+        gravar(temporario)
+        try:
+            os.replace(temporario, caminho)
+        except PermissionError as e:
+            raise PermissionError(f"{os.path.basename(caminho)} está aberto em outro programa; "
+                                  f"feche o arquivo e calcule de novo") from e
+    finally:
+        if os.path.exists(temporario):
+            os.remove(temporario)
 
-                total_empilhado = usadas_base + usadas_sobre
-                chave = f"{fornecedor}-{embal_base}-{embal_sobre}"
-                
-                saturacao = total_empilhado / capacidade_veiculo
-
-                empilhamento_rows.append({
-                    'FORNECEDOR': fornecedor,
-                    'COD FLUXO': cod_fluxo,
-                    'EMBALAGEM_BASE': embal_base,
-                    'EMBALAGEM_SOBREPOSTA': embal_sobre,
-                    'CAPACIDADE_VEÍCULO': capacidade_veiculo,
-                    'TOTAL_DE_EMBALAGENS_BASE': base_row['TOTAL DE CXS'],
-                    'TOTAL_DE_EMBALAGENS_SOBREPOSTA': sobre_row['TOTAL DE CXS'],
-                    'TOTAL_DE_EMBALAGENS_BASE_PARA_COMBINAR': usadas_base,
-                    'TOTAL_DE_EMBALAGENS_SOBREPOSTA_PARA_COMBINAR': usadas_sobre,
-                    'EMBALAGENS_BASE_RESTANTE': total_base,
-                    'EMBALAGENS_SOBREPOSTA_RESTANTE': total_sobre,
-                    'CHAVE': chave,
-                    'TOTAL_EMBALAGENS_EMPILHADAS': total_empilhado,
-                    'SATURAÇÃO': saturacao,
-                    'EMPILHAMENTO BASE': emp_base
-                })
 
-    return pd.DataFrame(empilhamento_rows)
+def _gravar_xlsx(caminho, abas, estilo_cabecalho):
+    """Grava um .xlsx com as abas na ordem dada: lista de (nome, df, larguras ou None, formatar cabeçalho).
 
+    O pacote não leva a parte de tema (opcional): a fonte padrão tem cor explícita em styles.xml.
+    """
+    tipo = 'application/vnd.openxmlformats-officedocument'
+    relacao = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+    partes = {
+        '[Content_Types].xml': (
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            f'<Override PartName="/xl/workbook.xml" ContentType="{tipo}.spreadsheetml.sheet.main+xml"/>'
+            + ''.join(f'<Override PartName="/xl/worksheets/sheet{i}.xml" ContentType="{tipo}.spreadsheetml.worksheet+xml"/>'
+                      for i in range(1, len(abas) + 1))
+            + f'<Override PartName="/xl/styles.xml" ContentType="{tipo}.spreadsheetml.styles+xml"/></Types>'
+        ),
+        '_rels/.rels': (
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            f'<Relationship Id="rId1" Type="{relacao}/officeDocument" Target="xl/workbook.xml"/></Relationships>'
+        ),
+        'xl/workbook.xml': (
+            f'<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" xmlns:r="{relacao}">'
+            '<bookViews><workbookView activeTab="0"/></bookViews><sheets>'
+            + ''.join(f'<sheet name="{_escapar_xml(nome).replace(chr(34), "&quot;")}" sheetId="{i}" r:id="rId{i}"/>'
+                      for i, (nome, *_) in enumerate(abas, 1))
+            + '</sheets><calcPr calcId="124519" fullCalcOnLoad="1"/></workbook>'
+        ),
+        'xl/_rels/workbook.xml.rels': (
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            + ''.join(f'<Relationship Id="rId{i}" Type="{relacao}/worksheet" Target="worksheets/sheet{i}.xml"/>'
+                      for i in range(1, len(abas) + 1))
+            + f'<Relationship Id="rId{len(abas) + 1}" Type="{relacao}/styles" Target="styles.xml"/></Relationships>'
+        ),
+        'xl/styles.xml': _xml_estilos(estilo_cabecalho),
+    }
 
+    # Compressão rápida (nível 1): o arquivo fica um pouco maior, mas a compressão era 1/3 do tempo de gravação
+    def gravar(destino):
+        with zipfile.ZipFile(destino, 'w', zipfile.ZIP_DEFLATED, compresslevel=1) as pacote:
+            for nome, conteudo in partes.items():
+                pacote.writestr(nome, conteudo)
+            for i, (_, df, larguras, formatar_cabecalho) in enumerate(abas, 1):
+                # A aba vai primeiro para um temporário: com o tamanho conhecido o zip decide sozinho se precisa de ZIP64
+                descritor, temporario = tempfile.mkstemp(suffix='.xml')
+                try:
+                    with os.fdopen(descritor, 'wb') as arquivo:
+                        _gravar_aba_xml(arquivo, df, larguras, formatar_cabecalho)
+                    pacote.write(temporario, f'xl/worksheets/sheet{i}.xml')
+                finally:
+                    os.remove(temporario)
 
+    _gravar_atomico(caminho, gravar)
 
 
+def exportar_viajante(abas, caminho='VIAJANTE.xlsx'):
+    """Grava VIAJANTE.xlsx a partir das abas devolvidas por completar_informacoes (nome da aba -> DataFrame)"""
+    # Cabeçalho amarelo nas abas formatadas, com a largura de cada coluna pelo cabeçalho
+    planilha = [(nome, abas[nome], [len(str(coluna)) + 2 for coluna in abas[nome].columns], True)
+                for nome in ABAS_FORMATADAS_VIAJANTE]
+    if 'PN Não Cadastrados' in abas:
+        planilha.append(('PN Não Cadastrados', abas['PN Não Cadastrados'], None, False))
+    _gravar_xlsx(caminho, planilha, ESTILO_CABECALHO_VIAJANTE)
 
 
+# ------------------- LOG DE PNs NÃO CADASTRADOS -------------------
+# O log fica numa tabela SQLite (BD/PNs_Nao_Cadastrados_Log.sqlite) com chave (DESENHO, COD FORNECEDOR):
+# cada cálculo grava só os PNs dele, com upsert (o registro mais recente de um PN substitui o anterior),
+# sem reler nem regravar o histórico. BD/PNs_Nao_Cadastrados_Log.xlsx virou uma vista, gerada por
+# exportar_log_pns_nao_cadastrados quando pedida; um log .xlsx de antes é importado na criação da tabela.
 
+COLUNAS_LOG_PNS = ['COD FORNECEDOR', 'FORNECEDOR', 'COD IMS', 'COD DESTINO', 'DESENHO', 'QTDE', 'MDR', 'QME',
+                   'MOTIVO', 'DATA_SOLICITACAO']
+_trava_log_pns = threading.Lock()
 
 
+def _caminho_log_pns(caminho_BD='BD', extensao='.sqlite'):
+    return os.path.join(caminho_base, caminho_BD, 'PNs_Nao_Cadastrados_Log' + extensao)
 
 
+def _valor_sqlite(valor):
+    """Valor aceito pelo sqlite3: nulos viram None, escalares do numpy viram int/float e o resto vira texto"""
+    if pd.api.types.is_scalar(valor) and pd.isna(valor):
+        return None
+    if isinstance(valor, np.generic):
+        valor = valor.item()
+    if isinstance(valor, (int, float, str)):
+        return valor
+    return str(valor)
+
+
+def _chave_log_pns(valor):
+    """DESENHO / COD FORNECEDOR como texto para a chave: 12, 12.0 e '12' são o mesmo PN"""
+    texto = _texto_planilha(valor)
+    return '' if pd.isna(texto) else texto.strip()
+
+
+def _gravar_log_pns(conexao, pn_nao_cadastrados):
+    """Upsert das linhas no log, na ordem do DataFrame (a última de uma mesma chave vale)"""
+    proxima = conexao.execute("SELECT COALESCE(MAX(sequencia), 0) + 1 FROM pns_nao_cadastrados").fetchone()[0]
+    colunas = [coluna for coluna in COLUNAS_LOG_PNS if coluna in pn_nao_cadastrados.columns]
+    registros = [
+        (_chave_log_pns(linha.get('DESENHO')), _chave_log_pns(linha.get('COD FORNECEDOR')), proxima + posicao,
+         *(_valor_sqlite(linha[coluna]) for coluna in colunas))
+        for posicao, (_, linha) in enumerate(pn_nao_cadastrados.iterrows())
+    ]
+    nomes = ', '.join(f'"{coluna}"' for coluna in colunas)
+    marcadores = ', '.join('?' * (3 + len(colunas)))
+    conexao.executemany(
+        f'INSERT OR REPLACE INTO pns_nao_cadastrados (chave_desenho, chave_fornecedor, sequencia, {nomes}) '
+        f'VALUES ({marcadores})', registros)
+
+
+def _abrir_log_pns(caminho_BD='BD'):
+    """Conexão com o log de PNs; cria a tabela (importando o log .xlsx antigo, se houver) na primeira vez"""
+    caminho = _caminho_log_pns(caminho_BD)
+    novo = not os.path.exists(caminho)
+    conexao = sqlite3.connect(caminho, timeout=30)
+    colunas = ', '.join(f'"{coluna}"' for coluna in COLUNAS_LOG_PNS)
+    conexao.execute(
+        f"CREATE TABLE IF NOT EXISTS pns_nao_cadastrados (chave_desenho TEXT NOT NULL, chave_fornecedor TEXT NOT NULL, "
+        f"sequencia INTEGER NOT NULL, {colunas}, PRIMARY KEY (chave_desenho, chave_fornecedor))")
+    planilha_antiga = _caminho_log_pns(caminho_BD, '.xlsx')
+    if novo and os.path.exists(planilha_antiga):
+        with conexao:
+            _gravar_log_pns(conexao, pd.read_excel(planilha_antiga))
+        print(f"[INFO] Log de PNs não cadastrados importado de: {planilha_antiga}")
+    return conexao
+
+
+def registrar_pns_nao_cadastrados(pn_nao_cadastrados, caminho_BD='BD'):
+    """Acrescenta os PNs com problema de cadastro ao log (upsert por DESENHO + COD FORNECEDOR)"""
+    pn_nao_cadastrados = pn_nao_cadastrados.copy()
+    if 'DATA_SOLICITACAO' not in pn_nao_cadastrados.columns:
+        pn_nao_cadastrados['DATA_SOLICITACAO'] = pd.Timestamp.now().strftime('%Y-%m-%d %H:%M:%S')
+    with _trava_log_pns:
+        conexao = _abrir_log_pns(caminho_BD)
+        try:
+            with conexao:
+                _gravar_log_pns(conexao, pn_nao_cadastrados)
+        finally:
+            conexao.close()
+    print(f"[INFO] PNs não cadastrados salvos em: {_caminho_log_pns(caminho_BD)}")
+
+
+def exportar_log_pns_nao_cadastrados(caminho_BD='BD', caminho=None):
+    """Gera a planilha do log de PNs não cadastrados (padrão BD/PNs_Nao_Cadastrados_Log.xlsx); retorna o caminho"""
+    caminho = caminho or _caminho_log_pns(caminho_BD, '.xlsx')
+    with _trava_log_pns:
+        conexao = _abrir_log_pns(caminho_BD)
+        try:
+            colunas = ', '.join(f'"{coluna}"' for coluna in COLUNAS_LOG_PNS)
+            log = pd.read_sql_query(f"SELECT {colunas} FROM pns_nao_cadastrados ORDER BY sequencia", conexao)
+        finally:
+            conexao.close()
+    _gravar_atomico(caminho, lambda destino: log.to_excel(destino, index=False))
+    return caminho
+
+
+def exportar_volume_por_rota(df_volume, caminho='Volume_por_rota.xlsx'):
+    """Grava a tabela de consolidar_dados com cabeçalho azul e largura automática das colunas"""
+    # Largura pelo cabeçalho e pelas 100 primeiras linhas, com folga de 2 e limite de 50
+    amostra = df_volume.head(100)
+    larguras = []
+    for posicao, coluna in enumerate(df_volume.columns):
+        valores = [_valor_planilha(valor)[0] for valor in amostra.iloc[:, posicao]]
+        max_length = max([len(str(coluna)) if coluna else 0] + [len(str(v)) for v in valores if v])
+        larguras.append(min(max_length + 2, 50))
+
+    _gravar_xlsx(caminho, [('Volume por Rota', df_volume, larguras, True)], ESTILO_CABECALHO_VOLUME)
+
+
+def exportar_relatorios(template_demanda=None, viajante=None, df_volume=None, caminho_BD='BD', progresso=None):
+    """Saída final do cálculo em Excel: Template.xlsx, VIAJANTE.xlsx (+ log de PNs) e Volume_por_rota.xlsx.
+
+    Recebe o que input_demanda, completar_informacoes e consolidar_dados devolveram; o que vier None
+    não é gravado. Cada arquivo é gravado à parte (um bloqueado não impede os outros) e progresso(texto),
+    se dado, é chamado antes de cada um (uma falha dele só é impressa). Retorna a lista de erros
+    ("arquivo: motivo"), vazia se tudo gravou.
+    """
+    tarefas = []
+    if template_demanda is not None:
+        tarefas.append(("Template.xlsx", lambda: _gravar_atomico(
+            "Template.xlsx", lambda destino: template_demanda.to_excel(destino, index=False))))
+    if viajante is not None:
+        tarefas.append(("VIAJANTE.xlsx", lambda: exportar_viajante(viajante)))
+        if 'PN Não Cadastrados' in viajante:
+            tarefas.append(("log de PNs não cadastrados",
+                            lambda: registrar_pns_nao_cadastrados(viajante['PN Não Cadastrados'], caminho_BD)))
+    if df_volume is not None:
+        tarefas.append(("Volume_por_rota.xlsx", lambda: exportar_volume_por_rota(df_volume)))
+
+    erros = []
+    for numero, (arquivo, tarefa) in enumerate(tarefas, 1):
+        if progresso is not None:
+            try:
+                progresso(f"Gravando {arquivo} ({numero}/{len(tarefas)})...")
+            except Exception as e:
+                # Ex.: janela já fechada; o aviso de progresso nunca impede a gravação
+                print(f"[AVISO] Erro ao informar o progresso da exportação: {e}")
+        try:
+            tarefa()
+        except Exception as e:
+            print(f"[AVISO] Erro ao gravar {arquivo}: {e}")
+            erros.append(f"{arquivo}: {e}")
+    return erros
 
 
+# ------------------- FILA DE EXPORTAÇÃO -------------------
+# Os números e a tela ficam prontos antes dos arquivos: agendar_exportacao põe exportar_relatorios numa
+# fila com um trabalhador só, para as exportações saírem na ordem dos cálculos sem segurar o próximo.
+# Ao fechar a janela, main.py espera a fila com aguardar_exportacoes antes de destruí-la.
 
+_fila_exportacao = {'executor': None, 'pendentes': []}
+_trava_fila_exportacao = threading.Lock()
 
 
+def agendar_exportacao(template_demanda=None, viajante=None, df_volume=None, caminho_BD='BD', progresso=None):
+    """Põe a gravação dos relatórios na fila e retorna o Future (resultado: lista de erros de exportar_relatorios)"""
+    with _trava_fila_exportacao:
+        if _fila_exportacao['executor'] is None:
+            _fila_exportacao['executor'] = ThreadPoolExecutor(max_workers=1, thread_name_prefix='exportacao')
+        futuro = _fila_exportacao['executor'].submit(
+            exportar_relatorios, template_demanda, viajante, df_volume, caminho_BD, progresso)
+        _fila_exportacao['pendentes'] = [f for f in _fila_exportacao['pendentes'] if not f.done()] + [futuro]
+    return futuro
 
 
+def aguardar_exportacoes(timeout=None):
+    """Espera as exportações agendadas terminarem; retorna os erros das que terminaram"""
+    with _trava_fila_exportacao:
+        pendentes = list(_fila_exportacao['pendentes'])
+    wait(pendentes, timeout=timeout)
+    erros = []
+    for futuro in pendentes:
+        if futuro.done():
+            erros.extend(futuro.result())
+    return erros
 
-def completar_informacoes(tree, veiculo, tree_resumo, canvas_caminhoes, caminhao_img, usar_manual=False,caminho_BD = 'BD'):
 
+def completar_informacoes(tree, veiculo, tree_resumo, canvas_caminhoes, caminhao_img, usar_manual=False,caminho_BD = 'BD',
+                          template=None, exportar=True):
+    """
+    Enriquece o template da demanda, calcula a saturação e preenche as tabelas da tela.
+    template: DataFrame devolvido por input_demanda (None lê Template.xlsx)
+    exportar: grava VIAJANTE.xlsx e o log de PNs não cadastrados (False deixa para exportar_relatorios)
+    Retorna dict aba -> DataFrame (Template Completo, Saturação, Calculo Empilhamento e, se houver,
+    PN Não Cadastrados), ou None se o cálculo falhar.
+    """
 
     def split_key_logic(code):
         """
@@ -698,7 +2735,10 @@ def completar_informacoes(tree, veiculo, tree_resumo, canvas_caminhoes, caminhao
 
 
         # --- Leitura dos arquivos ---
-        template = pd.read_excel('Template.xlsx', dtype={'DESENHO': str})
+        if template is None:
+            template = pd.read_excel('Template.xlsx', dtype={'DESENHO': str})
+        else:
+            template = _preparar_template_demanda(template)
         template = template[template['QTDE'] > 0]
         
         # Filter out rows where COD FLUXO is NaN and convert to int
@@ -735,210 +2775,35 @@ def completar_informacoes(tree, veiculo, tree_resumo, canvas_caminhoes, caminhao
         if 'COD DESTINO' in template.columns:
             template['COD DESTINO'] = template['COD DESTINO'].astype(str).str.replace(r'\.0$', '', regex=True)
         
-        # Use pattern matching to find latest dated files, with fallback to non-dated versions
-        BD_PN = get_latest_file(
-            os.path.join(caminho_base, caminho_BD, "BD_CADASTRO_PN_*.xlsx"),
-            fallback=os.path.join(caminho_base, caminho_BD, "BD_CADASTRO_PN.xlsx")
-        )
-        BD_MDR = get_latest_file(
-            os.path.join(caminho_base, caminho_BD, "BD_CADASTRO_MDR_*.xlsx"),
-            fallback=os.path.join(caminho_base, caminho_BD, "BD_CADASTRO_MDR.xlsx")
-        )
-        
-        if BD_PN is None:
-            raise FileNotFoundError("BD_CADASTRO_PN file not found. Please ensure database files are available.")
-        if BD_MDR is None:
-            raise FileNotFoundError("BD_CADASTRO_MDR file not found. Please ensure database files are available.")
-        
-        VEÍCULOS = os.path.join(caminho_base,caminho_BD,"VEÍCULOS.xlsx")
-        db_empilhamento = os.path.join(caminho_base,caminho_BD,"BD_EMPILHAMENTO_EMBALAGENS.xlsx")
-        db_efi = os.path.join(caminho_base,caminho_BD,"BD_CADASTRO_MDR_PERDA_COMPRIMENTO.xlsx")
-        PN_CT_path = os.path.join(caminho_base,caminho_BD,"PN_Conta_trabalho.xlsx")
-       
-        # ------------------Working in the DB structrue------------------
-        # Use 'Int64' (nullable integer) instead of 'int' to handle NaN values in the Excel file
-        db_PN = pd.read_excel(BD_PN, sheet_name='BD', dtype={'DESENHO': str})
-        db_PN = db_PN.rename(columns={'CÓD. FORNECEDOR': 'COD FORNECEDOR'})
-        
-        # Filter for EMPRESA = 1, 10.12 (not separate 10 and 12!)
-        # Note: EMPRESA 10.12 is a single float value in the database
-        if 'EMPRESA' in db_PN.columns:
-            db_PN = db_PN[db_PN['EMPRESA'].isin([1, 1.0, 10.12])]
-        else:
-            print("[WARNING] Column 'EMPRESA' not found in BD_CADASTRO_PN")
-
-        db_MDR = pd.read_excel(BD_MDR, sheet_name='BD')
-        db_MDR = db_MDR.rename(columns={'DESCRIÇÃO2': 'DESCRIÇÃO'})
-        
-        # Filter for EMPRESA = 1, 10.12 (not separate 10 and 12!)
-        if 'EMPRESA' in db_MDR.columns:
-            db_MDR = db_MDR[db_MDR['EMPRESA'].isin([1, 1.0, 10.12])]
-        else:
-            print("[WARNING] Column 'EMPRESA' not found in BD_CADASTRO_MDR")
-
-        db_veiculos = pd.read_excel(VEÍCULOS, sheet_name='VEÍCULOS')
-
-        db_empilhamento = pd.read_excel(db_empilhamento, sheet_name='BD')
-        db_empilhamento = db_empilhamento.rename(columns={'CÓD. FORNECEDOR': 'COD FORNECEDOR'})
-
-        db_efi = pd.read_excel(db_efi,sheet_name='BD')
-        
-        # --- Load PN_Conta_trabalho for CT validation ---
-        pn_ct_lookup = set()  # Will store (FORNECEDOR, DESENHO) pairs
-        try:
-            if os.path.exists(PN_CT_path):
-                db_pn_ct = pd.read_excel(PN_CT_path)
-                # Normalize column names to find Fornecedor, Desenho, Destino
-                col_map = {}
-                for col in db_pn_ct.columns:
-                    col_upper = str(col).upper().strip()
-                    if 'FORNECEDOR' in col_upper:
-                        col_map['FORNECEDOR'] = col
-                    elif 'DESENHO' in col_upper:
-                        col_map['DESENHO'] = col
-                    elif 'DESTINO' in col_upper:
-                        col_map['DESTINO'] = col
-                
-                # Need FORNECEDOR and DESENHO columns for CT matching
-                if all(k in col_map for k in ['FORNECEDOR', 'DESENHO']):
-                    for _, row in db_pn_ct.iterrows():
-                        # Normalize to string and remove .0 from floats
-                        # CT matching uses FORNECEDOR (COD IMS) + DESENHO
-                        try:
-                            forn = str(int(float(row[col_map['FORNECEDOR']]))) if pd.notna(row[col_map['FORNECEDOR']]) else ''
-                        except (ValueError, TypeError):
-                            forn = str(row[col_map['FORNECEDOR']]).strip()
-                        
-                        try:
-                            desenho = str(int(float(row[col_map['DESENHO']]))) if pd.notna(row[col_map['DESENHO']]) else ''
-                        except (ValueError, TypeError):
-                            desenho = str(row[col_map['DESENHO']]).strip()
-                        
-                        if forn and desenho:
-                            pn_ct_lookup.add((forn, desenho))  # (FORNECEDOR/COD_IMS, DESENHO)
-                    # print(f"[INFO] Loaded {len(pn_ct_lookup)} Fornecedor-Desenho combinations from PN_Conta_trabalho.xlsx")
-                else:
-                    adicionar_erro("PN_Conta_trabalho.xlsx: Colunas esperadas não encontradas", "AVISO")
-        except Exception as e:
-            adicionar_erro(f"Erro ao carregar PN_Conta_trabalho.xlsx: {str(e)}", "AVISO")
-
-        # --- Normalização de tipos ---
-        db_PN['DESENHO ATUALIZAÇÃO'] = pd.to_datetime(db_PN['DESENHO ATUALIZAÇÃO'], errors='coerce')
-        db_MDR['VOLUME'] = pd.to_numeric(db_MDR['VOLUME'], errors='coerce')
-        db_MDR['MDR PESO'] = pd.to_numeric(db_MDR['MDR PESO'], errors='coerce')
-        db_PN['PESO (Kg) MATERIAL'] = pd.to_numeric(db_PN['PESO (Kg) MATERIAL'], errors='coerce')
-        
-        
-        
-        db_PN = db_PN.sort_values('DESENHO ATUALIZAÇÃO', ascending=False)
-        
-        # Criar chave composta DESENHO+MDR em db_PN
-        db_PN['KEY'] = db_PN['DESENHO'].astype(str) + '_' + db_PN['MDR'].astype(str)
-
-        # --- Mapeamentos únicos para .map() seguros ---
-        # Filter out nan values and keep most recent entries for db_PN mappings
-        mapa_fornecedores = db_PN.drop_duplicates('COD FORNECEDOR').set_index('COD FORNECEDOR')['FORNECEDOR']
-
-        # Mapas baseados na chave composta - already sorted by DESENHO ATUALIZAÇÃO descending
-        # This ensures we always get the most recent non-null values
-        # Create composite key mappings for DESCRIÇÃO (COD FORNECEDOR + KEY where KEY = DESENHO + MDR)
-        db_PN_valid_desc = db_PN[db_PN['DESCRIÇÃO'].notna()].copy()
-        db_PN_valid_desc['FORNECEDOR_CHAVE'] = db_PN_valid_desc['COD FORNECEDOR'].apply(_codigo_principal)
-        db_PN_valid_desc['DESC_PN_KEY'] = ''
-        desc_pn_key_mask = db_PN_valid_desc['FORNECEDOR_CHAVE'].ne('') & db_PN_valid_desc['KEY'].notna()
-        db_PN_valid_desc.loc[desc_pn_key_mask, 'DESC_PN_KEY'] = (
-            db_PN_valid_desc.loc[desc_pn_key_mask, 'FORNECEDOR_CHAVE'].astype(str)
-            + '|'
-            + db_PN_valid_desc.loc[desc_pn_key_mask, 'KEY'].astype(str)
-        )
-        mapa_pn = db_PN_valid_desc[db_PN_valid_desc['DESC_PN_KEY'] != ''].drop_duplicates('DESC_PN_KEY', keep='first').set_index('DESC_PN_KEY')['DESCRIÇÃO']
-        mapa_pn_fallback = db_PN_valid_desc.drop_duplicates('KEY', keep='first').set_index('KEY')['DESCRIÇÃO']
-        
-        mapa_mdr = db_PN.drop_duplicates('KEY', keep='first').set_index('KEY')['MDR']
-        
-        # For QME and PESO, filter out invalid values before mapping
-        # Create composite key mappings for QME (COD FORNECEDOR + KEY where KEY = DESENHO + MDR)
-        db_PN_valid_qme = db_PN[db_PN['QME'].notna() & (db_PN['QME'] > 0)].copy()
-        db_PN_valid_qme['FORNECEDOR_CHAVE'] = db_PN_valid_qme['COD FORNECEDOR'].apply(_codigo_principal)
-        db_PN_valid_qme['QME_KEY'] = ''
-        qme_key_mask = db_PN_valid_qme['FORNECEDOR_CHAVE'].ne('') & db_PN_valid_qme['KEY'].notna()
-        db_PN_valid_qme.loc[qme_key_mask, 'QME_KEY'] = (
-            db_PN_valid_qme.loc[qme_key_mask, 'FORNECEDOR_CHAVE'].astype(str)
-            + '|'
-            + db_PN_valid_qme.loc[qme_key_mask, 'KEY'].astype(str)
-        )
-        mapa_qme = db_PN_valid_qme[db_PN_valid_qme['QME_KEY'] != ''].drop_duplicates('QME_KEY', keep='first').set_index('QME_KEY')['QME']
-        mapa_qme_fallback = db_PN_valid_qme.drop_duplicates('KEY', keep='first').set_index('KEY')['QME']
-        
-        # Create composite key mappings for PESO (COD FORNECEDOR + KEY where KEY = DESENHO + MDR)
-        db_PN_valid_peso = db_PN[db_PN['PESO (Kg) MATERIAL'].notna()].copy()
-        db_PN_valid_peso['FORNECEDOR_CHAVE'] = db_PN_valid_peso['COD FORNECEDOR'].apply(_codigo_principal)
-        db_PN_valid_peso['PESO_PN_KEY'] = ''
-        peso_pn_key_mask = db_PN_valid_peso['FORNECEDOR_CHAVE'].ne('') & db_PN_valid_peso['KEY'].notna()
-        db_PN_valid_peso.loc[peso_pn_key_mask, 'PESO_PN_KEY'] = (
-            db_PN_valid_peso.loc[peso_pn_key_mask, 'FORNECEDOR_CHAVE'].astype(str)
-            + '|'
-            + db_PN_valid_peso.loc[peso_pn_key_mask, 'KEY'].astype(str)
-        )
-        mapa_peso_pn = db_PN_valid_peso[db_PN_valid_peso['PESO_PN_KEY'] != ''].drop_duplicates('PESO_PN_KEY', keep='first').set_index('PESO_PN_KEY')['PESO (Kg) MATERIAL']
-        mapa_peso_pn_fallback = db_PN_valid_peso.drop_duplicates('KEY', keep='first').set_index('KEY')['PESO (Kg) MATERIAL']
-
-        # Mapas vindos do db_MDR - filter out nan values BEFORE creating mappings
-        # Get the correct column name for FORNECEDOR
-        coluna_fornecedor_mdr = 'CÓD. FORNECEDOR' if 'CÓD. FORNECEDOR' in db_MDR.columns else ('COD FORNECEDOR' if 'COD FORNECEDOR' in db_MDR.columns else None)
-        
-        # Create composite key mappings for DESCRIÇÃO (COD FORNECEDOR + MDR)
-        db_MDR_valid_desc = db_MDR[db_MDR['DESCRIÇÃO'].notna()].copy()
-        db_MDR_valid_desc['MDR_CHAVE'] = db_MDR_valid_desc['MDR'].apply(_mdr_chave)
-        if coluna_fornecedor_mdr is not None:
-            db_MDR_valid_desc['FORNECEDOR_CHAVE'] = db_MDR_valid_desc[coluna_fornecedor_mdr].apply(_codigo_principal)
-            db_MDR_valid_desc['DESC_KEY'] = ''
-            desc_key_mask = db_MDR_valid_desc['FORNECEDOR_CHAVE'].ne('') & db_MDR_valid_desc['MDR_CHAVE'].ne('')
-            db_MDR_valid_desc.loc[desc_key_mask, 'DESC_KEY'] = (
-                db_MDR_valid_desc.loc[desc_key_mask, 'FORNECEDOR_CHAVE']
-                + '|'
-                + db_MDR_valid_desc.loc[desc_key_mask, 'MDR_CHAVE']
-            )
-            mapa_descricao_mdr = db_MDR_valid_desc[db_MDR_valid_desc['DESC_KEY'] != ''].drop_duplicates('DESC_KEY', keep='first').set_index('DESC_KEY')['DESCRIÇÃO']
-        else:
-            mapa_descricao_mdr = pd.Series(dtype=str)
-        mapa_descricao_mdr_fallback = db_MDR_valid_desc.drop_duplicates('MDR_CHAVE', keep='first').set_index('MDR_CHAVE')['DESCRIÇÃO']
-        
-        # Create composite key mappings for VOLUME (COD FORNECEDOR + MDR)
-        db_MDR_valid_volume = db_MDR[db_MDR['VOLUME'].notna()].copy()
-        db_MDR_valid_volume['MDR_CHAVE'] = db_MDR_valid_volume['MDR'].apply(_mdr_chave)
-        if coluna_fornecedor_mdr is not None:
-            db_MDR_valid_volume['FORNECEDOR_CHAVE'] = db_MDR_valid_volume[coluna_fornecedor_mdr].apply(_codigo_principal)
-            db_MDR_valid_volume['VOLUME_KEY'] = ''
-            volume_key_mask = db_MDR_valid_volume['FORNECEDOR_CHAVE'].ne('') & db_MDR_valid_volume['MDR_CHAVE'].ne('')
-            db_MDR_valid_volume.loc[volume_key_mask, 'VOLUME_KEY'] = (
-                db_MDR_valid_volume.loc[volume_key_mask, 'FORNECEDOR_CHAVE']
-                + '|'
-                + db_MDR_valid_volume.loc[volume_key_mask, 'MDR_CHAVE']
-            )
-            mapa_volume = db_MDR_valid_volume[db_MDR_valid_volume['VOLUME_KEY'] != ''].drop_duplicates('VOLUME_KEY', keep='first').set_index('VOLUME_KEY')['VOLUME']
-        else:
-            mapa_volume = pd.Series(dtype=float)
-        mapa_volume_mdr = db_MDR_valid_volume.drop_duplicates('MDR_CHAVE', keep='first').set_index('MDR_CHAVE')['VOLUME']
-        
-        # Create composite key mappings for MDR PESO (COD FORNECEDOR + MDR)
-        db_MDR_valid_peso = db_MDR[db_MDR['MDR PESO'].notna()].copy()
-        db_MDR_valid_peso['MDR_CHAVE'] = db_MDR_valid_peso['MDR'].apply(_mdr_chave)
-        if coluna_fornecedor_mdr is not None:
-            db_MDR_valid_peso['FORNECEDOR_CHAVE'] = db_MDR_valid_peso[coluna_fornecedor_mdr].apply(_codigo_principal)
-            db_MDR_valid_peso['PESO_KEY'] = ''
-            peso_key_mask = db_MDR_valid_peso['FORNECEDOR_CHAVE'].ne('') & db_MDR_valid_peso['MDR_CHAVE'].ne('')
-            db_MDR_valid_peso.loc[peso_key_mask, 'PESO_KEY'] = (
-                db_MDR_valid_peso.loc[peso_key_mask, 'FORNECEDOR_CHAVE']
-                + '|'
-                + db_MDR_valid_peso.loc[peso_key_mask, 'MDR_CHAVE']
-            )
-            mapa_peso_mdr = db_MDR_valid_peso[db_MDR_valid_peso['PESO_KEY'] != ''].drop_duplicates('PESO_KEY', keep='first').set_index('PESO_KEY')['MDR PESO']
-        else:
-            mapa_peso_mdr = pd.Series(dtype=float)
-        mapa_peso_mdr_fallback = db_MDR_valid_peso.drop_duplicates('MDR_CHAVE', keep='first').set_index('MDR_CHAVE')['MDR PESO']
-        
-        mapa_peso_max = db_veiculos.set_index('COD VEICULO')['PESO MAXIMO']
+        # Registros do BD (normalizados) e mapas de lookup: lidos no primeiro cálculo e reaproveitados
+        # em memória enquanto os arquivos não mudarem
+        referencias = carregar_referencias(caminho_BD)
+        for mensagem, tipo in referencias["avisos"]:
+            adicionar_erro(mensagem, tipo)
+
+        # Cópias: o cálculo abaixo altera as tabelas (ex.: MDR em caixa alta)
+        db_MDR = referencias["db_MDR"].copy()
+        db_veiculos = referencias["db_veiculos"].copy()
+        db_empilhamento = referencias["db_empilhamento"].copy()
+        db_efi = referencias["db_efi"]
+        pn_ct_lookup = referencias["pn_ct_lookup"]
+
+        mapas = referencias["mapas"]
+        mapa_fornecedores = mapas["mapa_fornecedores"]
+        mapa_pn = mapas["mapa_pn"]
+        mapa_pn_fallback = mapas["mapa_pn_fallback"]
+        mapa_mdr = mapas["mapa_mdr"]
+        mapa_qme = mapas["mapa_qme"]
+        mapa_qme_fallback = mapas["mapa_qme_fallback"]
+        mapa_peso_pn = mapas["mapa_peso_pn"]
+        mapa_peso_pn_fallback = mapas["mapa_peso_pn_fallback"]
+        mapa_descricao_mdr = mapas["mapa_descricao_mdr"]
+        mapa_descricao_mdr_fallback = mapas["mapa_descricao_mdr_fallback"]
+        mapa_volume = mapas["mapa_volume"]
+        mapa_volume_mdr = mapas["mapa_volume_mdr"]
+        mapa_peso_mdr = mapas["mapa_peso_mdr"]
+        mapa_peso_mdr_fallback = mapas["mapa_peso_mdr_fallback"]
+        mapa_peso_max = mapas["mapa_peso_max"]
 
         # keep template VEICULO as-is here; Template.xlsx will be
         # updated by input_demanda() when the user forces manual vehicle.
@@ -947,11 +2812,7 @@ def completar_informacoes(tree, veiculo, tree_resumo, canvas_caminhoes, caminhao
 
         # Passo 1: primeiro trazer MDR pelo DESENHO, para podermos montar a KEY
         # Filter out nan MDR values and use most recent (already sorted by DESENHO ATUALIZAÇÃO)
-        db_PN_valid_mdr = db_PN[db_PN['MDR'].notna()]
-        
-        template['MDR'] = template['DESENHO'].map(
-            db_PN_valid_mdr.drop_duplicates('DESENHO', keep='first').set_index('DESENHO')['MDR']
-        )
+        template['MDR'] = template['DESENHO'].map(mapas["mapa_mdr_desenho"])
         
         # Track PNs not found in BD_CADASTRO_PN (no MDR means PN not registered)
         template['PN_NOT_FOUND'] = template['MDR'].isna() | (template['MDR'].astype(str).str.strip() == '')
@@ -977,77 +2838,28 @@ def completar_informacoes(tree, veiculo, tree_resumo, canvas_caminhoes, caminhao
        
         template = template.drop(columns=['MAP_KEY'])
        
+        # Candidatos de cada linha (todos os COD IMS ou, na falta deles, o COD FORNECEDOR): explodidos
+        # uma vez e reaproveitados por todos os resolvers abaixo
+        candidatos = _candidatos_resolucao(template['COD IMS'], template['COD FORNECEDOR'])
+        chaves_key = _mapear_valores_unicos(template['KEY'], lambda key: str(key) if str(key).strip() else '')
+
         # Use COD IMS + KEY as the primary descrição material key, trying every IMS code before
         # falling back to COD FORNECEDOR and, if needed, KEY-only.
-        def resolver_descricao_material(row):
-            key = row.get('KEY')
-            if pd.isna(key) or str(key).strip() == '':
-                return np.nan
-            
-            candidatos = _normalizar_codigos_campo(row.get('COD IMS'))
-
-            if not candidatos:
-                candidatos = _normalizar_codigos_campo(row.get('COD FORNECEDOR'))
-
-            for codigo in candidatos:
-                codigo_chave = _codigo_principal(codigo)
-                if codigo_chave:
-                    chave_completa = f"{codigo_chave}|{key}"
-                    descricao = mapa_pn.get(chave_completa, np.nan)
-                    if pd.notna(descricao):
-                        return descricao
-
-            descricao_fallback = mapa_pn_fallback.get(key, np.nan)
-            return descricao_fallback
-
-        template['DESCRIÇÃO MATERIAL'] = template.apply(resolver_descricao_material, axis=1)
+        template['DESCRIÇÃO MATERIAL'], _ = _resolver_por_candidatos(
+            template.index, candidatos, chaves_key, mapa_pn, mapa_pn_fallback, exige_sufixo=True)
         template['MDR'] = template['KEY'].map(mapa_mdr)  # reforça MDR correto do KEY
         
+        chaves_mdr = _mapear_valores_unicos(template['MDR'], _mdr_chave)
+
         # Use COD IMS + MDR as the primary descrição key, trying every IMS code before
         # falling back to COD FORNECEDOR and, if needed, MDR-only.
-        def resolver_descricao(row):
-            mdr_chave = _mdr_chave(row.get('MDR'))
-            candidatos = _normalizar_codigos_campo(row.get('COD IMS'))
-
-            if not candidatos:
-                candidatos = _normalizar_codigos_campo(row.get('COD FORNECEDOR'))
-
-            for codigo in candidatos:
-                chave = _chave_fornecedor_mdr(codigo, mdr_chave)
-                if chave:
-                    descricao = mapa_descricao_mdr.get(chave, np.nan)
-                    if pd.notna(descricao):
-                        return descricao
-
-            descricao_fallback = mapa_descricao_mdr_fallback.get(mdr_chave, np.nan)
-            return descricao_fallback
-
-        template['DESCRIÇÃO DA EMBALAGEM'] = template.apply(resolver_descricao, axis=1)
+        template['DESCRIÇÃO DA EMBALAGEM'], _ = _resolver_por_candidatos(
+            template.index, candidatos, chaves_mdr, mapa_descricao_mdr, mapa_descricao_mdr_fallback)
         
         # Use COD IMS + KEY as the primary QME key, trying every IMS code before
         # falling back to COD FORNECEDOR and, if needed, KEY-only.
-        def resolver_qme(row):
-            key = row.get('KEY')
-            if pd.isna(key) or str(key).strip() == '':
-                return np.nan
-            
-            candidatos = _normalizar_codigos_campo(row.get('COD IMS'))
-
-            if not candidatos:
-                candidatos = _normalizar_codigos_campo(row.get('COD FORNECEDOR'))
-
-            for codigo in candidatos:
-                codigo_chave = _codigo_principal(codigo)
-                if codigo_chave:
-                    chave_completa = f"{codigo_chave}|{key}"
-                    qme = mapa_qme.get(chave_completa, np.nan)
-                    if pd.notna(qme):
-                        return qme
-
-            qme_fallback = mapa_qme_fallback.get(key, np.nan)
-            return qme_fallback
-
-        template['QME'] = template.apply(resolver_qme, axis=1)
+        template['QME'], _ = _resolver_por_candidatos(
+            template.index, candidatos, chaves_key, mapa_qme, mapa_qme_fallback, exige_sufixo=True)
 
         # Ensure QME is valid (not zero, not NaN) before division
         # template['QME'] = template['QME'].fillna(1)  # Replace NaN with 1 to avoid division issues
@@ -1070,24 +2882,9 @@ def completar_informacoes(tree, veiculo, tree_resumo, canvas_caminhoes, caminhao
 
         # Use COD IMS + MDR as the primary volume key, trying every IMS code before
         # falling back to COD FORNECEDOR and, if needed, MDR-only.
-        def resolver_volume(row):
-            mdr_chave = _mdr_chave(row.get('MDR'))
-            candidatos = _normalizar_codigos_campo(row.get('COD IMS'))
-
-            if not candidatos:
-                candidatos = _normalizar_codigos_campo(row.get('COD FORNECEDOR'))
-
-            for codigo in candidatos:
-                chave = _chave_fornecedor_mdr(codigo, mdr_chave)
-                if chave:
-                    volume = mapa_volume.get(chave, np.nan)
-                    if pd.notna(volume):
-                        return pd.Series({'VOLUME_UNITARIO': volume, 'VOLUME_KEY': chave})
-
-            volume_fallback = mapa_volume_mdr.get(mdr_chave, np.nan)
-            return pd.Series({'VOLUME_UNITARIO': volume_fallback, 'VOLUME_KEY': ''})
-
-        volume_info = template.apply(resolver_volume, axis=1)
+        volume_unitario, volume_chave = _resolver_por_candidatos(
+            template.index, candidatos, chaves_mdr, mapa_volume, mapa_volume_mdr)
+        volume_info = pd.DataFrame({'VOLUME_UNITARIO': volume_unitario, 'VOLUME_KEY': volume_chave})
         
         # Handle empty volume_info (when template is empty)
         if volume_info.empty or 'VOLUME_UNITARIO' not in volume_info.columns:
@@ -1106,50 +2903,14 @@ def completar_informacoes(tree, veiculo, tree_resumo, canvas_caminhoes, caminhao
         
         # Use COD IMS + KEY as the primary peso material key, trying every IMS code before
         # falling back to COD FORNECEDOR and, if needed, KEY-only.
-        def resolver_peso_material(row):
-            key = row.get('KEY')
-            if pd.isna(key) or str(key).strip() == '':
-                return np.nan
-            
-            candidatos = _normalizar_codigos_campo(row.get('COD IMS'))
-
-            if not candidatos:
-                candidatos = _normalizar_codigos_campo(row.get('COD FORNECEDOR'))
-
-            for codigo in candidatos:
-                codigo_chave = _codigo_principal(codigo)
-                if codigo_chave:
-                    chave_completa = f"{codigo_chave}|{key}"
-                    peso = mapa_peso_pn.get(chave_completa, np.nan)
-                    if pd.notna(peso):
-                        return peso
-
-            peso_fallback = mapa_peso_pn_fallback.get(key, np.nan)
-            return peso_fallback
-
-        peso_material_unitario = template.apply(resolver_peso_material, axis=1)
+        peso_material_unitario, _ = _resolver_por_candidatos(
+            template.index, candidatos, chaves_key, mapa_peso_pn, mapa_peso_pn_fallback, exige_sufixo=True)
         template['PESO MAT'] = round(template['QTDE'] * peso_material_unitario, 1)
         
         # Use COD IMS + MDR as the primary peso key, trying every IMS code before
         # falling back to COD FORNECEDOR and, if needed, MDR-only.
-        def resolver_peso_mdr(row):
-            mdr_chave = _mdr_chave(row.get('MDR'))
-            candidatos = _normalizar_codigos_campo(row.get('COD IMS'))
-
-            if not candidatos:
-                candidatos = _normalizar_codigos_campo(row.get('COD FORNECEDOR'))
-
-            for codigo in candidatos:
-                chave = _chave_fornecedor_mdr(codigo, mdr_chave)
-                if chave:
-                    peso = mapa_peso_mdr.get(chave, np.nan)
-                    if pd.notna(peso):
-                        return peso
-
-            peso_fallback = mapa_peso_mdr_fallback.get(mdr_chave, np.nan)
-            return peso_fallback
-
-        peso_mdr_por_embalagem = template.apply(resolver_peso_mdr, axis=1)
+        peso_mdr_por_embalagem, _ = _resolver_por_candidatos(
+            template.index, candidatos, chaves_mdr, mapa_peso_mdr, mapa_peso_mdr_fallback)
         template['PESO MDR'] = round(template['QTD EMBALAGENS'] * peso_mdr_por_embalagem, 1)
         
         # Garante que NaN e infinitos sejam tratados como 0 antes de somar
@@ -1255,95 +3016,18 @@ def completar_informacoes(tree, veiculo, tree_resumo, canvas_caminhoes, caminhao
         template['INCLUDE_IN_CALC'] = True  # Default: include all
         
         if 'MOT' in template.columns and len(pn_ct_lookup) > 0:
-            ct_excluded_count = 0
-            ct_included_count = 0
-            ftl_excluded_count = 0
-            ftl_included_count = 0
-            
-            # Group by (COD FORNECEDOR, COD DESTINO, MOT)
-            for (cod_forn, dest, mot), group in template.groupby(['COD FORNECEDOR', 'COD DESTINO', 'MOT']):
-                mot_upper = str(mot).strip().upper() if pd.notna(mot) else ''
-                
-                if mot_upper == 'CT':
-                    # For CT rows, check if (COD_IMS, DESENHO) exists in pn_ct_lookup
-                    # Include only if found in PN_Conta_trabalho
-                    for idx, row in group.iterrows():
-                        # Get COD IMS for lookup (this is the Fornecedor in PN_Conta_trabalho)
-                        cod_ims = row.get('COD IMS', None)
-                        try:
-                            cod_ims_str = str(int(float(cod_ims))) if pd.notna(cod_ims) else ''
-                        except (ValueError, TypeError):
-                            cod_ims_str = str(cod_ims).strip() if cod_ims else ''
-                        
-                        # Skip CT filtering if no COD IMS (include by default)
-                        if not cod_ims_str:
-                            ct_included_count += 1
-                            continue
-                        
-                        try:
-                            desenho_val = row['DESENHO']
-                            desenho_str = str(int(float(desenho_val))) if pd.notna(desenho_val) else ''
-                        except (ValueError, TypeError):
-                            desenho_str = str(desenho_val).strip() if pd.notna(desenho_val) else ''
-                        
-                        # Handle compound COD IMS (e.g., "24149/36190")
-                        # Check if ANY part of the compound IMS matches in the CT lookup
-                        cod_ims_parts = [p.strip() for p in cod_ims_str.split('/')]
-                        
-                        is_in_ct = False
-                        for ims_part in cod_ims_parts:
-                            key = (ims_part, desenho_str)  # (COD_IMS_PART, DESENHO)
-                            if key in pn_ct_lookup:
-                                is_in_ct = True
-                                break
-                        
-                        if not is_in_ct:
-                            # PN not in CT file, exclude from CT calculation
-                            template.at[idx, 'INCLUDE_IN_CALC'] = False
-                            ct_excluded_count += 1
-                        else:
-                            ct_included_count += 1
-                
-                elif mot_upper in ['FTL', 'LTL']:
-                    # For FTL/LTL rows, EXCLUDE if (COD_IMS, DESENHO) exists in pn_ct_lookup
-                    # This prevents CT PNs from appearing in FTL for the same COD IMS
-                    for idx, row in group.iterrows():
-                        # Get COD IMS for lookup
-                        cod_ims = row.get('COD IMS', None)
-                        try:
-                            cod_ims_str = str(int(float(cod_ims))) if pd.notna(cod_ims) else ''
-                        except (ValueError, TypeError):
-                            cod_ims_str = str(cod_ims).strip() if cod_ims else ''
-                        
-                        # Skip CT filtering if no COD IMS (include by default)
-                        if not cod_ims_str:
-                            ftl_included_count += 1
-                            continue
-                        
-                        try:
-                            desenho_val = row['DESENHO']
-                            desenho_str = str(int(float(desenho_val))) if pd.notna(desenho_val) else ''
-                        except (ValueError, TypeError):
-                            desenho_str = str(desenho_val).strip() if pd.notna(desenho_val) else ''
-                        
-                        # Handle compound COD IMS (e.g., "24149/36190")
-                        # Check if ANY part of the compound IMS matches in the CT lookup
-                        cod_ims_parts = [p.strip() for p in cod_ims_str.split('/')]
-                        
-                        is_in_ct = False
-                        for ims_part in cod_ims_parts:
-                            key = (ims_part, desenho_str)  # (COD_IMS_PART, DESENHO)
-                            if key in pn_ct_lookup:
-                                is_in_ct = True
-                                break
-                        
-                        if is_in_ct:
-                            # PN is in CT file for this COD IMS, so exclude from FTL calculation
-                            template.at[idx, 'INCLUDE_IN_CALC'] = False
-                            ftl_excluded_count += 1
-                        else:
-                            ftl_included_count += 1
-                # Else: MOT is NaN or other value - skip CT filtering (include by default)
+            # Only rows with COD FORNECEDOR, COD DESTINO and MOT filled are evaluated (the rule used to
+            # run over groupby(['COD FORNECEDOR', 'COD DESTINO', 'MOT']), which drops null keys)
+            chaves_validas = template[['COD FORNECEDOR', 'COD DESTINO', 'MOT']].notna().all(axis=1)
+            ct_regra = _avaliar_conta_trabalho(template['COD IMS'], template['DESENHO'],
+                                               template['MOT'].where(chaves_validas), pn_ct_lookup)
+            template['INCLUDE_IN_CALC'] = ct_regra['incluir']
+
+            # CT: included if no COD IMS or found in PN_Conta_trabalho; FTL/LTL: excluded if found
+            ct_excluded_count = int((ct_regra['ct'] & ~ct_regra['sem_ims'] & ~ct_regra['no_ct']).sum())
+            ct_included_count = int(ct_regra['ct'].sum()) - ct_excluded_count
+            ftl_excluded_count = int((ct_regra['ftl'] & ~ct_regra['sem_ims'] & ct_regra['no_ct']).sum())
+            ftl_included_count = int(ct_regra['ftl'].sum()) - ftl_excluded_count
             
             if ct_excluded_count > 0:
                 adicionar_erro(f"{ct_excluded_count} PN(s) com MOT=CT excluídos (não encontrados em PN_Conta_trabalho)", "INFO")
@@ -1376,20 +3060,8 @@ def completar_informacoes(tree, veiculo, tree_resumo, canvas_caminhoes, caminhao
             .rename(columns={'MDR': 'EMBALAGEM', 'QTD EMBALAGENS': 'TOTAL DE CXS'})
         )
 
-        # Create mappings from db_MDR - filter out NaN values before deduplication
-        # to ensure we don't get empty/null values when valid values exist
-        db_MDR_valid_paletizavel = db_MDR[db_MDR['CAIXA PLÁSTICA'].notna()]
-        mapa_paletizavel = db_MDR_valid_paletizavel.drop_duplicates('MDR').set_index('MDR')['CAIXA PLÁSTICA']
-        
-        # For CAIXAS POR PALLET, filter out NaN and use the most common value (mode)
-        # This prevents picking the first row if it has NaN when other rows have valid values
-        db_MDR_valid_cxs = db_MDR[db_MDR['CAIXAS POR PALLET'].notna()]
-        
-        # Group by MDR and take the mode (most common value) for CAIXAS POR PALLET
-        # If multiple modes exist, take the first one
-        mapa_cxs_por_pallet = db_MDR_valid_cxs.groupby('MDR')['CAIXAS POR PALLET'].agg(
-            lambda x: x.mode()[0] if not x.mode().empty else x.iloc[0]
-        )
+        mapa_paletizavel = mapas["mapa_paletizavel"]
+        mapa_cxs_por_pallet = mapas["mapa_cxs_por_pallet"]
 
         df_saturacao['CX_PALETIZÁVEL'] = df_saturacao['EMBALAGEM'].map(mapa_paletizavel).fillna(0).astype(int)
         df_saturacao['CXS_POR_PALLET'] = df_saturacao.apply(
@@ -1400,7 +3072,7 @@ def completar_informacoes(tree, veiculo, tree_resumo, canvas_caminhoes, caminhao
         df_saturacao['CXS/PALLETS_TOTAL'] = df_saturacao['TOTAL DE CXS'] / df_saturacao['CXS_POR_PALLET']
 
         # Mapeia de código do veículo (ex: 4) -> coluna de capacidade no db_MDR (ex: "14 x 2,4 x 2,78")
-        mapa_coluna_capacidade = db_veiculos.set_index('COD VEICULO')['VEICULOS'].to_dict()
+        mapa_coluna_capacidade = mapas["mapa_coluna_capacidade"]
         
         # --- Vehicle configuration handling ---
         # If usar_manual=True: use global vehicle for all calculations
@@ -1424,138 +3096,21 @@ def completar_informacoes(tree, veiculo, tree_resumo, canvas_caminhoes, caminhao
         # Garante que os MDRs na base estejam em caixa alta
         db_MDR['MDR'] = db_MDR['MDR'].astype(str).str.upper()
 
-        def obter_veiculo_anterior(cod_veic):
-            if cod_veic in [4, 5, 6, 7, 8, 9, 14]:
-                return 3
-            elif cod_veic in [2, 3, 12, 13, 15, 16, 17, 18]:
-                return 1
-            elif cod_veic == 1:
-                return 10
-            elif cod_veic == 10:
-                return 11
-            elif cod_veic == 11:
-                return 11
-            return None
-
-        def obter_capacidade_por_linha(row):
-            try:
-                mdr = str(row['EMBALAGEM']).upper()
-                cod_veic = row['VEICULO']
-                fornecedor = row['COD FORNECEDOR']
-                coluna = mapa_coluna_capacidade.get(cod_veic)
-
-                if not coluna or not isinstance(coluna, str):
-                    return np.nan
-                if coluna not in db_MDR.columns:
-                    return np.nan
-
-                # Try supplier-specific lookup first
-                supplier_codes = [fornecedor]
-                
-                # Use exact matching
-                filtro_fornecedor = (db_MDR['MDR'] == mdr) & (db_MDR['CÓD. FORNECEDOR'].isin(supplier_codes))
-                capacidade_data_forn = db_MDR.loc[filtro_fornecedor, coluna]
-                
-                # Ensure we got a Series
-                if isinstance(capacidade_data_forn, pd.DataFrame):
-                    return np.nan
-                    
-                capacidade_series_forn = capacidade_data_forn.dropna()
-                
-                if not capacidade_series_forn.empty:
-                    # Found supplier-specific capacity - use HYBRID approach
-                    capacity_mean = float(capacidade_series_forn.mean())
-                    capacity_min = float(capacidade_series_forn.min())
-                    capacity_max = float(capacidade_series_forn.max())
-                    mode_result = capacidade_series_forn.mode()
-                    capacity_mode = float(mode_result.iloc[0]) if not mode_result.empty else capacity_mean
-                    
-                    # Hybrid: Use MODE if high variance, otherwise MAX
-                    variance = capacity_max - capacity_min
-                    if variance > capacity_mode * 0.5:
-                        return capacity_mode
-                    else:
-                        return capacity_max
-                
-                # Fall back to all suppliers for this MDR, use MAX
-                filtro = db_MDR['MDR'] == mdr
-                capacidade_data = db_MDR.loc[filtro, coluna]
-                
-                # Ensure we got a Series
-                if isinstance(capacidade_data, pd.DataFrame):
-                    return np.nan
-                    
-                capacidade_series = capacidade_data.dropna()
-
-                if capacidade_series.empty:
-                    return np.nan
-
-                # Use MAX approach
-                capacity_mean = float(capacidade_series.mean())
-                capacity_min = float(capacidade_series.min())
-                capacity_max = float(capacidade_series.max())
-                mode_result = capacidade_series.mode()
-                capacity_mode = float(mode_result.iloc[0]) if not mode_result.empty else capacity_mean
-                
-                return capacity_max
-                
-            except Exception as e:
-                print(f"[WARNING] Error in obter_capacidade_por_linha: {e}")
-                return np.nan
-
-        def obter_capacidade_por_linha_veic_anterior(row):
-            try:
-                mdr = str(row['EMBALAGEM']).upper()
-                cod_veic = int(row['VEICULO'])
-                veic_anterior = obter_veiculo_anterior(cod_veic)
-               
-                if veic_anterior is None:
-                    return np.nan
-
-                coluna = mapa_coluna_capacidade.get(veic_anterior)
-
-                if not coluna or not isinstance(coluna, str):
-                    return np.nan
-                
-                if coluna not in db_MDR.columns:
-                    return np.nan
-
-                # Use exact match to avoid str.contains issues
-                filtro = db_MDR['MDR'] == mdr
-                
-                # Ensure we're selecting a single column (string selector)
-                capacidade_data = db_MDR.loc[filtro, coluna]
-                
-                # If we got a DataFrame instead of Series, something is wrong
-                if isinstance(capacidade_data, pd.DataFrame):
-                    return np.nan
-                
-                # Now we have a Series, drop NaN values
-                capacidade_series = capacidade_data.dropna()
-
-                if capacidade_series.empty:
-                    return np.nan
-
-                # Get first value and ensure it's a scalar
-                valor = capacidade_series.iloc[0]
-                
-                # Convert to float, return NaN if fails
-                return float(valor) if pd.notna(valor) else np.nan
-                
-            except Exception as e:
-                # Log error but don't crash
-                print(f"[WARNING] Error in obter_capacidade_por_linha_veic_anterior: {e}")
-                return np.nan
-
-        df_saturacao['CAPACIDADE'] = df_saturacao.apply(obter_capacidade_por_linha, axis=1)
+        # Capacidade pela tabela pré-calculada com o registro (regra híbrida do fornecedor, senão o MÁX do MDR)
+        df_saturacao['CAPACIDADE'] = _capacidade_por_linha(df_saturacao, referencias["capacidades"],
+                                                           mapa_coluna_capacidade)
         df_saturacao['VEICULO'] = df_saturacao['VEICULO'].fillna(0)
         df_saturacao['VEICULO'] = df_saturacao['VEICULO'].astype(int)         
-        df_saturacao['CAPACIDADE_VEIC_ANTERIOR'] = df_saturacao.apply(obter_capacidade_por_linha_veic_anterior, axis=1)
+        # Capacidade de cada linha em todos os veículos de uma vez (matriz MDR x veículo do registro)
+        matriz_capacidades = referencias["matriz_capacidades"]
+        capacidades_veiculos = _capacidades_da_matriz(matriz_capacidades,
+                                                      df_saturacao['EMBALAGEM'].astype(str).str.upper())
+        df_saturacao['CAPACIDADE_VEIC_ANTERIOR'] = _capacidades_da_matriz(
+            matriz_capacidades, df_saturacao['EMBALAGEM'].astype(str).str.upper(),
+            df_saturacao['VEICULO'].map(VEICULO_MENOR))
 
-       
         # Converte para numérico, tratando valores não numéricos
         df_saturacao['CAPACIDADE'] = pd.to_numeric(df_saturacao['CAPACIDADE'], errors='coerce')
-        df_saturacao['CAPACIDADE_VEIC_ANTERIOR'] = pd.to_numeric(df_saturacao['CAPACIDADE_VEIC_ANTERIOR'], errors='coerce')
         df_saturacao['CXS/PALLETS_TOTAL'] = pd.to_numeric(df_saturacao['CXS/PALLETS_TOTAL'], errors='coerce')
         
         # Calcula saturação apenas onde CAPACIDADE_VEIC_ANTERIOR não é nulo/zero
@@ -1565,6 +3120,22 @@ def completar_informacoes(tree, veiculo, tree_resumo, canvas_caminhoes, caminhao
             df_saturacao.loc[mask, 'CXS/PALLETS_TOTAL'] / df_saturacao.loc[mask, 'CAPACIDADE_VEIC_ANTERIOR'] * 100, 2
         )
 
+        # Escada de veículos menores e saturação em cada veículo cadastrado no db_MDR (0 sem capacidade)
+        df_saturacao['ESCADA DE VEÍCULOS'] = [
+            ' > '.join(str(cod) for cod in escada_veiculos(cod_veic)) for cod_veic in df_saturacao['VEICULO']]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            saturacoes = np.where(
+                capacidades_veiculos > 0,
+                np.round(df_saturacao['CXS/PALLETS_TOTAL'].to_numpy(dtype=float)[:, None] / capacidades_veiculos * 100, 2),
+                0.0,
+            )
+        colunas_saturacao = {}
+        for posicao, cod_veic in enumerate(matriz_capacidades.columns):
+            nome = f"SATURAÇÃO {mapa_coluna_capacidade.get(cod_veic)} (%)"
+            if matriz_capacidades[cod_veic].notna().any() and nome not in colunas_saturacao:
+                colunas_saturacao[nome] = saturacoes[:, posicao]
+        df_saturacao = pd.concat([df_saturacao, pd.DataFrame(colunas_saturacao, index=df_saturacao.index)], axis=1)
+
         bases = set(zip(db_empilhamento['FORNECEDOR'], db_empilhamento['MDR BASE']))
         sobrepostas = set(zip(db_empilhamento['FORNECEDOR'], db_empilhamento['MDR SOBREPOSTA']))
         df_saturacao['EMBALAGEM_BASE'] = df_saturacao.apply(
@@ -1576,38 +3147,15 @@ def completar_informacoes(tree, veiculo, tree_resumo, canvas_caminhoes, caminhao
 
 
         # --- Eficiência de empilhamento por embalagem ---
-        # When usar_manual=False, we need to handle multiple vehicles (per-row lookup)
-        # When usar_manual=True, we can use a single global vehicle column
+        # Coluna do veículo global (usar_manual=True) ou do veículo de cada rota, juntada à tabela longa do registro
         if usar_manual and valor_veiculo is not None:
-            # Global vehicle mode: use single efficiency column for all rows
-            if valor_veiculo in db_efi.columns:
-                mapa_efi = db_efi.drop_duplicates('CHAVE FORNE + MDR').set_index('CHAVE FORNE + MDR')[valor_veiculo]
-                df_saturacao['EFICIÊNCIA_COMPRIMENTO'] = df_saturacao['CHAVE'].map(mapa_efi).fillna(1)
-            else:
+            if valor_veiculo not in db_efi.columns:
                 print(f"[WARNING] Efficiency column '{valor_veiculo}' not found in BD_CADASTRO_MDR_PERDA_COMPRIMENTO")
-                df_saturacao['EFICIÊNCIA_COMPRIMENTO'] = 1.0
+            colunas_efi = [valor_veiculo] * len(df_saturacao)
         else:
-            # Per-route vehicle mode: lookup efficiency for each row's vehicle
-            def obter_eficiencia_por_linha(row):
-                chave = str(row['COD FORNECEDOR']) + '-' + str(row['EMBALAGEM'])
-                cod_veic = row['VEICULO']
-                coluna_veic = mapa_coluna_capacidade.get(cod_veic)
-                
-                if not coluna_veic or coluna_veic not in db_efi.columns:
-                    return 1.0  # Default efficiency
-                
-                # Filter db_efi for this CHAVE and get efficiency from appropriate vehicle column
-                filtro = db_efi['CHAVE FORNE + MDR'] == chave
-                efi_series = db_efi.loc[filtro, coluna_veic].dropna()
-                
-                if efi_series.empty:
-                    return 1.0
-                
-                return efi_series.values[0]
-            
-            df_saturacao['EFICIÊNCIA_COMPRIMENTO'] = df_saturacao.apply(obter_eficiencia_por_linha, axis=1)
-            df_saturacao['EFICIÊNCIA_COMPRIMENTO'] = df_saturacao['EFICIÊNCIA_COMPRIMENTO'].fillna(1)
-
+            colunas_efi = [mapa_coluna_capacidade.get(cod_veic) for cod_veic in df_saturacao['VEICULO']]
+        df_saturacao['EFICIÊNCIA_COMPRIMENTO'] = _eficiencia_por_linha(df_saturacao['CHAVE'], colunas_efi,
+                                                                       referencias["eficiencias"])
 
         mapa_volume_efi = db_MDR.drop_duplicates('CHAVE EMBALAGENS').set_index('CHAVE EMBALAGENS')['VOLUME']
         df_saturacao['M³ POR EMBALAGEM'] = df_saturacao['CHAVE'].map(mapa_volume_efi) * \
@@ -1617,36 +3165,6 @@ def completar_informacoes(tree, veiculo, tree_resumo, canvas_caminhoes, caminhao
         df_calculo_empilhamento = calcular_empilhamento(df_saturacao, db_empilhamento)
 
         # --- Saturação final por embalagem ---
-        def integrar_saturacao_total(df_sat, df_emp):
-            def calcular(row):
-                filtro = (df_emp['FORNECEDOR'] == row['COD FORNECEDOR']) & \
-                         (df_emp['EMBALAGEM_BASE'] == row['EMBALAGEM']) & \
-                         (df_emp['COD FLUXO'] == row['COD FLUXO'])
-                soma_saturacoes = df_emp[filtro]['SATURAÇÃO'].sum()
-                # Prevent division by zero
-                if pd.isna(row['CAPACIDADE']) or row['CAPACIDADE'] == 0:
-                    return 0
-                proporcao = row['CXS/PALLETS_TOTAL'] / row['CAPACIDADE']
-                result = (proporcao + soma_saturacoes) * row['EFICIÊNCIA_COMPRIMENTO']
-                
-
-                
-                return result
-
-            df_sat['SATURAÇÃO_TOTAL'] = df_sat.apply(calcular, axis=1)
-            # Clean up infinity values
-            df_sat['SATURAÇÃO_TOTAL'] = df_sat['SATURAÇÃO_TOTAL'].replace([np.inf, -np.inf], np.nan).fillna(0)
-            
-            # Prevent division by zero for SATURAÇÃO_POR_MDR
-            df_sat['SATURAÇÃO_POR_MDR'] = 0.0
-            mask = (df_sat['TOTAL DE CXS'].notna()) & (df_sat['TOTAL DE CXS'] > 0)
-            df_sat.loc[mask, 'SATURAÇÃO_POR_MDR'] = df_sat.loc[mask, 'SATURAÇÃO_TOTAL'] / df_sat.loc[mask, 'TOTAL DE CXS']
-            df_sat['SATURAÇÃO_POR_MDR'] = df_sat['SATURAÇÃO_POR_MDR'].replace([np.inf, -np.inf], np.nan).fillna(0)
-            
-            return df_sat
-            
-            return df_sat
-
         if not df_calculo_empilhamento.empty:
             df_saturacao = integrar_saturacao_total(df_saturacao, df_calculo_empilhamento)
         else:
@@ -1722,7 +3240,7 @@ def completar_informacoes(tree, veiculo, tree_resumo, canvas_caminhoes, caminhao
         # Limpa e atualiza a tabela tree_resumo
         tree_resumo.delete(*tree_resumo.get_children())
         for item in resumo_dados:
-            tree_resumo.insert("", END, values=item)
+            tree_resumo.insert("", "end", values=item)
 
 
         # --- Atualiza TreeView (Tkinter) with deduplicated data ---
@@ -1762,7 +3280,7 @@ def completar_informacoes(tree, veiculo, tree_resumo, canvas_caminhoes, caminhao
             width = column_widths.get(col, 90)  # Default 90 if not specified
             tree.column(col, width=width, anchor="center", stretch=False)
         for _, row in template.iterrows():
-            tree.insert("", END, values=list(row))
+            tree.insert("", "end", values=list(row))
 
         desenhar_caminhoes(canvas_caminhoes, ocupacao, caminhao_img)
         
@@ -1812,91 +3330,32 @@ def completar_informacoes(tree, veiculo, tree_resumo, canvas_caminhoes, caminhao
             if rows_removed > 0:
                 adicionar_erro(f"{rows_removed} linha(s) removida(s) (COD FORNECEDOR in COD IMS e COD DESTINO != 1046)", "INFO")
         
+        # --- Abas do VIAJANTE ---
+        abas = {
+            'Template Completo': template,
+            'Saturação': df_saturacao,
+            'Calculo Empilhamento': df_calculo_empilhamento,
+        }
+
+        pn_nao_cadastrados = _pns_nao_cadastrados(template)
+        if pn_nao_cadastrados is not None:
+            abas['PN Não Cadastrados'] = pn_nao_cadastrados
+
+            # Log de PNs não cadastrados
+            qtd_pn_faltando = len(pn_nao_cadastrados)
+            qtd_sem_mdr = len(pn_nao_cadastrados[pn_nao_cadastrados['MOTIVO'].str.contains('sem MDR', na=False)])
+            adicionar_erro(f"{qtd_pn_faltando} PN(s) com problemas de cadastro ({qtd_sem_mdr} sem MDR). Verifique a aba 'PN Não Cadastrados' do viajante", "AVISO")
+
         # --- Exporta para Excel formatado ---
-        with pd.ExcelWriter('VIAJANTE.xlsx', engine='openpyxl') as writer:
-            template.to_excel(writer, sheet_name='Template Completo', index=False)
-            df_saturacao.to_excel(writer, sheet_name='Saturação', index=False)
-            df_calculo_empilhamento.to_excel(writer, sheet_name='Calculo Empilhamento', index=False)
-
-            header_fill = PatternFill(start_color='FFC000', end_color='FFC000', fill_type='solid')
-            header_font = Font(bold=True, color='000000')
-            header_align = Alignment(horizontal='center', vertical='center')
-
-            for sheet_name in ['Template Completo', 'Saturação', 'Calculo Empilhamento']:
-                ws = writer.sheets[sheet_name]
-                for col_num, col in enumerate(ws.iter_cols(min_row=1, max_row=1), 1):
-                    largura = max(len(str(cell.value) or '') for cell in col) + 2
-                    ws.column_dimensions[get_column_letter(col_num)].width = largura
-                for cell in ws[1]:
-                    cell.fill = header_fill
-                    cell.font = header_font
-                    cell.alignment = header_align
-
-            if 'MDR' in template.columns:
-                # Identify PNs with issues
-                pn_nao_cadastrados_list = []
-                
-                # 1. PNs not in BD_CADASTRO_PN (no MDR)
-                pn_sem_mdr = template[
-                    template['MDR'].isna() | (template['MDR'].astype(str).str.strip() == '')
-                ].copy()
-                if not pn_sem_mdr.empty:
-                    pn_sem_mdr['MOTIVO'] = 'PN não encontrado no BD_CADASTRO_PN (sem MDR)'
-                    pn_nao_cadastrados_list.append(pn_sem_mdr)
-                
-                # 2. PNs without QME (critical for calculations)
-                pn_sem_qme = template[
-                    template['MDR'].notna() & 
-                    (template['QME'].isna() | (template['QME'] == 0))
-                ].copy()
-                if not pn_sem_qme.empty:
-                    pn_sem_qme['MOTIVO'] = 'PN sem QME cadastrado'
-                    pn_nao_cadastrados_list.append(pn_sem_qme)
-                
-                # 3. PNs without DESCRIÇÃO MATERIAL
-                pn_sem_desc = template[
-                    template['MDR'].notna() & 
-                    (template['DESCRIÇÃO MATERIAL'].isna() | (template['DESCRIÇÃO MATERIAL'].astype(str).str.strip() == ''))
-                ].copy()
-                if not pn_sem_desc.empty:
-                    pn_sem_desc['MOTIVO'] = 'PN sem DESCRIÇÃO MATERIAL cadastrada'
-                    pn_nao_cadastrados_list.append(pn_sem_desc)
-                
-                # Combine all issues
-                if pn_nao_cadastrados_list:
-                    pn_nao_cadastrados = pd.concat(pn_nao_cadastrados_list, ignore_index=True)
-                    
-                    # Select columns to keep
-                    cols_to_keep = ['COD FORNECEDOR', 'FORNECEDOR', 'COD IMS', 'COD DESTINO', 'DESENHO', 'QTDE', 'MDR', 'QME', 'MOTIVO']
-                    existing_cols = [c for c in cols_to_keep if c in pn_nao_cadastrados.columns]
-                    
-                    if existing_cols:
-                        pn_nao_cadastrados = pn_nao_cadastrados[existing_cols]
-                        pn_nao_cadastrados.drop_duplicates(subset=["DESENHO", "MOTIVO"], inplace=True)
-                        pn_nao_cadastrados.to_excel(writer, sheet_name='PN Não Cadastrados', index=False)
-                        
-                        # Log de PNs não cadastrados
-                        qtd_pn_faltando = len(pn_nao_cadastrados)
-                        qtd_sem_mdr = len(pn_nao_cadastrados[pn_nao_cadastrados['MOTIVO'].str.contains('sem MDR', na=False)])
-                        adicionar_erro(f"{qtd_pn_faltando} PN(s) com problemas de cadastro ({qtd_sem_mdr} sem MDR). Verifique a aba 'PN Não Cadastrados' do viajante", "AVISO")
-                        
-                        # Append to tracking file
-                        tracking_file = os.path.join(caminho_base, caminho_BD, 'PNs_Nao_Cadastrados_Log.xlsx')
-                        try:
-                            if os.path.exists(tracking_file):
-                                existing_log = pd.read_excel(tracking_file)
-                                # Add timestamp if not present
-                                if 'DATA_SOLICITACAO' not in pn_nao_cadastrados.columns:
-                                    pn_nao_cadastrados['DATA_SOLICITACAO'] = pd.Timestamp.now().strftime('%Y-%m-%d %H:%M:%S')
-                                combined_log = pd.concat([existing_log, pn_nao_cadastrados], ignore_index=True)
-                                combined_log.drop_duplicates(subset=['DESENHO', 'COD FORNECEDOR'], keep='last', inplace=True)
-                                combined_log.to_excel(tracking_file, index=False)
-                            else:
-                                pn_nao_cadastrados['DATA_SOLICITACAO'] = pd.Timestamp.now().strftime('%Y-%m-%d %H:%M:%S')
-                                pn_nao_cadastrados.to_excel(tracking_file, index=False)
-                            print(f"[INFO] PNs não cadastrados salvos em: {tracking_file}")
-                        except Exception as e:
-                            adicionar_erro(f"Erro ao salvar log de PNs não cadastrados: {str(e)}", "AVISO")
+        if exportar:
+            exportar_viajante(abas)
+            if pn_nao_cadastrados is not None:
+                try:
+                    registrar_pns_nao_cadastrados(pn_nao_cadastrados, caminho_BD)
+                except Exception as e:
+                    adicionar_erro(f"Erro ao salvar log de PNs não cadastrados: {str(e)}", "AVISO")
+
+        return abas
 
     except Exception as e:
         adicionar_erro(f"Erro crítico ao processar informações: {str(e)}", "ERRO")
@@ -1904,7 +3363,13 @@ def completar_informacoes(tree, veiculo, tree_resumo, canvas_caminhoes, caminhao
         traceback.print_exc()
 
 
-def consolidar_dados(use_manual=False, manual_veiculo=None):
+def consolidar_dados(use_manual=False, manual_veiculo=None, template=None, exportar=True):
+    """
+    Consolida o template completo por rota do FLUXO (volume, peso, saturação e cargas).
+    template: aba 'Template Completo' devolvida por completar_informacoes (None lê VIAJANTE.xlsx)
+    exportar: grava Volume_por_rota.xlsx (False deixa para exportar_relatorios)
+    Retorna o DataFrame de Volume por Rota.
+    """
     # === CONFIGURATION: Static Cargas Adjustment ===
     use_static_adjustment = 1  # Set to 1 to activate, 0 to deactivate
     
@@ -1916,13 +3381,14 @@ def consolidar_dados(use_manual=False, manual_veiculo=None):
     
     # Carrega os dados
     fluxos_path = os.path.join(caminho_base, "BD", "FLUXO.xlsx")
-    fluxos = pd.read_excel(fluxos_path, sheet_name='FLUXOS')
+    fluxos = ler_registro(fluxos_path, sheet_name='FLUXOS')
     
     # Ensure COD IMS column exists in fluxos
     if 'COD IMS' not in fluxos.columns:
         fluxos['COD IMS'] = ""
     
-    template = pd.read_excel('VIAJANTE.xlsx', sheet_name='Template Completo')
+    if template is None:
+        template = pd.read_excel('VIAJANTE.xlsx', sheet_name='Template Completo')
 
     # Filtra linhas com quantidade válida e prepara as colunas
     template = template[template['QTDE'] > 0].copy()
@@ -1992,7 +3458,7 @@ def consolidar_dados(use_manual=False, manual_veiculo=None):
         # Try to persist the overridden Template Completo back into VIAJANTE.xlsx
         try:
             via_path = os.path.join(caminho_base, 'VIAJANTE.xlsx')
-            if os.path.exists(via_path):
+            if exportar and os.path.exists(via_path):
                 out_template = template.copy()
                 try:
                     # map codes to names using code_to_vehicle_name if available
@@ -2015,7 +3481,7 @@ def consolidar_dados(use_manual=False, manual_veiculo=None):
     try:
         veic_path = os.path.join(caminho_base, 'BD', 'VEÍCULOS.xlsx')
         if os.path.exists(veic_path):
-            db_veic = pd.read_excel(veic_path)
+            db_veic = ler_registro(veic_path)
             cols = {c.strip().upper(): c for c in db_veic.columns}
             code_col = None
             name_col = None
@@ -2299,43 +3765,12 @@ def consolidar_dados(use_manual=False, manual_veiculo=None):
     # Do NOT drop_duplicates - CT and FTL routes for same supplier are separate!
     
     # --- Save with blue header formatting and auto-width columns ---
-    with pd.ExcelWriter('Volume_por_rota.xlsx', engine='openpyxl') as writer:
-        df_volume.to_excel(writer, sheet_name='Volume por Rota', index=False)
-        
-        # Apply formatting
-        ws = writer.sheets['Volume por Rota']
-        
-        # Blue header fill
-        header_fill = PatternFill(start_color='00246C', end_color='00246C', fill_type='solid')
-        header_font = Font(bold=True, color='FFFFFF')
-        header_align = Alignment(horizontal='center', vertical='center')
-        
-        # Auto-size columns and apply header formatting
-        for col_num, col in enumerate(ws.iter_cols(min_row=1, max_row=1), 1):
-            # Calculate width based on content
-            max_length = 0
-            column_letter = get_column_letter(col_num)
-            
-            # Check header length
-            header_cell = ws[f'{column_letter}1']
-            if header_cell.value:
-                max_length = len(str(header_cell.value))
-            
-            # Check data length (sample first 100 rows for performance)
-            for row_num in range(2, min(102, ws.max_row + 1)):
-                cell = ws[f'{column_letter}{row_num}']
-                if cell.value:
-                    max_length = max(max_length, len(str(cell.value)))
-            
-            # Set column width (add padding)
-            adjusted_width = min(max_length + 2, 50)  # Cap at 50 for very long content
-            ws.column_dimensions[column_letter].width = adjusted_width
-            
-            # Apply header formatting
-            header_cell.fill = header_fill
-            header_cell.font = header_font
-            header_cell.alignment = header_align
-    
+    if exportar:
+        exportar_volume_por_rota(df_volume)
+
+    return df_volume
+
+
 #tree = ttk.Treeview()
 #tree_resumo = ttk.Treeview()
 #completar_informacoes(tree,3, tree_resumo)
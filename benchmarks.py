@@ -0,0 +1,706 @@
+"""
+Benchmarks do VIAJANTE - compara os caminhos otimizados com as implementações anteriores
+
+Uso (a partir da pasta do projeto):
+    python benchmarks.py txt --pasta "Albert demanda" --repeticoes 5 --sinteticos 300 100000
+    python benchmarks.py cache --pasta Demandas --sheet SEG
+    python benchmarks.py registros
+    python benchmarks.py inicializacao --orcamento-main 1.5
+    python benchmarks.py exportacao --linhas 10000 100000 500000
+    python benchmarks.py log_pns --historico 1000 10000 50000
+    python benchmarks.py capacidade --registro 50000 --linhas 2000
+    python benchmarks.py escada --registro 50000 --linhas 2000
+    python benchmarks.py eficiencia --registro 20000 --linhas 2000
+    python benchmarks.py empilhamento --linhas 2000 --caixas 5000
+    python benchmarks.py saturacao_total --linhas 5000
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import pandas as pd
+
+caminho_base = os.path.dirname(os.path.abspath(__file__))
+if caminho_base not in sys.path:
+    sys.path.insert(0, caminho_base)
+
+
+def medir(funcao, *args, repeticoes=5, **kwargs):
+    """Executa a função `repeticoes` vezes e retorna (melhor tempo em segundos, último resultado)"""
+    melhor = float("inf")
+    resultado = None
+    for _ in range(repeticoes):
+        inicio = time.perf_counter()
+        resultado = funcao(*args, **kwargs)
+        melhor = min(melhor, time.perf_counter() - inicio)
+    return melhor, resultado
+
+
+def imprimir_linha(nome, tempo_antigo, tempo_novo):
+    ganho = tempo_antigo / tempo_novo if tempo_novo > 0 else float("inf")
+    print(f"{nome:<40} {tempo_antigo * 1000:>10.2f} ms {tempo_novo * 1000:>10.2f} ms {ganho:>8.1f}x")
+
+
+# ------------------- TXT GMDNVA8 -------------------
+
+def _ler_txt_legado(caminho_arquivo):
+    """Laço linha a linha usado por Processar_Demandas antes do parser colunar (referência)"""
+    dados_arquivo_atual = []
+    with open(caminho_arquivo, "r", encoding="utf-8", errors="ignore") as arquivo:
+        linhas_a_processar = arquivo.readlines()
+
+    for linha in linhas_a_processar:
+        if "AUTOMATIC" in linha:
+            continue
+
+        linha = linha.strip()
+
+        if len(linha) >= 20:
+            try:
+                desenho = linha[3:14]
+                cod_fornecedor = linha[-20:-11]
+                quantidade = linha[-11:].replace("+", "")
+
+                dados_arquivo_atual.append({
+                    "DESENHO": int(desenho.strip()),
+                    "COD FORNECEDOR": int(cod_fornecedor.strip()),
+                    "QTDE": int(quantidade.strip()),
+                })
+            except (ValueError, IndexError):
+                continue
+
+    return pd.DataFrame(dados_arquivo_atual)
+
+
+def _gerar_txt_sintetico(caminho_arquivo, linhas, semente=0):
+    """GMDNVA8 de largura fixa (140 colunas, CRLF) com um cabeçalho AUTOMATIC a cada 500 linhas"""
+    import random
+
+    aleatorio = random.Random(semente)
+    with open(caminho_arquivo, "w", newline="") as arquivo:
+        for i in range(linhas):
+            if i % 500 == 0:
+                arquivo.write("OP01161BIMF2026033110002005880V8AUTOMATIC".ljust(140) + "\r\n")
+            desenho = aleatorio.randint(0, 10**11 - 1)
+            fornecedor = aleatorio.randint(0, 10**9 - 1)
+            qtde = aleatorio.randint(0, 10**6)
+            arquivo.write(f"161{desenho:011d}2026033108{fornecedor:09d}{qtde:010d}+".ljust(140) + "\r\n")
+
+
+def _comparar_txt(nome, caminho, repeticoes):
+    from DB import _ler_txt_demanda
+
+    tempo_antigo, df_antigo = medir(_ler_txt_legado, caminho, repeticoes=repeticoes)
+    tempo_novo, df_novo = medir(_ler_txt_demanda, caminho, repeticoes=repeticoes)
+
+    if df_antigo.empty:
+        assert df_novo.empty, f"{caminho}: parser colunar retornou linhas que o laço antigo descarta"
+    else:
+        pd.testing.assert_frame_equal(df_antigo, df_novo)
+
+    imprimir_linha(f"{nome} ({len(df_novo)} linhas)", tempo_antigo, tempo_novo)
+
+
+def bench_txt(pasta, repeticoes, sinteticos=()):
+    import tempfile
+
+    arquivos = []
+    if os.path.isdir(pasta):
+        arquivos = sorted(
+            os.path.join(pasta, nome) for nome in os.listdir(pasta)
+            if nome.lower().endswith((".txt", ".csv"))
+        )
+    if not arquivos:
+        print(f"Nenhum arquivo .txt/.csv encontrado em '{pasta}'")
+
+    print(f"{'Arquivo':<40} {'Laço antigo':>13} {'Colunar':>13} {'Ganho':>9}")
+    for caminho in arquivos:
+        _comparar_txt(os.path.basename(caminho), caminho, repeticoes)
+
+    # Arquivos sintéticos: abaixo de DB._LINHAS_MINIMAS_TXT_COLUNAR o leitor segue linha a linha
+    with tempfile.TemporaryDirectory() as pasta_temporaria:
+        for linhas in sinteticos:
+            caminho = os.path.join(pasta_temporaria, f"sintetico_{linhas}.txt")
+            _gerar_txt_sintetico(caminho, linhas)
+            _comparar_txt("sintético", caminho, repeticoes)
+
+
+# ------------------- CACHE DE DEMANDAS -------------------
+
+def bench_cache(pasta, sheet_name, repeticoes):
+    import DB
+
+    def ler(usar_cache):
+        DB.limpar_erros()
+        return DB.Processar_Demandas(None, pasta_demandas=pasta, sheet_name=sheet_name, usar_cache=usar_cache)
+
+    tempo_sem_cache, df_sem_cache = medir(ler, False, repeticoes=repeticoes)
+    ler(True)  # aquece o cache
+    tempo_com_cache, df_com_cache = medir(ler, True, repeticoes=repeticoes)
+
+    pd.testing.assert_frame_equal(df_sem_cache, df_com_cache)
+
+    print(f"{'Etapa':<40} {'Sem cache':>13} {'Cache quente':>13} {'Ganho':>9}")
+    imprimir_linha(f"Processar_Demandas ({len(df_com_cache)} linhas)", tempo_sem_cache, tempo_com_cache)
+
+
+# ------------------- REGISTROS COLUNARES -------------------
+
+def bench_registros(caminho_BD, repeticoes):
+    import DB
+
+    print(f"{'Registro':<40} {'read_excel':>13} {'Colunar':>13} {'Ganho':>9}")
+    for nome, caminho in DB.arquivos_registros(caminho_BD).items():
+        if caminho is None or not os.path.exists(caminho):
+            continue
+        for sheet_name, dtype in DB._ABAS_REGISTROS[nome]:
+            tempo_excel, df_excel = medir(pd.read_excel, caminho, sheet_name=sheet_name, dtype=dtype,
+                                          repeticoes=repeticoes)
+            DB.ler_registro(caminho, sheet_name=sheet_name, dtype=dtype)  # gera o .pkl
+            tempo_colunar, df_colunar = medir(DB.ler_registro, caminho, sheet_name=sheet_name, dtype=dtype,
+                                              repeticoes=repeticoes)
+            pd.testing.assert_frame_equal(df_excel, df_colunar)
+            imprimir_linha(f"{nome} [{sheet_name}] ({len(df_colunar)} linhas)", tempo_excel, tempo_colunar)
+
+
+# ------------------- EXPORTAÇÃO DOS RELATÓRIOS -------------------
+
+def _exportar_volume_legado(df_volume, caminho):
+    """pd.ExcelWriter + formatação célula a célula usada por consolidar_dados antes da gravação direta (referência)"""
+    from openpyxl.styles import PatternFill, Font, Alignment
+    from openpyxl.utils import get_column_letter
+
+    with pd.ExcelWriter(caminho, engine='openpyxl') as writer:
+        df_volume.to_excel(writer, sheet_name='Volume por Rota', index=False)
+        ws = writer.sheets['Volume por Rota']
+        header_fill = PatternFill(start_color='00246C', end_color='00246C', fill_type='solid')
+        header_font = Font(bold=True, color='FFFFFF')
+        header_align = Alignment(horizontal='center', vertical='center')
+        for col_num, col in enumerate(ws.iter_cols(min_row=1, max_row=1), 1):
+            max_length = 0
+            column_letter = get_column_letter(col_num)
+            header_cell = ws[f'{column_letter}1']
+            if header_cell.value:
+                max_length = len(str(header_cell.value))
+            for row_num in range(2, min(102, ws.max_row + 1)):
+                cell = ws[f'{column_letter}{row_num}']
+                if cell.value:
+                    max_length = max(max_length, len(str(cell.value)))
+            ws.column_dimensions[column_letter].width = min(max_length + 2, 50)
+            header_cell.fill = header_fill
+            header_cell.font = header_font
+            header_cell.alignment = header_align
+
+
+def _tabela_sintetica(linhas):
+    """Tabela no formato do Template Completo (textos, inteiros, decimais com vazios e datas)"""
+    import numpy as np
+
+    gerador = np.random.default_rng(0)
+    df = pd.DataFrame({
+        "COD FORNECEDOR": gerador.integers(10000, 99999, linhas).astype(str),
+        "FORNECEDOR": gerador.choice(["ACME LTDA", "FOO SA", "BAR INDUSTRIA"], linhas),
+        "COD DESTINO": gerador.choice(["1046", "1080", "1097"], linhas),
+        "DESENHO": gerador.integers(10**9, 10**10, linhas).astype(str),
+        "QTDE": gerador.integers(1, 500, linhas),
+        "MDR": gerador.choice(["M1", "M2", "M3", None], linhas),
+        "QME": np.where(gerador.random(linhas) < 0.1, np.nan, gerador.integers(1, 50, linhas)),
+        "VOLUME": gerador.random(linhas).round(4),
+        "PESO": gerador.random(linhas) * 100,
+        "DATA": pd.Timestamp("2025-01-01") + pd.to_timedelta(gerador.integers(0, 365, linhas), "D"),
+    })
+    for indice in range(20):
+        df[f"SATURAÇÃO {indice}"] = gerador.random(linhas)
+    return df
+
+
+def bench_exportacao(contagens, limite_legado, caminho_saida):
+    from DB import exportar_volume_por_rota
+
+    print(f"{'Exportação Volume_por_rota.xlsx':<40} {'Antigo':>13} {'Novo':>13} {'Ganho':>9}")
+    for linhas in contagens:
+        df = _tabela_sintetica(linhas)
+        caminho = os.path.join(caminho_saida, f"bench_exportacao_{linhas}.xlsx")
+        tempo_novo, _ = medir(exportar_volume_por_rota, df, caminho, repeticoes=1)
+        nome = f"{linhas} linhas x {df.shape[1]} colunas"
+        if linhas <= limite_legado:
+            tempo_antigo, _ = medir(_exportar_volume_legado, df, caminho, repeticoes=1)
+            imprimir_linha(nome, tempo_antigo, tempo_novo)
+        else:
+            print(f"{nome:<40} {'-':>13} {tempo_novo * 1000:>10.2f} ms")
+        os.remove(caminho)
+
+
+# ------------------- LOG DE PNs NÃO CADASTRADOS -------------------
+
+def _registrar_pns_legado(pn_nao_cadastrados, tracking_file):
+    """Lê o log .xlsx inteiro, concatena, remove duplicados e regrava tudo (referência)"""
+    pn_nao_cadastrados = pn_nao_cadastrados.copy()
+    existing_log = pd.read_excel(tracking_file)
+    pn_nao_cadastrados['DATA_SOLICITACAO'] = pd.Timestamp.now().strftime('%Y-%m-%d %H:%M:%S')
+    combined_log = pd.concat([existing_log, pn_nao_cadastrados], ignore_index=True)
+    combined_log.drop_duplicates(subset=['DESENHO', 'COD FORNECEDOR'], keep='last', inplace=True)
+    combined_log.to_excel(tracking_file, index=False)
+
+
+def _pns_sinteticos(linhas, inicio=0):
+    return pd.DataFrame({
+        "COD FORNECEDOR": [str(10000 + i % 900) for i in range(inicio, inicio + linhas)],
+        "FORNECEDOR": "ACME LTDA", "COD IMS": None, "COD DESTINO": "1080",
+        "DESENHO": [str(500000000 + i) for i in range(inicio, inicio + linhas)],
+        "QTDE": 10, "MDR": None, "QME": None, "MOTIVO": "PN não encontrado no BD_CADASTRO_PN (sem MDR)",
+    })
+
+
+def bench_log_pns(historicos, novas):
+    import tempfile
+
+    import DB
+
+    print(f"{'Registro de ' + str(novas) + ' PNs no log':<40} {'Antigo':>13} {'Novo':>13} {'Ganho':>9}")
+    caminho_original = DB.caminho_base
+    try:
+        for historico in historicos:
+            with tempfile.TemporaryDirectory() as pasta:
+                os.makedirs(os.path.join(pasta, "BD"))
+                DB.caminho_base = pasta
+                existente = _pns_sinteticos(historico).assign(DATA_SOLICITACAO="2025-01-01 00:00:00")
+                planilha = os.path.join(pasta, "BD", "PNs_Nao_Cadastrados_Log.xlsx")
+                existente.to_excel(planilha, index=False)
+                DB.registrar_pns_nao_cadastrados(existente.iloc[:0])  # importa o histórico para o SQLite
+
+                # Metade dos PNs novos já está no log (upsert), metade é nova
+                lote = _pns_sinteticos(novas, inicio=historico - novas // 2)
+                tempo_antigo, _ = medir(_registrar_pns_legado, lote, planilha, repeticoes=1)
+                tempo_novo, _ = medir(DB.registrar_pns_nao_cadastrados, lote, repeticoes=3)
+                imprimir_linha(f"histórico de {historico} linhas", tempo_antigo, tempo_novo)
+    finally:
+        DB.caminho_base = caminho_original
+
+
+# ------------------- CAPACIDADE POR VEÍCULO -------------------
+
+def _capacidade_legado(df_saturacao, db_MDR, mapa_coluna_capacidade):
+    """apply linha a linha com duas máscaras sobre o db_MDR inteiro por linha (referência)"""
+    import numpy as np
+
+    db_MDR = db_MDR.copy()
+    db_MDR['MDR'] = db_MDR['MDR'].astype(str).str.upper()
+
+    def obter_capacidade_por_linha(row):
+        mdr = str(row['EMBALAGEM']).upper()
+        coluna = mapa_coluna_capacidade.get(row['VEICULO'])
+        if not coluna or coluna not in db_MDR.columns:
+            return np.nan
+        filtro_fornecedor = (db_MDR['MDR'] == mdr) & (db_MDR['CÓD. FORNECEDOR'].isin([row['COD FORNECEDOR']]))
+        serie = db_MDR.loc[filtro_fornecedor, coluna].dropna()
+        if not serie.empty:
+            moda = float(serie.mode().iloc[0])
+            maximo = float(serie.max())
+            return moda if maximo - float(serie.min()) > moda * 0.5 else maximo
+        serie = db_MDR.loc[db_MDR['MDR'] == mdr, coluna].dropna()
+        return float(serie.max()) if not serie.empty else np.nan
+
+    return df_saturacao.apply(obter_capacidade_por_linha, axis=1)
+
+
+def _saturacao_sintetica(registro, linhas):
+    """db_MDR sintético com uma coluna de capacidade por veículo e uma aba Saturação que o consulta"""
+    import numpy as np
+
+    gerador = np.random.default_rng(0)
+    veiculos = {1: "V34", 3: "T3M", 4: "14 x 2,4 x 2,78", 7: "BITREM", 10: "VAN", 11: "FIO", 14: "LH"}
+    mdrs = np.array([f"M{i}" for i in range(300)])
+    fornecedores = np.array([str(10000 + i) for i in range(800)])
+    db_MDR = pd.DataFrame({
+        "MDR": gerador.choice(mdrs, registro),
+        "CÓD. FORNECEDOR": gerador.choice(fornecedores, registro),
+    })
+    for coluna in veiculos.values():
+        db_MDR[coluna] = np.where(gerador.random(registro) < 0.3, np.nan,
+                                  gerador.choice([10, 12, 30, 40, 44, 60, 100], registro))
+    df_saturacao = pd.DataFrame({
+        "EMBALAGEM": gerador.choice(mdrs, linhas),
+        "COD FORNECEDOR": gerador.choice(fornecedores, linhas),
+        "VEICULO": gerador.choice(list(veiculos), linhas),
+        "CXS/PALLETS_TOTAL": gerador.integers(1, 200, linhas) / 4,
+    })
+    return db_MDR, df_saturacao, veiculos
+
+
+def bench_capacidade(registro, linhas, repeticoes):
+    from DB import _capacidade_por_linha, _tabela_capacidades
+
+    db_MDR, df_saturacao, veiculos = _saturacao_sintetica(registro, linhas)
+
+    tempo_antigo, antigo = medir(_capacidade_legado, df_saturacao, db_MDR, veiculos, repeticoes=1)
+    tempo_tabela, capacidades = medir(_tabela_capacidades, db_MDR, veiculos, repeticoes=repeticoes)
+    tempo_novo, novo = medir(_capacidade_por_linha, df_saturacao, capacidades, veiculos, repeticoes=repeticoes)
+    iguais = bool(((antigo == novo) | (antigo.isna() & novo.isna())).all())
+
+    print(f"{'Etapa':<40} {'Antigo':>13} {'Novo':>13} {'Ganho':>9}")
+    imprimir_linha(f"CAPACIDADE ({linhas} linhas)", tempo_antigo, tempo_novo)
+    print(f"{'Tabela de capacidades (uma vez por registro)':<40} {'':>13} {tempo_tabela * 1000:>10.2f} ms")
+    print(f"Resultados iguais: {'sim' if iguais else 'NÃO'}")
+
+
+# ------------------- ESCADA DE VEÍCULOS -------------------
+
+def _saturacao_escada_legado(df_saturacao, db_MDR, mapa_coluna_capacidade):
+    """Capacidade do primeiro cadastro do MDR por linha e por veículo da escada, varrendo o db_MDR a cada
+    consulta como obter_capacidade_por_linha_veic_anterior (referência)"""
+    import numpy as np
+
+    from DB import escada_veiculos
+
+    db_MDR = db_MDR.copy()
+    db_MDR['MDR'] = db_MDR['MDR'].astype(str).str.upper()
+
+    def capacidade(mdr, cod_veic):
+        serie = db_MDR.loc[db_MDR['MDR'] == mdr, mapa_coluna_capacidade[cod_veic]].dropna()
+        return float(serie.iloc[0]) if not serie.empty else np.nan
+
+    saturacoes = {}
+    for posicao, row in enumerate(df_saturacao.itertuples(index=False)):
+        mdr = str(row.EMBALAGEM).upper()
+        for cod_veic in escada_veiculos(row.VEICULO):
+            valor = capacidade(mdr, cod_veic)
+            saturacoes[(posicao, cod_veic)] = (round(row[3] / valor * 100, 2)
+                                               if pd.notna(valor) and valor > 0 else 0.0)
+    return saturacoes
+
+
+def _saturacao_escada(df_saturacao, db_MDR, mapa_coluna_capacidade):
+    """Mesma saída pela matriz MDR x veículo e uma divisão com broadcast"""
+    import numpy as np
+
+    from DB import _capacidades_da_matriz, _matriz_capacidades, escada_veiculos
+
+    matriz = _matriz_capacidades(db_MDR, mapa_coluna_capacidade)
+    capacidades = _capacidades_da_matriz(matriz, df_saturacao['EMBALAGEM'].astype(str).str.upper())
+    with np.errstate(divide='ignore', invalid='ignore'):
+        saturacoes = np.where(capacidades > 0,
+                              np.round(df_saturacao['CXS/PALLETS_TOTAL'].to_numpy(dtype=float)[:, None]
+                                       / capacidades * 100, 2), 0.0)
+    posicao_veiculo = {cod_veic: posicao for posicao, cod_veic in enumerate(matriz.columns)}
+    return {(posicao, cod_veic): float(saturacoes[posicao, posicao_veiculo[cod_veic]])
+            for posicao, cod_veic_linha in enumerate(df_saturacao['VEICULO'])
+            for cod_veic in escada_veiculos(cod_veic_linha)}
+
+
+def bench_escada(registro, linhas, repeticoes):
+    db_MDR, df_saturacao, veiculos = _saturacao_sintetica(registro, linhas)
+    df_saturacao = df_saturacao[['EMBALAGEM', 'COD FORNECEDOR', 'VEICULO', 'CXS/PALLETS_TOTAL']]
+
+    tempo_antigo, antigo = medir(_saturacao_escada_legado, df_saturacao, db_MDR, veiculos, repeticoes=1)
+    tempo_novo, novo = medir(_saturacao_escada, df_saturacao, db_MDR, veiculos, repeticoes=repeticoes)
+
+    print(f"{'Etapa':<40} {'Antigo':>13} {'Novo':>13} {'Ganho':>9}")
+    imprimir_linha(f"Saturação na escada ({len(antigo)} consultas)", tempo_antigo, tempo_novo)
+    print(f"Resultados iguais: {'sim' if antigo == novo else 'NÃO'}")
+
+
+# ------------------- EFICIÊNCIA DE COMPRIMENTO -------------------
+
+def _eficiencia_legado(df_saturacao, db_efi, mapa_coluna_capacidade):
+    """apply linha a linha filtrando o db_efi inteiro pela CHAVE (referência)"""
+    def obter_eficiencia_por_linha(row):
+        coluna_veic = mapa_coluna_capacidade.get(row['VEICULO'])
+        if not coluna_veic or coluna_veic not in db_efi.columns:
+            return 1.0
+        efi_series = db_efi.loc[db_efi['CHAVE FORNE + MDR'] == row['CHAVE'], coluna_veic].dropna()
+        return 1.0 if efi_series.empty else efi_series.values[0]
+
+    return df_saturacao.apply(obter_eficiencia_por_linha, axis=1).fillna(1)
+
+
+def bench_eficiencia(registro, linhas, repeticoes):
+    import numpy as np
+
+    from DB import _eficiencia_por_linha, _tabela_eficiencias
+
+    _, df_saturacao, veiculos = _saturacao_sintetica(0, linhas)
+    df_saturacao['CHAVE'] = df_saturacao['COD FORNECEDOR'].astype(str) + '-' + df_saturacao['EMBALAGEM'].astype(str)
+    gerador = np.random.default_rng(1)
+    db_efi = pd.DataFrame({"CHAVE FORNE + MDR": gerador.choice(df_saturacao['CHAVE'].unique(), registro)})
+    for coluna in veiculos.values():
+        db_efi[coluna] = np.where(gerador.random(registro) < 0.3, np.nan,
+                                  gerador.choice([0.75, 0.8, 0.9, 1.0], registro))
+
+    def novo(df_saturacao, db_efi, mapa_coluna_capacidade):
+        colunas = [mapa_coluna_capacidade.get(cod_veic) for cod_veic in df_saturacao['VEICULO']]
+        return _eficiencia_por_linha(df_saturacao['CHAVE'], colunas, _tabela_eficiencias(db_efi))
+
+    tempo_antigo, antigo = medir(_eficiencia_legado, df_saturacao, db_efi, veiculos, repeticoes=1)
+    tempo_tabela, eficiencias = medir(_tabela_eficiencias, db_efi, repeticoes=repeticoes)
+    tempo_novo, resultado = medir(novo, df_saturacao, db_efi, veiculos, repeticoes=repeticoes)
+
+    print(f"{'Etapa':<40} {'Antigo':>13} {'Novo':>13} {'Ganho':>9}")
+    imprimir_linha(f"EFICIÊNCIA ({linhas} linhas)", tempo_antigo, tempo_novo)
+    print(f"{'Tabela longa (uma vez por registro)':<40} {'':>13} {tempo_tabela * 1000:>10.2f} ms")
+    print(f"Resultados iguais: {'sim' if antigo.astype(float).equals(resultado.astype(float)) else 'NÃO'}")
+
+
+# ------------------- EMPILHAMENTO -------------------
+
+def _empilhamento_legado(df_saturacao, db_empilhamento):
+    """iterrows base x sobreposta, filtro no db_empilhamento por par e pilhas contadas caixa a caixa (referência)"""
+    empilhamento_rows = []
+    base_df = df_saturacao[df_saturacao['EMBALAGEM_BASE'] == 1]
+    sobre_df = df_saturacao[df_saturacao['EMBALAGEM_SOBREPOSTA'] == 1]
+    for _, base_row in base_df.iterrows():
+        for _, sobre_row in sobre_df.iterrows():
+            if base_row['COD FORNECEDOR'] != sobre_row['COD FORNECEDOR'] or base_row['COD FLUXO'] != sobre_row['COD FLUXO']:
+                continue
+            empilhamento_match = db_empilhamento[
+                (db_empilhamento['COD FORNECEDOR'] == base_row['COD FORNECEDOR']) &
+                (db_empilhamento['MDR BASE'] == base_row['EMBALAGEM']) &
+                (db_empilhamento['MDR SOBREPOSTA'] == sobre_row['EMBALAGEM'])
+            ]
+            if empilhamento_match.empty:
+                continue
+            emp_base = empilhamento_match.iloc[0]['EMPILHAMENTO BASE']
+            total_base, total_sobre = base_row['TOTAL DE CXS'], sobre_row['TOTAL DE CXS']
+            usadas_base = usadas_sobre = 0
+            while total_base >= emp_base and total_sobre >= 1:
+                total_base -= emp_base
+                total_sobre -= 1
+                usadas_base += emp_base
+                usadas_sobre += 1
+            total_empilhado = usadas_base + usadas_sobre
+            empilhamento_rows.append({
+                'FORNECEDOR': base_row['COD FORNECEDOR'],
+                'COD FLUXO': base_row['COD FLUXO'],
+                'EMBALAGEM_BASE': base_row['EMBALAGEM'],
+                'EMBALAGEM_SOBREPOSTA': sobre_row['EMBALAGEM'],
+                'CAPACIDADE_VEÍCULO': base_row['CAPACIDADE'],
+                'TOTAL_DE_EMBALAGENS_BASE': base_row['TOTAL DE CXS'],
+                'TOTAL_DE_EMBALAGENS_SOBREPOSTA': sobre_row['TOTAL DE CXS'],
+                'TOTAL_DE_EMBALAGENS_BASE_PARA_COMBINAR': usadas_base,
+                'TOTAL_DE_EMBALAGENS_SOBREPOSTA_PARA_COMBINAR': usadas_sobre,
+                'EMBALAGENS_BASE_RESTANTE': total_base,
+                'EMBALAGENS_SOBREPOSTA_RESTANTE': total_sobre,
+                'CHAVE': f"{base_row['COD FORNECEDOR']}-{base_row['EMBALAGEM']}-{sobre_row['EMBALAGEM']}",
+                'TOTAL_EMBALAGENS_EMPILHADAS': total_empilhado,
+                'SATURAÇÃO': total_empilhado / base_row['CAPACIDADE'],
+                'EMPILHAMENTO BASE': emp_base,
+            })
+    return pd.DataFrame(empilhamento_rows)
+
+
+def _empilhamento_sintetico(linhas, cadastros, caixas):
+    """Aba Saturação com linhas base/sobreposta de poucos fornecedores e fluxos, e o cadastro de empilhamento"""
+    import numpy as np
+
+    gerador = np.random.default_rng(0)
+    fornecedores = np.array([str(10000 + i) for i in range(max(linhas // 40, 1))])
+    fluxos = np.array([f"F{i}" for i in range(4)])
+    mdrs = np.array([f"M{i}" for i in range(12)])
+    df_saturacao = pd.DataFrame({
+        "COD FLUXO": gerador.choice(fluxos, linhas),
+        "COD FORNECEDOR": gerador.choice(fornecedores, linhas),
+        "EMBALAGEM": gerador.choice(mdrs, linhas),
+        "CAPACIDADE": gerador.choice([30.0, 44.0, 100.0], linhas),
+        "TOTAL DE CXS": gerador.integers(1, caixas, linhas),
+        "EMBALAGEM_BASE": gerador.integers(0, 2, linhas),
+        "EMBALAGEM_SOBREPOSTA": gerador.integers(0, 2, linhas),
+    })
+    db_empilhamento = pd.DataFrame({
+        "COD FORNECEDOR": gerador.choice(fornecedores, cadastros),
+        "MDR BASE": gerador.choice(mdrs, cadastros),
+        "MDR SOBREPOSTA": gerador.choice(mdrs, cadastros),
+        "EMPILHAMENTO BASE": gerador.choice([1, 2, 3], cadastros),
+    })
+    return df_saturacao, db_empilhamento
+
+
+def bench_empilhamento(linhas, cadastros, caixas, repeticoes):
+    from DB import calcular_empilhamento
+
+    df_saturacao, db_empilhamento = _empilhamento_sintetico(linhas, cadastros, caixas)
+
+    tempo_antigo, antigo = medir(_empilhamento_legado, df_saturacao, db_empilhamento, repeticoes=1)
+    tempo_novo, novo = medir(calcular_empilhamento, df_saturacao, db_empilhamento, repeticoes=repeticoes)
+    try:
+        pd.testing.assert_frame_equal(antigo, novo, check_dtype=False)
+        iguais = True
+    except AssertionError:
+        iguais = False
+
+    print(f"{'Etapa':<40} {'Antigo':>13} {'Novo':>13} {'Ganho':>9}")
+    imprimir_linha(f"Empilhamento ({len(novo)} pares)", tempo_antigo, tempo_novo)
+    print(f"Resultados iguais: {'sim' if iguais else 'NÃO'}")
+
+
+# ------------------- SATURAÇÃO TOTAL -------------------
+
+def _saturacao_total_legado(df_sat, df_emp):
+    """apply linha a linha filtrando o df_emp inteiro para somar a SATURAÇÃO (referência)"""
+    import numpy as np
+
+    def calcular(row):
+        filtro = (df_emp['FORNECEDOR'] == row['COD FORNECEDOR']) & \
+                 (df_emp['EMBALAGEM_BASE'] == row['EMBALAGEM']) & \
+                 (df_emp['COD FLUXO'] == row['COD FLUXO'])
+        soma_saturacoes = df_emp[filtro]['SATURAÇÃO'].sum()
+        if pd.isna(row['CAPACIDADE']) or row['CAPACIDADE'] == 0:
+            return 0
+        return (row['CXS/PALLETS_TOTAL'] / row['CAPACIDADE'] + soma_saturacoes) * row['EFICIÊNCIA_COMPRIMENTO']
+
+    df_sat['SATURAÇÃO_TOTAL'] = df_sat.apply(calcular, axis=1)
+    df_sat['SATURAÇÃO_TOTAL'] = df_sat['SATURAÇÃO_TOTAL'].replace([np.inf, -np.inf], np.nan).fillna(0)
+    df_sat['SATURAÇÃO_POR_MDR'] = 0.0
+    mask = (df_sat['TOTAL DE CXS'].notna()) & (df_sat['TOTAL DE CXS'] > 0)
+    df_sat.loc[mask, 'SATURAÇÃO_POR_MDR'] = df_sat.loc[mask, 'SATURAÇÃO_TOTAL'] / df_sat.loc[mask, 'TOTAL DE CXS']
+    df_sat['SATURAÇÃO_POR_MDR'] = df_sat['SATURAÇÃO_POR_MDR'].replace([np.inf, -np.inf], np.nan).fillna(0)
+    return df_sat
+
+
+def bench_saturacao_total(linhas, repeticoes):
+    from DB import calcular_empilhamento, integrar_saturacao_total
+
+    df_saturacao, db_empilhamento = _empilhamento_sintetico(linhas, linhas, 50)
+    df_saturacao["CXS/PALLETS_TOTAL"] = df_saturacao["TOTAL DE CXS"] / 2
+    df_saturacao["EFICIÊNCIA_COMPRIMENTO"] = 0.9
+    df_emp = calcular_empilhamento(df_saturacao, db_empilhamento)
+
+    tempo_antigo, antigo = medir(lambda: _saturacao_total_legado(df_saturacao.copy(), df_emp), repeticoes=1)
+    tempo_novo, novo = medir(lambda: integrar_saturacao_total(df_saturacao.copy(), df_emp), repeticoes=repeticoes)
+    try:
+        pd.testing.assert_frame_equal(antigo, novo, check_dtype=False)
+        iguais = True
+    except AssertionError:
+        iguais = False
+
+    print(f"{'Etapa':<40} {'Antigo':>13} {'Novo':>13} {'Ganho':>9}")
+    imprimir_linha(f"SATURAÇÃO_TOTAL ({linhas} linhas)", tempo_antigo, tempo_novo)
+    print(f"Resultados iguais: {'sim' if iguais else 'NÃO'}")
+
+
+# ------------------- INICIALIZAÇÃO -------------------
+
+# Módulos que `import DB` não deve carregar: interface (Tk/PIL) e gravação de Excel (openpyxl)
+MODULOS_PESADOS_DB = ("tkinter", "PIL", "openpyxl")
+
+
+def medir_importacao(modulo, repeticoes):
+    """Tempos (s) de `import modulo` em interpretadores novos, na pasta do projeto"""
+    codigo = f"import time; inicio = time.perf_counter(); import {modulo}; print(time.perf_counter() - inicio)"
+    tempos = []
+    for _ in range(repeticoes):
+        saida = subprocess.run([sys.executable, "-c", codigo], cwd=caminho_base, capture_output=True,
+                               text=True, check=True)
+        tempos.append(float(saida.stdout.strip().splitlines()[-1]))
+    return tempos
+
+
+def bench_inicializacao(repeticoes, orcamentos):
+    """Compara a mediana do tempo de importação de DB e main com o orçamento; retorna False se estourar"""
+    dentro = True
+    print(f"{'Módulo':<10} {'Melhor':>10} {'Mediana':>10} {'Orçamento':>10}")
+    for modulo, orcamento in orcamentos.items():
+        tempos = medir_importacao(modulo, repeticoes)
+        mediana = statistics.median(tempos)
+        situacao = "ok" if mediana <= orcamento else "ACIMA DO ORÇAMENTO"
+        dentro = dentro and mediana <= orcamento
+        print(f"{modulo:<10} {min(tempos) * 1000:>7.0f} ms {mediana * 1000:>7.0f} ms {orcamento * 1000:>7.0f} ms  {situacao}")
+
+    codigo = f"import sys, DB; print(','.join(m for m in {MODULOS_PESADOS_DB!r} if m in sys.modules))"
+    carregados = subprocess.run([sys.executable, "-c", codigo], cwd=caminho_base, capture_output=True,
+                                text=True, check=True).stdout.strip()
+    if carregados:
+        dentro = False
+        print(f"import DB carregou {carregados} (deveria ficar para a interface/exportação)")
+    return dentro
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks do VIAJANTE")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    parser_txt = subparsers.add_parser("txt", help="Parser GMDNVA8: laço por linha vs. colunar")
+    parser_txt.add_argument("--pasta", default=os.path.join(caminho_base, "Albert demanda"),
+                            help="Pasta com arquivos GMDNVA8 (.txt/.csv)")
+    parser_txt.add_argument("--repeticoes", type=int, default=5, help="Repetições por medição (melhor tempo)")
+    parser_txt.add_argument("--sinteticos", type=int, nargs="*", default=[300, 100000],
+                            help="Quantidade de linhas dos arquivos GMDNVA8 sintéticos")
+
+    parser_cache = subparsers.add_parser("cache", help="Processar_Demandas: leitura completa vs. cache de demandas")
+    parser_cache.add_argument("--pasta", default="Demandas", help="Pasta de demandas (relativa à pasta do projeto)")
+    parser_cache.add_argument("--sheet", default=None, help="Aba de saturação / data das Coletas DHL")
+    parser_cache.add_argument("--repeticoes", type=int, default=3, help="Repetições por medição (melhor tempo)")
+
+    parser_registros = subparsers.add_parser("registros", help="Registros do BD: pd.read_excel vs. arquivo colunar")
+    parser_registros.add_argument("--bd", default="BD", help="Pasta do BD (relativa à pasta do projeto)")
+    parser_registros.add_argument("--repeticoes", type=int, default=3, help="Repetições por medição (melhor tempo)")
+
+    parser_inicializacao = subparsers.add_parser("inicializacao", help="Tempo de importação de DB e main (abertura do programa)")
+    parser_inicializacao.add_argument("--orcamento-db", type=float, default=1.0, help="Orçamento para import DB (segundos)")
+    parser_inicializacao.add_argument("--orcamento-main", type=float, default=1.5, help="Orçamento para import main (segundos)")
+    parser_inicializacao.add_argument("--repeticoes", type=int, default=5, help="Interpretadores novos por módulo")
+
+    parser_exportacao = subparsers.add_parser("exportacao", help="Volume_por_rota.xlsx: pd.ExcelWriter + openpyxl vs. XML direto")
+    parser_exportacao.add_argument("--linhas", type=int, nargs="+", default=[10000, 100000, 500000],
+                                   help="Tamanhos da tabela sintética")
+    parser_exportacao.add_argument("--limite-legado", type=int, default=100000,
+                                   help="Maior tabela medida também no caminho antigo (lento e pesado em memória)")
+    parser_exportacao.add_argument("--saida", default=caminho_base, help="Pasta para os arquivos temporários")
+
+    parser_log = subparsers.add_parser("log_pns", help="Log de PNs não cadastrados: regravar o .xlsx vs. upsert no SQLite")
+    parser_log.add_argument("--historico", type=int, nargs="+", default=[1000, 10000, 50000],
+                            help="Linhas já existentes no log")
+    parser_log.add_argument("--novas", type=int, default=200, help="PNs registrados por cálculo")
+
+    parser_capacidade = subparsers.add_parser("capacidade", help="CAPACIDADE da saturação: apply por linha vs. tabela pré-calculada")
+    parser_capacidade.add_argument("--registro", type=int, default=50000, help="Linhas do BD_CADASTRO_MDR sintético")
+    parser_capacidade.add_argument("--linhas", type=int, default=2000, help="Linhas da aba Saturação")
+    parser_capacidade.add_argument("--repeticoes", type=int, default=3, help="Repetições por medição (melhor tempo)")
+
+    parser_escada = subparsers.add_parser("escada", help="Saturação nos veículos menores: varredura por linha e veículo vs. matriz")
+    parser_escada.add_argument("--registro", type=int, default=50000, help="Linhas do BD_CADASTRO_MDR sintético")
+    parser_escada.add_argument("--linhas", type=int, default=2000, help="Linhas da aba Saturação")
+    parser_escada.add_argument("--repeticoes", type=int, default=3, help="Repetições por medição (melhor tempo)")
+
+    parser_eficiencia = subparsers.add_parser("eficiencia", help="EFICIÊNCIA_COMPRIMENTO: filtro por linha vs. tabela longa")
+    parser_eficiencia.add_argument("--registro", type=int, default=20000, help="Linhas do BD_CADASTRO_MDR_PERDA_COMPRIMENTO sintético")
+    parser_eficiencia.add_argument("--linhas", type=int, default=2000, help="Linhas da aba Saturação")
+    parser_eficiencia.add_argument("--repeticoes", type=int, default=3, help="Repetições por medição (melhor tempo)")
+
+    parser_empilhamento = subparsers.add_parser("empilhamento", help="calcular_empilhamento: laços iterrows vs. junções e divisão inteira")
+    parser_empilhamento.add_argument("--linhas", type=int, default=2000, help="Linhas da aba Saturação")
+    parser_empilhamento.add_argument("--cadastros", type=int, default=2000, help="Linhas do BD_EMPILHAMENTO_EMBALAGENS sintético")
+    parser_empilhamento.add_argument("--caixas", type=int, default=5000, help="Máximo de caixas por linha")
+    parser_empilhamento.add_argument("--repeticoes", type=int, default=3, help="Repetições por medição (melhor tempo)")
+
+    parser_saturacao = subparsers.add_parser("saturacao_total", help="integrar_saturacao_total: filtro por linha vs. groupby e junção")
+    parser_saturacao.add_argument("--linhas", type=int, default=5000, help="Linhas da aba Saturação")
+    parser_saturacao.add_argument("--repeticoes", type=int, default=3, help="Repetições por medição (melhor tempo)")
+
+    args = parser.parse_args()
+
+    if args.benchmark == "txt":
+        bench_txt(args.pasta, args.repeticoes, args.sinteticos)
+    elif args.benchmark == "cache":
+        bench_cache(args.pasta, args.sheet, args.repeticoes)
+    elif args.benchmark == "registros":
+        bench_registros(args.bd, args.repeticoes)
+    elif args.benchmark == "exportacao":
+        bench_exportacao(args.linhas, args.limite_legado, args.saida)
+    elif args.benchmark == "log_pns":
+        bench_log_pns(args.historico, args.novas)
+    elif args.benchmark == "capacidade":
+        bench_capacidade(args.registro, args.linhas, args.repeticoes)
+    elif args.benchmark == "escada":
+        bench_escada(args.registro, args.linhas, args.repeticoes)
+    elif args.benchmark == "eficiencia":
+        bench_eficiencia(args.registro, args.linhas, args.repeticoes)
+    elif args.benchmark == "empilhamento":
+        bench_empilhamento(args.linhas, args.cadastros, args.caixas, args.repeticoes)
+    elif args.benchmark == "saturacao_total":
+        bench_saturacao_total(args.linhas, args.repeticoes)
+    elif args.benchmark == "inicializacao":
+        if not bench_inicializacao(args.repeticoes, {"DB": args.orcamento_db, "main": args.orcamento_main}):
+            sys.exit(1)